@@ -0,0 +1,153 @@
+"""
+Адаптивное ограничение одновременных запросов к LLM (AIMD)
+Лимит растет на единицу за "окно" успешных ответов с нормальной задержкой
+и уменьшается в разы при перегрузке (429, 5xx, таймауты)
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Dict, Optional
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбор заголовка Retry-After: секунды или HTTP дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD лимитер одновременных запросов
+
+    Args:
+        initial_limit: Стартовый лимит
+        min_limit: Нижняя граница лимита
+        max_limit: Верхняя граница лимита
+        decrease_factor: Во сколько раз уменьшается лимит при перегрузке
+        latency_tolerance: Во сколько раз задержка может превышать базовую, чтобы лимит рос
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int = 1, max_limit: int = 32,
+                 decrease_factor: float = 0.5, latency_tolerance: float = 2.0):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None      # Текущая задержка (быстрая EWMA)
+        self.latency_baseline: Optional[float] = None  # Базовая задержка (медленная EWMA)
+        self._blocked_until = 0.0                      # Retry-After: до этого момента новые запросы ждут
+        self._last_decrease = 0.0
+        self._increases = 0
+        self._decreases = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self.logger = logging.getLogger("AdaptiveConcurrencyLimiter")
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Занять слот на время одного HTTP запроса"""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            await self.release()
+
+    async def acquire(self):
+        """Ожидание свободного слота и окончания паузы Retry-After"""
+        condition = self._get_condition()
+        async with condition:
+            while True:
+                pause = self._blocked_until - time.monotonic()
+                if pause > 0:
+                    # Ждем паузу, но просыпаемся, если ее продлят или сократят
+                    try:
+                        await asyncio.wait_for(condition.wait(), timeout=pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                await condition.wait()
+
+    async def release(self):
+        """Освобождение слота"""
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    async def on_success(self, latency: float):
+        """Успешный ответ: учитываем задержку и при здоровой задержке увеличиваем лимит"""
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+            self.latency_baseline = latency
+        else:
+            self.latency_ewma = 0.3 * latency + 0.7 * self.latency_ewma
+            self.latency_baseline = 0.05 * latency + 0.95 * self.latency_baseline
+
+        if self.latency_ewma > self.latency_baseline * self.latency_tolerance:
+            return
+
+        # Аддитивный рост: +1 к лимиту примерно за limit успешных ответов
+        if self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._increases += 1
+            await self._notify()
+
+    async def on_overload(self, retry_after: Optional[float] = None):
+        """Перегрузка (429/5xx/таймаут): мультипликативно уменьшаем лимит"""
+        now = time.monotonic()
+
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+            self.logger.warning(f"⏸️ Retry-After: новые запросы приостановлены на {retry_after:.1f}с")
+            await self._notify()
+
+        # Пачка ошибок от одного "поколения" запросов уменьшает лимит один раз
+        cooldown = min(self.latency_ewma or 1.0, 5.0)
+        if now - self._last_decrease < cooldown:
+            return
+
+        old_limit = self.limit
+        self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        self._last_decrease = now
+        self._decreases += 1
+        self.logger.warning(f"📉 Лимит одновременных запросов: {old_limit:.1f} → {self.limit:.1f}")
+
+    def metrics(self) -> Dict[str, Any]:
+        """Текущее состояние лимитера"""
+        return {
+            "лимит": int(self.limit),
+            "в_работе": self.in_flight,
+            "задержка_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "базовая_задержка": round(self.latency_baseline, 3) if self.latency_baseline is not None else None,
+            "увеличений": self._increases,
+            "уменьшений": self._decreases,
+            "пауза_retry_after": round(max(0.0, self._blocked_until - time.monotonic()), 1)
+        }
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Создаем лениво, чтобы привязаться к event loop, в котором идут запросы
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def _notify(self):
+        """Будим ожидающих: лимит вырос или пауза изменилась"""
+        condition = self._get_condition()
+        async with condition:
+            condition.notify_all()
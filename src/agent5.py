@@ -7,16 +7,19 @@ import asyncio
 import json
 import logging
 import os
+import random
 import time
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Any, Union, Annotated
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Any, Set, Tuple, Type, Union, Annotated
 from enum import Enum
 import operator
 
 import aiohttp
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, create_model, field_validator, model_validator
 from dotenv import load_dotenv
 
 # LangGraph импорты
@@ -25,6 +28,22 @@ from langgraph.graph.message import add_messages
 from typing_extensions import TypedDict
 
 from agent_context import AgentContext
+from adaptive_limiter import AdaptiveConcurrencyLimiter, parse_retry_after
+from provider_pool import Provider, ProviderPool, ProviderState, load_providers
+from priority_scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_WARMUP, PriorityScheduler
+from rate_limiter import DEFAULT_COMPLETION_TOKENS, RateLimiter, estimate_tokens, shared_rate_limiter
+from hedging import HedgeBudget, HedgeReport, LatencyTracker
+from deadline import Deadline, DeadlineExceeded
+from llm_cache import LLMResponseCache
+from singleflight import SingleFlight
+from json_extract import JSONExtractError, JSONStreamExtractor, extract_json
+from structured_output import ParseStats, is_invalid_schema_error, is_unsupported_error, json_schema_format
+from gift_index import GiftIndex, assign_gift_ids, gift_id
+from score_matrix import AGGREGATIONS, ScoreMatrix
+from call_log import (
+    CallLog, CallRecord, OUTCOME_ERROR, OUTCOME_LOST, SOURCE_API, SOURCE_CACHE, SOURCE_COALESCED
+)
+from recipient_classifier import DEFAULT_AGENTS, RECIPIENT_AGENTS, RecipientClassifier, load_classifier
 import gigafile
 
 # Настройка русскоязычного логирования
@@ -123,7 +142,8 @@ class GiftModel(BaseModel):
     релевантность: int = Field(..., ge=1, le=10, description="Оценка релевантности от 1 до 10")
     query: str = Field(..., min_length=0, description="query")
 
-    @validator('релевантность')
+    @field_validator('релевантность', mode='before')
+    @classmethod
     def validate_relevance(cls, v):
         """Проверяем, что релевантность - это число от 1 до 10"""
         if not isinstance(v, int):
@@ -133,39 +153,282 @@ class GiftModel(BaseModel):
                 raise ValueError('Релевантность должна быть числом от 1 до 10')
         return v
 
-class AgentResponseModel(BaseModel):
-    """Расширенная модель ответа ИИ-агента с поддержкой всех новых агентов"""
-    выбранный_подарок: str = Field(..., min_length=1)
+class AgentVoteModel(BaseModel):
+    """Общая часть ответа агента: id выбранного подарка и обоснование"""
+    подарок_id: str = Field(..., min_length=1, description="Идентификатор подарка из списка (g1, g2, ...)")
     обоснование: str = Field(..., min_length=1)
+    оценки: Optional[Dict[str, float]] = Field(None, description="Оценки всех подарков по id, 0..100 (режим оценки всех подарков)")
+    
+    @model_validator(mode='before')
+    @classmethod
+    def accept_gift_name(cls, data):
+        """Ответ в старом формате: вместо id - название подарка (id по нему найдет GiftIndex)"""
+        if isinstance(data, dict) and not data.get("подарок_id") and data.get("выбранный_подарок"):
+            return {**data, "подарок_id": data["выбранный_подарок"]}
+        return data
+
+# Оценка голоса, если агент не прислал свою метрику
+DEFAULT_VOTE_SCORE = 75.0
+
+@dataclass
+class AgentSpec:
+    """
+    Описание агента - единственный источник для его промпта, схемы ответа, нормализации оценки
+    и резервного ответа
+    """
+    agent_type: AgentType
+    display_name: str               # Имя агента для пользователя и в промпте
+    role: str                       # Чем занимается агент
+    task: str                       # Какой подарок выбрать
+    rationale: str                  # Что написать в обосновании
+    metric_field: str               # Поле оценки в ответе
+    fallback_value: float           # Оценка в резервном ответе
+    ratio: bool = False             # Оценка - коэффициент (>= 0), а не процент 0..100
+    scale: float = 1.0              # Множитель, приводящий оценку к шкале 0..100
+    response_model: Type[BaseModel] = field(init=False, repr=False)
+    
+    def __post_init__(self):
+        # Модель ответа агента собирается (и компилируется pydantic) один раз при импорте
+        self.response_model = create_model(
+            f"AgentResponse_{self.agent_type.value}",
+            __base__=AgentVoteModel,
+            **{self.metric_field: self.metric_definition()}
+        )
     
-    # Поля для оригинальных агентов
-    коэффициент_практической_ценности: Optional[int] = Field(None, ge=0, le=100)
-    roi_индекс: Optional[float] = Field(None, ge=0)
-    степень_восторга_процент: Optional[int] = Field(None, ge=0, le=100)
-    процент_сценариев_использования: Optional[int] = Field(None, ge=0, le=100)
-    шанс_запомниться_процент: Optional[int] = Field(None, ge=0, le=100)
-    прогноз_роста_ценности_процент: Optional[int] = Field(None, ge=0, le=100)
-    
-    # Поля для новых агентов
-    уровень_романтики_процент: Optional[int] = Field(None, ge=0, le=100)
-    детская_радость_процент: Optional[int] = Field(None, ge=0, le=100)
-    возрастная_уместность_процент: Optional[int] = Field(None, ge=0, le=100)
-    соответствие_хобби_процент: Optional[int] = Field(None, ge=0, le=100)
-    уровень_роскоши_процент: Optional[int] = Field(None, ge=0, le=100)
-    экономичность_процент: Optional[int] = Field(None, ge=0, le=100)
-    уровень_технологий_процент: Optional[int] = Field(None, ge=0, le=100)
-    творческий_потенциал_процент: Optional[int] = Field(None, ge=0, le=100)
-    польза_здоровью_процент: Optional[int] = Field(None, ge=0, le=100)
-    туристическая_ценность_процент: Optional[int] = Field(None, ge=0, le=100)
-    кулинарная_привлекательность_процент: Optional[int] = Field(None, ge=0, le=100)
-    семейная_ценность_процент: Optional[int] = Field(None, ge=0, le=100)
-    корпоративная_уместность_процент: Optional[int] = Field(None, ge=0, le=100)
+    def metric_definition(self) -> Tuple[Any, Any]:
+        """Тип и ограничения поля оценки для create_model"""
+        if self.ratio:
+            return Optional[float], Field(None, ge=0)
+        return Optional[int], Field(None, ge=0, le=100)
+    
+    @property
+    def persona(self) -> str:
+        placeholder = "число_коэффициент_полезности" if self.ratio else "число_от_0_до_100"
+        return f"""
+Ты {self.display_name} - {self.role}.
+{self.task}
+
+Ответь JSON объектом:
+{{
+  "подарок_id": "идентификатор подарка из списка (g1, g2, ...)",
+  "обоснование": "{self.rationale}",
+  "{self.metric_field}": {placeholder}
+}}"""
+    
+    def validate(self, data: Any, gift_index: GiftIndex) -> Dict[str, Any]:
+        """
+        Проверка ответа агента (ValidationError - это ValueError)
+        
+        Ссылка на подарок приводится к id из индекса, название подарка добавляется для вывода
+        """
+        response = self.response_model.model_validate(data).model_dump()
+        gift_key = gift_index.resolve(response["подарок_id"])
+        if gift_key is None:
+            raise ValueError(f"Подарок '{response['подарок_id']}' не найден в списке")
+        response["подарок_id"] = gift_key
+        response["выбранный_подарок"] = gift_index.get(gift_key)["подарок"]
+        if response.get("оценки"):
+            # Оценки с неизвестными подарками отбрасываются, остальные приводятся к шкале 0..100
+            scores = {}
+            for reference, value in response["оценки"].items():
+                reference_key = gift_index.resolve(reference)
+                if reference_key is not None:
+                    scores[reference_key] = min(max(float(value), 0.0), 100.0)
+            response["оценки"] = scores or None
+        return response
+    
+    def score(self, response: Dict[str, Any]) -> float:
+        """Оценка голоса по шкале 0..100"""
+        raw_score = response.get(self.metric_field)
+        if raw_score is None:
+            return DEFAULT_VOTE_SCORE
+        return min(float(raw_score) * self.scale, 100.0)
+    
+    def fallback_response(self, gift_index: GiftIndex) -> Dict[str, Any]:
+        """Резервный ответ агента без участия модели: первый подарок списка"""
+        return self.validate({
+            "подарок_id": next(iter(gift_index.by_id)),
+            "обоснование": f"Подарок выбран агентом {self.agent_type.value} (резервный режим)",
+            self.metric_field: self.fallback_value
+        }, gift_index)
+
+# Реестр голосующих агентов (все, кроме селектора)
+AGENT_SPECS: Dict[str, AgentSpec] = {spec.agent_type.value: spec for spec in (
+    AgentSpec(
+        AgentType.PRAKTIK_BOT, "ПрактикБот",
+        role="анализируешь практическую пользу подарков в повседневной жизни",
+        task="Выбери ОДИН подарок с максимальной практической ценностью.",
+        rationale="детальное объяснение практической пользы",
+        metric_field="коэффициент_практической_ценности", fallback_value=75
+    ),
+    AgentSpec(
+        AgentType.FIN_EXPERT, "ФинЭксперт",
+        role="анализируешь соотношение цена/качество подарков",
+        task="Выбери ОДИН подарок с лучшим экономическим эффектом.",
+        rationale="экономическое обоснование с расчетами",
+        metric_field="roi_индекс", fallback_value=2.5, ratio=True, scale=20.0
+    ),
+    AgentSpec(
+        AgentType.WOW_FACTOR, "ВауФактор",
+        role="ищешь подарки с высоким эмоциональным откликом",
+        task="Выбери ОДИН подарок, который вызовет максимальный восторг.",
+        rationale="объяснение эмоционального воздействия",
+        metric_field="степень_восторга_процент", fallback_value=75
+    ),
+    AgentSpec(
+        AgentType.UNIVERSAL_GURU, "УниверсалГуру",
+        role="ищешь максимально универсальные подарки",
+        task="Выбери ОДИН подарок для максимального количества ситуаций.",
+        rationale="объяснение универсальности применения",
+        metric_field="процент_сценариев_использования", fallback_value=70
+    ),
+    AgentSpec(
+        AgentType.SURPRISE_MASTER, "СюрпризМастер",
+        role="ищешь нестандартные и неожиданные подарки",
+        task="Выбери ОДИН самый неожиданный и запоминающийся подарок.",
+        rationale="объяснение неожиданности и запоминаемости",
+        metric_field="шанс_запомниться_процент", fallback_value=75
+    ),
+    AgentSpec(
+        AgentType.PROF_ROST, "ПрофРост",
+        role="специализируешься на подарках для профессионального развития",
+        task="Выбери ОДИН подарок с максимальной пользой для карьеры.",
+        rationale="объяснение пользы для профессионального развития",
+        metric_field="прогноз_роста_ценности_процент", fallback_value=70
+    ),
+    AgentSpec(
+        AgentType.ROMANTIC_ADVISOR, "РомантикСоветник",
+        role="специалист по романтическим подаркам для близких отношений",
+        task="Выбери ОДИН подарок с максимальным романтическим потенциалом.",
+        rationale="объяснение романтической ценности подарка",
+        metric_field="уровень_романтики_процент", fallback_value=80
+    ),
+    AgentSpec(
+        AgentType.KIDS_EXPERT, "ДетскийЭксперт",
+        role="специалист по подаркам для детей разного возраста",
+        task="Выбери ОДИН подарок, наиболее подходящий для ребенка.",
+        rationale="объяснение пользы для развития и радости ребенка",
+        metric_field="детская_радость_процент", fallback_value=85
+    ),
+    AgentSpec(
+        AgentType.ELDERLY_CARE, "ЗаботаОПожилых",
+        role="специалист по подаркам для людей старшего возраста",
+        task="Выбери ОДИН подарок, учитывающий потребности пожилого человека.",
+        rationale="объяснение пользы и удобства для пожилого человека",
+        metric_field="возрастная_уместность_процент", fallback_value=80
+    ),
+    AgentSpec(
+        AgentType.HOBBY_HUNTER, "ОхотникХобби",
+        role="специалист по подаркам, связанным с увлечениями и хобби",
+        task="Выбери ОДИН подарок, максимально соответствующий увлечениям человека.",
+        rationale="объяснение связи подарка с хобби и интересами",
+        metric_field="соответствие_хобби_процент", fallback_value=75
+    ),
+    AgentSpec(
+        AgentType.LUXURY_CURATOR, "КураторЛюкса",
+        role="специалист по премиальным и роскошным подаркам",
+        task="Выбери ОДИН подарок с максимальным уровнем престижа и качества.",
+        rationale="объяснение премиальности и престижности подарка",
+        metric_field="уровень_роскоши_процент", fallback_value=90
+    ),
+    AgentSpec(
+        AgentType.BUDGET_SAVER, "БюджетСпаситель",
+        role="специалист по качественным, но доступным подаркам",
+        task="Выбери ОДИН подарок с минимальной стоимостью и максимальной ценностью.",
+        rationale="объяснение экономности при сохранении качества",
+        metric_field="экономичность_процент", fallback_value=85
+    ),
+    AgentSpec(
+        AgentType.TECH_GURU, "ТехГуру",
+        role="специалист по современным технологичным подаркам",
+        task="Выбери ОДИН самый технологичный и современный подарок.",
+        rationale="объяснение технологичности и инновационности",
+        metric_field="уровень_технологий_процент", fallback_value=80
+    ),
+    AgentSpec(
+        AgentType.CREATIVE_SOUL, "ТворческаяДуша",
+        role="специалист по подаркам для креативных и артистичных людей",
+        task="Выбери ОДИН подарок, способствующий творческому самовыражению.",
+        rationale="объяснение влияния на творчество и самовыражение",
+        metric_field="творческий_потенциал_процент", fallback_value=75
+    ),
+    AgentSpec(
+        AgentType.WELLNESS_COACH, "ВелнесТренер",
+        role="специалист по подаркам для здоровья, красоты и благополучия",
+        task="Выбери ОДИН подарок, максимально полезный для физического и ментального здоровья.",
+        rationale="объяснение пользы для здоровья и самочувствия",
+        metric_field="польза_здоровью_процент", fallback_value=80
+    ),
+    AgentSpec(
+        AgentType.TRAVEL_EXPERT, "ЭкспертПутешествий",
+        role="специалист по подаркам для любителей путешествий",
+        task="Выбери ОДИН подарок, наиболее полезный в поездках и путешествиях.",
+        rationale="объяснение пользы в путешествиях и поездках",
+        metric_field="туристическая_ценность_процент", fallback_value=75
+    ),
+    AgentSpec(
+        AgentType.FOODIE_GUIDE, "ГидГурмана",
+        role="специалист по подаркам для любителей еды и кулинарии",
+        task="Выбери ОДИН подарок, связанный с едой, кулинарией или гастрономией.",
+        rationale="объяснение гастрономической ценности подарка",
+        metric_field="кулинарная_привлекательность_процент", fallback_value=80
+    ),
+    AgentSpec(
+        AgentType.FAMILY_BONDS, "СемейныеУзы",
+        role="специалист по подаркам, укрепляющим семейные отношения",
+        task="Выбери ОДИН подарок, способствующий семейному единству и общению.",
+        rationale="объяснение влияния на семейные отношения",
+        metric_field="семейная_ценность_процент", fallback_value=85
+    ),
+    AgentSpec(
+        AgentType.COLLEAGUE_CONNECTOR, "КоллегиальныйСвязующий",
+        role="специалист по корпоративным подаркам для коллег",
+        task="Выбери ОДИН подарок, подходящий для рабочих отношений.",
+        rationale="объяснение уместности в рабочей среде",
+        metric_field="корпоративная_уместность_процент", fallback_value=70
+    )
+)}
+
+# Для агентов вне реестра (селектор): общая роль и поле "оценка"
+GENERIC_AGENT_SPEC = AgentSpec(
+    AgentType.AGENT_SELECTOR, "СелекторАгентов",
+    role="выбираешь лучший подарок из списка",
+    task="Выбери ОДИН подарок, который лучше всего подходит человеку.",
+    rationale="объяснение выбора",
+    metric_field="оценка", fallback_value=75
+)
+
+def agent_spec(agent_name: str) -> AgentSpec:
+    """Описание агента по идентификатору (для агентов вне реестра - общее)"""
+    return AGENT_SPECS.get(agent_name, GENERIC_AGENT_SPEC)
+
+AGENT_DISPLAY_NAMES = {
+    **{name: spec.display_name for name, spec in AGENT_SPECS.items()},
+    GENERIC_AGENT_SPEC.agent_type.value: GENERIC_AGENT_SPEC.display_name
+}
+
+# Общая модель ответа любого агента (схема этапа agent в response_format): все метрики необязательны
+AgentResponseModel = create_model(
+    "AgentResponseModel",
+    __base__=AgentVoteModel,
+    **{spec.metric_field: spec.metric_definition() for spec in AGENT_SPECS.values()}
+)
+
+class AgentSelectionModel(BaseModel):
+    """Ответ селектора агентов"""
+    selected_agents: List[str] = Field(..., description="Идентификаторы выбранных агентов")
+    reasoning: str = Field("", description="Объяснение выбора")
+
+class GiftListModel(BaseModel):
+    """Список подарков: в response_format корнем схемы может быть только объект, поэтому массив обернут"""
+    gifts: List[GiftModel]
 
 class PersonInfoModel(BaseModel):
     """Модель информации о человеке с защитой от инъекций"""
     info: str = Field(..., min_length=0)
     
-    @validator('info')
+    @field_validator('info')
+    @classmethod
     def validate_person_info(cls, v):
         """Базовая защита от опасного контента"""
         dangerous_patterns = ['<script', 'javascript:', 'eval(', 'exec(', 'import(']
@@ -190,6 +453,32 @@ class GraphState(dict):
         self.setdefault("files", [])
         self.setdefault("selected_agents", [])  # Новое поле для списка выбранных агентов
         
+def _panel_schema() -> Dict[str, Any]:
+    """Схема ответа панели: идентификатор агента -> ответ в формате этого агента"""
+    return {
+        "type": "object",
+        "properties": {name: {"$ref": f"#/$defs/{name}"} for name in AGENT_SPECS},
+        "$defs": {name: spec.response_model.model_json_schema() for name, spec in AGENT_SPECS.items()}
+    }
+
+# response_format этапов: все поля подарка и селектора обязательны - строгий режим,
+# у ответа агента поля метрик необязательны - схема без strict
+STAGE_RESPONSE_FORMATS = {
+    "generation": json_schema_format("gift_list", GiftListModel.model_json_schema(), strict=True),
+    "selector": json_schema_format("agent_selection", AgentSelectionModel.model_json_schema(), strict=True),
+    "agent": json_schema_format("agent_response", AgentResponseModel.model_json_schema()),
+    "panel": json_schema_format("agent_panel", _panel_schema())
+}
+
+# Тип JSON ответа этапа: стриминг отслеживает только свою открывающую скобку ("[1]" в тексте перед
+# объектом агента - не ответ); этапы без записи (make_request) принимают любой
+STAGE_JSON_TYPES = {
+    "generation": list,
+    "selector": dict,
+    "agent": dict,
+    "panel": dict
+}
+
 print("✅ Обновленные модели данных с поддержкой всех агентов созданы")
 
 """
@@ -197,16 +486,111 @@ print("✅ Обновленные модели данных с поддержк
 Настройки API, лимиты, таймауты и другие параметры системы
 """
 
+def _env_flag(name: str, default: bool) -> bool:
+    """Чтение булевого флага из переменных окружения"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def _env_optional(name: str, default, cast):
+    """Чтение необязательного числа: пустая строка или "none" - параметр не передается в API"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    value = value.strip()
+    if not value or value.lower() == "none":
+        return None
+    return cast(value)
+
+@dataclass
+class StageModelSettings:
+    """Модель и параметры генерации для одного этапа pipeline"""
+    model: str                                  # Модель этапа
+    max_tokens: Optional[int] = None            # Лимит токенов ответа (None - по умолчанию провайдера)
+    temperature: Optional[float] = None         # Температура (None - по умолчанию модели)
+    reasoning_effort: str = ""                  # low / medium / high, none - без рассуждений, пусто - как у модели
+    
+    @classmethod
+    def from_env(cls, stage: str, default: 'StageModelSettings') -> 'StageModelSettings':
+        """Переопределение через {STAGE}_MODEL, {STAGE}_MAX_TOKENS, {STAGE}_TEMPERATURE, {STAGE}_REASONING_EFFORT"""
+        prefix = stage.upper()
+        return cls(
+            model=os.getenv(f"{prefix}_MODEL", default.model),
+            max_tokens=_env_optional(f"{prefix}_MAX_TOKENS", default.max_tokens, int),
+            temperature=_env_optional(f"{prefix}_TEMPERATURE", default.temperature, float),
+            reasoning_effort=os.getenv(f"{prefix}_REASONING_EFFORT", default.reasoning_effort).strip().lower()
+        )
+
 @dataclass
 class Configuration:
     """Централизованная конфигурация всех параметров системы"""
     api_token: str                              # API токен для OpenRouter
     base_url: str = "https://openrouter.ai/api/v1"  # Базовый URL API
+    llm_providers: str = ""                     # JSON со списком провайдеров (пусто - только base_url)
+    llm_rpm: int = 0                            # Квота запросов в минуту на провайдера (0 - без ограничения)
+    llm_tpm: int = 0                            # Квота токенов в минуту на провайдера (0 - без ограничения)
+    scheduler_background_share: float = 0.5     # Максимальная доля слотов для фоновых запросов
+    scheduler_warmup_share: float = 0.25        # Максимальная доля слотов для прогрева кэша
     model: str = "google/gemini-2.5-flash-preview:thinking"  # Модель ИИ
+    fast_model: str = "google/gemini-2.5-flash-preview"  # Модель без рассуждений для коротких этапов
     max_retries: int = 3                        # Максимум попыток при ошибке
     retry_delay: float = 2.0                    # Задержка между попытками (сек)
     request_timeout: int = 30                   # Таймаут запроса (сек)
-    max_concurrent_requests: int = 6            # Максимум одновременных запросов
+    max_concurrent_requests: int = 6            # Стартовый лимит одновременных запросов
+    adaptive_concurrency: bool = True           # AIMD подстройка лимита по задержкам и 429/5xx
+    min_concurrent_requests: int = 1            # Нижняя граница адаптивного лимита
+    max_concurrent_requests_limit: int = 24     # Верхняя граница адаптивного лимита
+    keepalive_timeout: float = 75.0             # Сколько держать простаивающее соединение (сек)
+    stream_responses: bool = False              # SSE стриминг с обрывом после полного JSON
+    hedge_requests: bool = False                # Дублировать медленные запросы (хеджирование)
+    hedge_percentile: float = 0.9               # Порог хеджа - перцентиль задержек этапа
+    hedge_budget_ratio: float = 0.1             # Максимальная доля дополнительных запросов
+    hedge_min_samples: int = 20                 # Сколько замеров нужно до первого хеджа
+    hedge_shadow_ratio: float = 0.1             # Доля вызовов, где основной запрос не отменяется (p99 без хеджа в отчете)
+    agent_quorum_votes: int = 0                 # Кворум голосов агентов (0 - ждать всех)
+    agent_stage_deadline: float = 0.0           # Дедлайн этапа голосования, сек (0 - без дедлайна)
+    agent_consensus_threshold: float = 0.0      # Доля голосов лидера для досрочного финала (0 - не требуется)
+    request_deadline: float = 90.0              # Бюджет времени на весь запрос пользователя, сек (0 - без ограничения)
+    photo_budget_share: float = 0.2             # Доля бюджета на анализ фотографий
+    photo_timeout: float = 30.0                 # Таймаут GigaChat клиента на HTTP запрос анализа фото, сек
+    photo_workers: int = 2                      # Потоки для синхронного GigaChat клиента (анализ фото)
+    generation_budget_share: float = 0.5        # Доля оставшегося бюджета на генерацию подарков
+    llm_cache_enabled: bool = True              # Кэш ответов LLM (память + SQLite)
+    llm_cache_path: str = ""                    # Файл дискового кэша, лучше абсолютный путь (пусто - только память)
+    llm_cache_stages: str = "selector,agent,panel"  # Этапы с кэшем; без generation повтор запроса дает новые подарки
+    llm_cache_ttl: float = 86400.0              # Время жизни записи кэша, сек
+    llm_cache_memory_size: int = 512            # Размер LRU кэша в памяти
+    llm_cache_disk_max_entries: int = 20000     # Максимум записей в дисковом кэше
+    coalesce_requests: bool = True              # Склеивать одинаковые одновременные запросы
+    agent_selection_enabled: bool = True        # Запускать только агентов, выбранных селектором
+    agent_evaluation_mode: str = "fanout"       # fanout - запрос на агента, panel - все агенты одним запросом
+    min_agents: int = 4                         # Минимум агентов после выбора
+    max_agents: int = 6                         # Максимум агентов после выбора
+    local_classifier_enabled: bool = True       # Выбор агентов локальным классификатором без LLM
+    classifier_min_confidence: float = 0.6      # Ниже этой уверенности - запрос к LLM селектору
+    recipient_model_path: str = ""              # Обученная модель классификатора (пусто - встроенный корпус)
+    usage_log_path: str = "llm_usage.jsonl"     # Журнал токенов и задержек вызовов LLM (пусто - не писать)
+    structured_output: bool = True              # response_format с JSON схемой этапа (если провайдер поддерживает)
+    agent_score_all_gifts: bool = False         # Агенты оценивают каждый подарок, а не только выбранный
+    score_aggregation: str = "votes"            # Агрегация матрицы оценок: votes, mean, borda, condorcet, zscore
+    final_top_k: int = 2                        # Подарков в финальном выборе
+    stage_models: Dict[str, StageModelSettings] = field(default_factory=dict)  # Модели по этапам
+    
+    def __post_init__(self):
+        # Генерация подарков - основная модель с рассуждениями,
+        # выбор агентов и голосование - быстрая модель с коротким ответом
+        defaults = {
+            "generation": StageModelSettings(self.model),
+            "selector": StageModelSettings(self.fast_model, max_tokens=400, temperature=0.2),
+            "agent": StageModelSettings(self.fast_model, max_tokens=800, temperature=0.3),
+            "panel": StageModelSettings(self.fast_model, max_tokens=4000, temperature=0.3)
+        }
+        self.stage_models = {**defaults, **self.stage_models}
+    
+    def stage_settings(self, stage: str) -> StageModelSettings:
+        """Настройки этапа (неизвестный этап - основная модель без дополнительных параметров)"""
+        return self.stage_models.get(stage) or StageModelSettings(self.model)
 
     @classmethod
     def from_env(cls) -> 'Configuration':
@@ -218,17 +602,102 @@ class Configuration:
         config = cls(
             api_token=token,
             base_url=os.getenv("OPENROUTER_BASE_URL", cls.base_url),
+            llm_providers=os.getenv("LLM_PROVIDERS", cls.llm_providers),
+            llm_rpm=int(os.getenv("LLM_RPM", cls.llm_rpm)),
+            llm_tpm=int(os.getenv("LLM_TPM", cls.llm_tpm)),
+            scheduler_background_share=float(os.getenv("SCHEDULER_BACKGROUND_SHARE", cls.scheduler_background_share)),
+            scheduler_warmup_share=float(os.getenv("SCHEDULER_WARMUP_SHARE", cls.scheduler_warmup_share)),
             model=os.getenv("OPENROUTER_MODEL", cls.model),
+            fast_model=os.getenv("FAST_MODEL", cls.fast_model),
             max_retries=int(os.getenv("MAX_RETRIES", cls.max_retries)),
             retry_delay=float(os.getenv("RETRY_DELAY", cls.retry_delay)),
             request_timeout=int(os.getenv("REQUEST_TIMEOUT", cls.request_timeout)),
-            max_concurrent_requests=int(os.getenv("MAX_CONCURRENT_REQUESTS", cls.max_concurrent_requests))
+            max_concurrent_requests=int(os.getenv("MAX_CONCURRENT_REQUESTS", cls.max_concurrent_requests)),
+            adaptive_concurrency=_env_flag("ADAPTIVE_CONCURRENCY", cls.adaptive_concurrency),
+            min_concurrent_requests=int(os.getenv("MIN_CONCURRENT_REQUESTS", cls.min_concurrent_requests)),
+            max_concurrent_requests_limit=int(os.getenv("MAX_CONCURRENT_REQUESTS_LIMIT", cls.max_concurrent_requests_limit)),
+            keepalive_timeout=float(os.getenv("KEEPALIVE_TIMEOUT", cls.keepalive_timeout)),
+            stream_responses=_env_flag("STREAM_RESPONSES", cls.stream_responses),
+            hedge_requests=_env_flag("HEDGE_REQUESTS", cls.hedge_requests),
+            hedge_percentile=float(os.getenv("HEDGE_PERCENTILE", cls.hedge_percentile)),
+            hedge_budget_ratio=float(os.getenv("HEDGE_BUDGET_RATIO", cls.hedge_budget_ratio)),
+            hedge_min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", cls.hedge_min_samples)),
+            hedge_shadow_ratio=float(os.getenv("HEDGE_SHADOW_RATIO", cls.hedge_shadow_ratio)),
+            agent_quorum_votes=int(os.getenv("AGENT_QUORUM_VOTES", cls.agent_quorum_votes)),
+            agent_stage_deadline=float(os.getenv("AGENT_STAGE_DEADLINE", cls.agent_stage_deadline)),
+            agent_consensus_threshold=float(os.getenv("AGENT_CONSENSUS_THRESHOLD", cls.agent_consensus_threshold)),
+            request_deadline=float(os.getenv("REQUEST_DEADLINE", cls.request_deadline)),
+            photo_budget_share=float(os.getenv("PHOTO_BUDGET_SHARE", cls.photo_budget_share)),
+            photo_timeout=float(os.getenv("PHOTO_TIMEOUT", cls.photo_timeout)),
+            photo_workers=int(os.getenv("PHOTO_WORKERS", cls.photo_workers)),
+            generation_budget_share=float(os.getenv("GENERATION_BUDGET_SHARE", cls.generation_budget_share)),
+            llm_cache_enabled=_env_flag("LLM_CACHE_ENABLED", cls.llm_cache_enabled),
+            llm_cache_path=os.getenv("LLM_CACHE_PATH", cls.llm_cache_path),
+            llm_cache_stages=os.getenv("LLM_CACHE_STAGES", cls.llm_cache_stages),
+            llm_cache_ttl=float(os.getenv("LLM_CACHE_TTL", cls.llm_cache_ttl)),
+            llm_cache_memory_size=int(os.getenv("LLM_CACHE_MEMORY_SIZE", cls.llm_cache_memory_size)),
+            llm_cache_disk_max_entries=int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES", cls.llm_cache_disk_max_entries)),
+            coalesce_requests=_env_flag("COALESCE_REQUESTS", cls.coalesce_requests),
+            agent_selection_enabled=_env_flag("AGENT_SELECTION_ENABLED", cls.agent_selection_enabled),
+            agent_evaluation_mode=os.getenv("AGENT_EVALUATION_MODE", cls.agent_evaluation_mode).strip().lower(),
+            min_agents=int(os.getenv("MIN_AGENTS", cls.min_agents)),
+            max_agents=int(os.getenv("MAX_AGENTS", cls.max_agents)),
+            local_classifier_enabled=_env_flag("LOCAL_CLASSIFIER_ENABLED", cls.local_classifier_enabled),
+            classifier_min_confidence=float(os.getenv("CLASSIFIER_MIN_CONFIDENCE", cls.classifier_min_confidence)),
+            recipient_model_path=os.getenv("RECIPIENT_MODEL_PATH", cls.recipient_model_path),
+            usage_log_path=os.getenv("USAGE_LOG_PATH", cls.usage_log_path),
+            structured_output=_env_flag("STRUCTURED_OUTPUT", cls.structured_output),
+            agent_score_all_gifts=_env_flag("AGENT_SCORE_ALL_GIFTS", cls.agent_score_all_gifts),
+            score_aggregation=os.getenv("SCORE_AGGREGATION", cls.score_aggregation).strip().lower(),
+            final_top_k=int(os.getenv("FINAL_TOP_K", cls.final_top_k))
         )
         
+        config.stage_models = {
+            stage: StageModelSettings.from_env(stage, settings)
+            for stage, settings in config.stage_models.items()
+        }
+        
+        if config.agent_evaluation_mode not in ("fanout", "panel"):
+            raise ValueError(f"❌ AGENT_EVALUATION_MODE должен быть fanout или panel, получено: {config.agent_evaluation_mode}")
+        if config.score_aggregation not in AGGREGATIONS:
+            raise ValueError(f"❌ SCORE_AGGREGATION должен быть одним из {', '.join(AGGREGATIONS)}, "
+                             f"получено: {config.score_aggregation}")
+        
         print(f"✅ Конфигурация загружена:")
         print(f"  - Модель: {config.model}")
+        for stage, settings in config.stage_models.items():
+            print(f"  - Этап {stage}: {settings.model}, max_tokens={settings.max_tokens}, "
+                  f"temperature={settings.temperature}, reasoning={settings.reasoning_effort or 'по умолчанию'}")
+        if config.llm_providers:
+            providers = load_providers(config.llm_providers, config.base_url, config.api_token)
+            print(f"  - Провайдеры: {', '.join(f'{p.name} (вес {p.weight})' for p in providers)}")
+        if config.llm_rpm or config.llm_tpm:
+            print(f"  - Квоты провайдера: {config.llm_rpm or '∞'} запросов/мин, {config.llm_tpm or '∞'} токенов/мин")
         print(f"  - Максимум одновременных запросов: {config.max_concurrent_requests}")
+        if config.adaptive_concurrency:
+            print(f"  - Адаптивный лимит: {config.min_concurrent_requests}..{config.max_concurrent_requests_limit}")
         print(f"  - Таймаут: {config.request_timeout}с")
+        print(f"  - Бюджет запроса: {config.request_deadline or 'без ограничения'}с")
+        print(f"  - Анализ фото: таймаут {config.photo_timeout}с, потоков {config.photo_workers}")
+        if config.llm_cache_enabled:
+            print(f"  - Кэш ответов: {config.llm_cache_path or 'память'}, этапы: {config.llm_cache_stages or 'нет'}")
+        else:
+            print("  - Кэш ответов: выключен")
+        print(f"  - Стриминг ответов: {'да' if config.stream_responses else 'нет'}")
+        if config.agent_selection_enabled:
+            print(f"  - Выбор агентов: {config.min_agents}-{config.max_agents}")
+        if config.local_classifier_enabled:
+            print(f"  - Локальный классификатор получателя: порог уверенности {config.classifier_min_confidence}")
+        print(f"  - Режим оценки агентами: {config.agent_evaluation_mode}, "
+              f"{'оценка всех подарков' if config.agent_score_all_gifts else 'выбор одного подарка'}")
+        print(f"  - Агрегация оценок: {config.score_aggregation}, подарков в выборе: {config.final_top_k}")
+        if config.agent_quorum_votes or config.agent_stage_deadline:
+            print(f"  - Кворум агентов: {config.agent_quorum_votes or 'все'}, дедлайн: {config.agent_stage_deadline or 'нет'}")
+        print(f"  - Структурированный вывод (JSON схемы): {'да' if config.structured_output else 'нет'}")
+        print(f"  - Журнал расхода токенов: {config.usage_log_path or 'выключен'}")
+        if config.hedge_requests:
+            print(f"  - Хеджирование: p{int(config.hedge_percentile * 100)}, бюджет {config.hedge_budget_ratio:.0%}, "
+                  f"выборка без хеджа {config.hedge_shadow_ratio:.0%}")
         
         return config
 
@@ -236,7 +705,8 @@ print("✅ Класс конфигурации готов")
 
 """
 Ячейка 5: Безопасный парсер JSON ответов (ИСПРАВЛЕННАЯ ВЕРСИЯ)
-Заменяет небезопасный ast.literal_eval на json.loads с улучшенной обработкой
+Только json (без ast.literal_eval): первое JSON значение ищется в ответе за один проход
+через raw_decode, испорченный ответ чинится (см. json_extract)
 """
 
 class JSONParser:
@@ -248,7 +718,8 @@ class JSONParser:
     @staticmethod
     def parse_json_response(response: str) -> Dict[str, Any]:
         """
-        Безопасное извлечение и парсинг JSON из ответа ИИ
+        Безопасное извлечение и парсинг JSON объекта из ответа ИИ
+        Markdown разметка и текст вокруг JSON допускаются, предварительная очистка не нужна
         
         Args:
             response: Необработанный ответ от ИИ модели
@@ -260,75 +731,22 @@ class JSONParser:
             ValueError: Если JSON некорректен или не найден
         """
         try:
-            # Шаг 1: Очистка ответа от лишних символов
-            clean_response = response.strip()
-            
-            # Шаг 2: Удаление markdown разметки
-            if "```json" in clean_response:
-                parts = clean_response.split("```json")
-                if len(parts) > 1:
-                    clean_response = parts[1].split("```")[0].strip()
-            elif "```" in clean_response:
-                parts = clean_response.split("```")
-                if len(parts) > 1:
-                    clean_response = parts[1].split("```")[0].strip()
-            
-            # Шаг 3: Поиск JSON объекта в тексте (улучшенный алгоритм)
-            json_str = clean_response
-            
-            # Ищем фигурные скобки для объекта
-            start_idx = clean_response.find('{')
-            if start_idx != -1:
-                # Находим соответствующую закрывающую скобку
-                brace_count = 0
-                end_idx = -1
-                
-                for i in range(start_idx, len(clean_response)):
-                    if clean_response[i] == '{':
-                        brace_count += 1
-                    elif clean_response[i] == '}':
-                        brace_count -= 1
-                        if brace_count == 0:
-                            end_idx = i
-                            break
-                
-                if end_idx != -1:
-                    json_str = clean_response[start_idx:end_idx + 1]
-            
-            # Шаг 4: Дополнительная очистка JSON строки
-            # Удаляем лишние пробелы и переносы строк внутри строк
-            json_str = json_str.replace('\n', ' ').replace('\r', ' ')
-            
-            # Нормализуем множественные пробелы
-            import re
-            json_str = re.sub(r'\s+', ' ', json_str)
-            
-            # Шаг 5: БЕЗОПАСНЫЙ парсинг только через json.loads
-            parsed_data = json.loads(json_str)
-            
-            # Шаг 6: Проверка типа результата
-            if not isinstance(parsed_data, dict):
-                raise ValueError("Ответ должен быть JSON объектом (словарем)")
-            
-            logger.info(f"✅ JSON успешно распарсен, полей: {len(parsed_data)}")
-            return parsed_data
-            
-        except json.JSONDecodeError as e:
+            parsed_data, repaired = extract_json(response, dict)
+        except JSONExtractError as e:
             logger.error(f"❌ Ошибка парсинга JSON: {str(e)}")
             logger.error(f"🔍 Исходный ответ: {response[:500]}...")
-            logger.error(f"🔍 Очищенная строка: {json_str[:500] if 'json_str' in locals() else 'не определена'}...")
-            print(traceback.format_exc())
-            raise ValueError(f"Некорректный JSON в ответе: {str(e)}")
-        except Exception as e:
-            logger.error(f"💥 Неожиданная ошибка при парсинге: {str(e)}")
-            logger.error(f"🔍 Проблемный ответ: {response[:200]}...")
-            print(traceback.format_exc())
-            raise ValueError(f"Ошибка обработки ответа: {str(e)}")
+            raise
+        
+        if repaired:
+            logger.warning(f"🩹 JSON ответа починен, полей: {len(parsed_data)}")
+        else:
+            logger.info(f"✅ JSON успешно распарсен, полей: {len(parsed_data)}")
+        return parsed_data
     
     @staticmethod
     def parse_json_array(response: str) -> List[Dict[str, Any]]:
         """
-        Парсинг JSON массива (для списка подарков) - улучшенная версия
+        Парсинг JSON массива (для списка подарков)
         
         Args:
             response: Ответ содержащий JSON массив
@@ -337,56 +755,17 @@ class JSONParser:
             Список словарей
         """
         try:
-            clean_response = response.strip()
-            
-            # Удаление markdown разметки
-            if "```json" in clean_response:
-                clean_response = clean_response.split("```json")[1].split("```")[0].strip()
-            elif "```" in clean_response:
-                clean_response = clean_response.split("```")[1].split("```")[0].strip()
-            
-            # Поиск JSON массива с улучшенным алгоритмом
-            start_idx = clean_response.find('[')
-            if start_idx != -1:
-                # Находим соответствующую закрывающую скобку
-                bracket_count = 0
-                end_idx = -1
-                
-                for i in range(start_idx, len(clean_response)):
-                    if clean_response[i] == '[':
-                        bracket_count += 1
-                    elif clean_response[i] == ']':
-                        bracket_count -= 1
-                        if bracket_count == 0:
-                            end_idx = i
-                            break
-                
-                if end_idx != -1:
-                    json_str = clean_response[start_idx:end_idx + 1]
-                else:
-                    json_str = clean_response
-            else:
-                json_str = clean_response
-            
-            # Очистка строки
-            json_str = json_str.replace('\n', ' ').replace('\r', ' ')
-            import re
-            json_str = re.sub(r'\s+', ' ', json_str)
-            
-            # Безопасный парсинг массива
-            parsed_data = json.loads(json_str)
-            
-            if not isinstance(parsed_data, list):
-                raise ValueError("Ответ должен быть JSON массивом")
-            
-            logger.info(f"✅ JSON массив распарсен, элементов: {len(parsed_data)}")
-            return parsed_data
-            
-        except Exception as e:
+            parsed_data, repaired = extract_json(response, list)
+        except JSONExtractError as e:
             logger.error(f"❌ Ошибка парсинга JSON массива: {str(e)}")
             logger.error(f"🔍 Проблемный ответ: {response[:300]}...")
-            print(traceback.format_exc())
-            raise ValueError(f"Некорректный JSON массив: {str(e)}")
+            raise
+        
+        if repaired:
+            logger.warning(f"🩹 JSON массив починен, элементов: {len(parsed_data)}")
+        else:
+            logger.info(f"✅ JSON массив распарсен, элементов: {len(parsed_data)}")
+        return parsed_data
 
 print("✅ Улучшенный безопасный JSON парсер готов")
 
@@ -463,243 +842,89 @@ class PromptTemplate:
 }}
 """
 
-    @staticmethod  
-    def get_agent_prompt(agent_type: AgentType, person_info: str) -> str:
-        """Получение промпта для конкретного агента"""
-        
-        base_structure = f"""
-ИНФОРМАЦИЯ О ЧЕЛОВЕКЕ:
-{person_info}
-
-СПИСОК ПОДАРКОВ:
-{{gifts}}
-
+    # Общее начало промптов агентов и панели: статичные правила, затем подарки и профиль запроса.
+    # У всех агентов одного запроса начало промпта совпадает побайтно - провайдер кэширует этот префикс,
+    # поэтому все, что отличается между агентами (роль и формат ответа), идет строго после него
+    SHARED_PREFIX_TEMPLATE = """
+Ты участвуешь в выборе подарка. Ниже список подарков-кандидатов и информация о получателе.
 🔥 КРИТИЧЕСКИ ВАЖНО: Твой ответ должен быть СТРОГО в формате JSON объекта.
 ❗ НЕ добавляй никакого текста до или после JSON
 ❗ Отвечай ТОЛЬКО чистым JSON объектом
-"""
-
-        # Промпты для всех агентов
-        agent_prompts = {
-            # Оригинальные агенты
-            AgentType.PRAKTIK_BOT: base_structure + """
-Ты ПрактикБот - анализируешь практическую пользу подарков в повседневной жизни.
-Выбери ОДИН подарок с максимальной практической ценностью.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "детальное объяснение практической пользы",
-  "коэффициент_практической_ценности": число_от_0_до_100
-}""",
-
-            AgentType.FIN_EXPERT: base_structure + """
-Ты ФинЭксперт - анализируешь соотношение цена/качество подарков.
-Выбери ОДИН подарок с лучшим экономическим эффектом.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "экономическое обоснование с расчетами", 
-  "roi_индекс": число_коэффициент_полезности
-}""",
-
-            AgentType.WOW_FACTOR: base_structure + """
-Ты ВауФактор - ищешь подарки с высоким эмоциональным откликом.
-Выбери ОДИН подарок, который вызовет максимальный восторг.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение эмоционального воздействия",
-  "степень_восторга_процент": число_от_0_до_100
-}""",
-
-            AgentType.UNIVERSAL_GURU: base_structure + """
-Ты УниверсалГуру - ищешь максимально универсальные подарки.
-Выбери ОДИН подарок для максимального количества ситуаций.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение универсальности применения",
-  "процент_сценариев_использования": число_от_0_до_100
-}""",
-
-            AgentType.SURPRISE_MASTER: base_structure + """
-Ты СюрпризМастер - ищешь нестандартные и неожиданные подарки.
-Выбери ОДИН самый неожиданный и запоминающийся подарок.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение неожиданности и запоминаемости",
-  "шанс_запомниться_процент": число_от_0_до_100
-}""",
-
-            AgentType.PROF_ROST: base_structure + """
-Ты ПрофРост - специализируешься на подарках для профессионального развития.
-Выбери ОДИН подарок с максимальной пользой для карьеры.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение пользы для профессионального развития",
-  "прогноз_роста_ценности_процент": число_от_0_до_100
-}""",
-
-            # НОВЫЕ АГЕНТЫ
-            AgentType.ROMANTIC_ADVISOR: base_structure + """
-Ты РомантикСоветник - специалист по романтическим подаркам для близких отношений.
-Выбери ОДИН подарок с максимальным романтическим потенциалом.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение романтической ценности подарка",
-  "уровень_романтики_процент": число_от_0_до_100
-}""",
-
-            AgentType.KIDS_EXPERT: base_structure + """
-Ты ДетскийЭксперт - специалист по подаркам для детей разного возраста.
-Выбери ОДИН подарок, наиболее подходящий для ребенка.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение пользы для развития и радости ребенка",
-  "детская_радость_процент": число_от_0_до_100
-}""",
-
-            AgentType.ELDERLY_CARE: base_structure + """
-Ты ЗаботаОПожилых - специалист по подаркам для людей старшего возраста.
-Выбери ОДИН подарок, учитывающий потребности пожилого человека.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка", 
-  "обоснование": "объяснение пользы и удобства для пожилого человека",
-  "возрастная_уместность_процент": число_от_0_до_100
-}""",
-
-            AgentType.HOBBY_HUNTER: base_structure + """
-Ты ОхотникХобби - специалист по подаркам, связанным с увлечениями и хобби.
-Выбери ОДИН подарок, максимально соответствующий увлечениям человека.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение связи подарка с хобби и интересами",
-  "соответствие_хобби_процент": число_от_0_до_100
-}""",
 
-            AgentType.LUXURY_CURATOR: base_structure + """
-Ты КураторЛюкса - специалист по премиальным и роскошным подаркам.
-Выбери ОДИН подарок с максимальным уровнем престижа и качества.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение премиальности и престижности подарка",
-  "уровень_роскоши_процент": число_от_0_до_100
-}""",
-
-            AgentType.BUDGET_SAVER: base_structure + """
-Ты БюджетСпаситель - специалист по качественным, но доступным подаркам.
-Выбери ОДИН подарок с минимальной стоимостью и максимальной ценностью.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение экономности при сохранении качества",
-  "экономичность_процент": число_от_0_до_100
-}""",
-
-            AgentType.TECH_GURU: base_structure + """
-Ты ТехГуру - специалист по современным технологичным подаркам.
-Выбери ОДИН самый технологичный и современный подарок.
-
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение технологичности и инновационности",
-  "уровень_технологий_процент": число_от_0_до_100
-}""",
+СПИСОК ПОДАРКОВ:
+{gifts}
+ИНФОРМАЦИЯ О ЧЕЛОВЕКЕ:
+{person_info}
+"""
 
-            AgentType.CREATIVE_SOUL: base_structure + """
-Ты ТворческаяДуша - специалист по подаркам для креативных и артистичных людей.
-Выбери ОДИН подарок, способствующий творческому самовыражению.
+    PANEL_TEMPLATE = """
+Ты - панель из {count} независимых экспертов по подаркам. Каждый эксперт голосует
+только со своей точки зрения и не оглядывается на выбор остальных.
 
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение влияния на творчество и самовыражение",
-  "творческий_потенциал_процент": число_от_0_до_100
-}""",
+{personas}
+Ответь одним JSON объектом, где ключ - идентификатор эксперта,
+а значение - JSON объект ответа этого эксперта в его формате:
+{{
+  "{example_name}": {{"подарок_id": "g1", "обоснование": "...", ...}},
+  ...
+}}
+❗ Ответь за каждого эксперта: {agent_names}
+"""
 
-            AgentType.WELLNESS_COACH: base_structure + """
-Ты ВелнесТренер - специалист по подаркам для здоровья, красоты и благополучия.
-Выбери ОДИН подарок, максимально полезный для физического и ментального здоровья.
+    # Режим оценки всех подарков: добавляется после роли агента, общий префикс не меняется
+    AGENT_SCORES_SUFFIX = """
+Дополнительно оцени КАЖДЫЙ подарок из списка со своей точки зрения по шкале от 0 до 100
+и добавь в ответ поле "оценки" с id всех подарков, например: "оценки": {"g1": 85, "g2": 40, "g3": 70}
+"""
 
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение пользы для здоровья и самочувствия",
-  "польза_здоровью_процент": число_от_0_до_100
-}""",
+    PANEL_SCORES_SUFFIX = """
+Дополнительно каждый эксперт оценивает КАЖДЫЙ подарок из списка со своей точки зрения по шкале от 0 до 100:
+добавь в ответ каждого эксперта поле "оценки" с id всех подарков, например: "оценки": {"g1": 85, "g2": 40, "g3": 70}
+"""
 
-            AgentType.TRAVEL_EXPERT: base_structure + """
-Ты ЭкспертПутешествий - специалист по подаркам для любителей путешествий.
-Выбери ОДИН подарок, наиболее полезный в поездках и путешествиях.
+    # Заполняются один раз при импорте (см. _compile_prompts ниже)
+    AGENT_SUFFIXES: Dict[AgentType, str] = {}
+    PANEL_BLOCKS: Dict[AgentType, str] = {}
 
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение пользы в путешествиях и поездках",
-  "туристическая_ценность_процент": число_от_0_до_100
-}""",
+    @staticmethod
+    def get_shared_prefix(person_info: str, formatted_gifts: str) -> str:
+        """Общий для всех агентов запроса префикс промпта"""
+        return PromptTemplate.SHARED_PREFIX_TEMPLATE.format(gifts=formatted_gifts, person_info=person_info)
 
-            AgentType.FOODIE_GUIDE: base_structure + """
-Ты ГидГурмана - специалист по подаркам для любителей еды и кулинарии.
-Выбери ОДИН подарок, связанный с едой, кулинарией или гастрономией.
+    @staticmethod
+    def get_agent_prompt(agent_type: AgentType, person_info: str, formatted_gifts: str, score_all: bool = False) -> str:
+        """Получение промпта для конкретного агента: общий префикс + роль агента (+ оценка всех подарков)"""
+        prompt = PromptTemplate.get_shared_prefix(person_info, formatted_gifts) + PromptTemplate.AGENT_SUFFIXES[agent_type]
+        return prompt + PromptTemplate.AGENT_SCORES_SUFFIX if score_all else prompt
 
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение гастрономической ценности подарка",
-  "кулинарная_привлекательность_процент": число_от_0_до_100
-}""",
+    @staticmethod
+    def get_panel_prompt(agent_types: List[AgentType], person_info: str, formatted_gifts: str,
+                         score_all: bool = False) -> str:
+        """
+        Промпт панели: все выбранные агенты голосуют в одном запросе
+        Общий контекст (профиль и подарки) передается один раз, а не для каждого агента
+        """
+        agent_names = [agent_type.value for agent_type in agent_types]
+        panel = PromptTemplate.PANEL_TEMPLATE.format(
+            count=len(agent_types),
+            personas="".join(PromptTemplate.PANEL_BLOCKS[agent_type] for agent_type in agent_types),
+            example_name=agent_names[0] if agent_names else "agent",
+            agent_names=", ".join(agent_names)
+        )
+        if score_all:
+            panel += PromptTemplate.PANEL_SCORES_SUFFIX
+        return PromptTemplate.get_shared_prefix(person_info, formatted_gifts) + panel
 
-            AgentType.FAMILY_BONDS: base_structure + """
-Ты СемейныеУзы - специалист по подаркам, укрепляющим семейные отношения.
-Выбери ОДИН подарок, способствующий семейному единству и общению.
 
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение влияния на семейные отношения",
-  "семейная_ценность_процент": число_от_0_до_100
-}""",
+def _compile_prompts():
+    """Готовые части промптов агентов из реестра AGENT_SPECS: собираются один раз, а не на каждый вызов"""
+    for agent_type in AgentType:
+        persona = agent_spec(agent_type.value).persona
+        PromptTemplate.AGENT_SUFFIXES[agent_type] = persona
+        PromptTemplate.PANEL_BLOCKS[agent_type] = f"=== ЭКСПЕРТ {agent_type.value} ===" + persona + "\n\n"
 
-            AgentType.COLLEAGUE_CONNECTOR: base_structure + """
-Ты КоллегиальныйСвязующий - специалист по корпоративным подаркам для коллег.
-Выбери ОДИН подарок, подходящий для рабочих отношений.
 
-Ответь JSON объектом:
-{
-  "выбранный_подарок": "точное название подарка из списка",
-  "обоснование": "объяснение уместности в рабочей среде",
-  "корпоративная_уместность_процент": число_от_0_до_100
-}"""
-        }
-        
-        return agent_prompts.get(agent_type, base_structure + """
-Выбери лучший подарок и ответь JSON объектом:
-{
-  "выбранный_подарок": "название подарка",
-  "обоснование": "объяснение выбора", 
-  "оценка": число_от_0_до_100
-}""")
+_compile_prompts()
 
 print("✅ Расширенные промпты для всех агентов готовы")
 print(f"📝 Всего промптов: {len(AgentType)} агентов")
@@ -709,34 +934,131 @@ print(f"📝 Всего промптов: {len(AgentType)} агентов")
 Асинхронный клиент с connection pooling и retry логикой
 """
 
+class APIStatusError(Exception):
+    """Ответ API с неуспешным HTTP статусом"""
+    
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"API вернул статус {status}")
+        self.status = status
+        self.retry_after = retry_after
+    
+    @property
+    def is_overload(self) -> bool:
+        """Провайдер перегружен или ограничивает нас - стоит снизить нагрузку"""
+        return self.status == 429 or self.status >= 500
+
+class StructuredOutputUnsupported(APIStatusError):
+    """Провайдер не принял response_format (модель не поддерживает или схема отклонена) - запрос повторяется без схемы"""
+    
+    def __init__(self):
+        super().__init__(400)
+
 class APIClient:
     """Асинхронный HTTP клиент с защитой от перегрузок и автоповторами"""
     
     def __init__(self, config: Configuration):
         self.config = config
         self.session: Optional[aiohttp.ClientSession] = None
-        # Семафор ограничивает количество одновременных запросов
-        self._semaphore = asyncio.Semaphore(config.max_concurrent_requests)
+        # Пул провайдеров: у каждого свой лимитер одновременных запросов (AIMD),
+        # без адаптивности лимит фиксирован и лимитер работает как обычный семафор
+        def limiter_factory() -> AdaptiveConcurrencyLimiter:
+            if config.adaptive_concurrency:
+                return AdaptiveConcurrencyLimiter(
+                    initial_limit=config.max_concurrent_requests,
+                    min_limit=config.min_concurrent_requests,
+                    max_limit=config.max_concurrent_requests_limit
+                )
+            return AdaptiveConcurrencyLimiter(
+                initial_limit=config.max_concurrent_requests,
+                min_limit=config.max_concurrent_requests,
+                max_limit=config.max_concurrent_requests
+            )
+        
+        # Квоты RPM/TPM общие на процесс: все клиенты с одним провайдером расходуют одно ведро
+        def rate_limiter_factory(provider: Provider) -> RateLimiter:
+            return shared_rate_limiter(
+                provider.name, provider.base_url, provider.api_token,
+                rpm=provider.rpm if provider.rpm is not None else config.llm_rpm,
+                tpm=provider.tpm if provider.tpm is not None else config.llm_tpm
+            )
+        
+        self._pool = ProviderPool(
+            load_providers(config.llm_providers, config.base_url, config.api_token),
+            limiter_factory, rate_limiter_factory
+        )
+        # Приоритеты: слоты - сумма текущих лимитов провайдеров, фоновые классы получают только свою долю
+        self._scheduler = PriorityScheduler(
+            capacity=lambda: sum(int(state.limiter.limit) for state in self._pool.states),
+            shares={
+                PRIORITY_BACKGROUND: config.scheduler_background_share,
+                PRIORITY_WARMUP: config.scheduler_warmup_share
+            }
+        )
         self.logger = logging.getLogger("APIClient")
+        # Кэш ответов: повторные промпты не тратят токены
+        self._cache: Optional[LLMResponseCache] = None
+        if config.llm_cache_enabled:
+            self._cache = LLMResponseCache(
+                memory_size=config.llm_cache_memory_size,
+                db_path=config.llm_cache_path or None,
+                ttl=config.llm_cache_ttl,
+                disk_max_entries=config.llm_cache_disk_max_entries
+            )
+        # Генерация не кэшируется: пользователь, повторивший запрос, ждет других вариантов,
+        # а промпты агентов включают список подарков - новые подарки дают и новые оценки
+        self._cached_stages = {stage.strip() for stage in config.llm_cache_stages.split(",") if stage.strip()}
+        # Одинаковые одновременные запросы ждут один общий ответ
+        self._singleflight = SingleFlight()
+        # Хеджирование медленных запросов
+        self._latency_tracker = LatencyTracker()
+        self._hedge_budget = HedgeBudget(config.hedge_budget_ratio)
+        self._hedge_report = HedgeReport()
+        # Основные запросы из выборки отчета, дорабатывающие после победы хеджа, и журналы их вызовов
+        # (asyncio держит задачи по слабой ссылке - без этого словаря задачу может собрать GC)
+        self._shadow_tasks: Dict[asyncio.Task, Optional[CallLog]] = {}
+        # Разбор ответов и резервные результаты по моделям
+        self._parse_stats = ParseStats()
+        # Статистика переиспользования соединений
+        self._stats = {
+            "запросов": 0,
+            "новых_соединений": 0,
+            "переиспользовано_соединений": 0,
+            "dns_запросов": 0,
+            "стриминг_запросов": 0,
+            "досрочно_закрыто_стримов": 0,
+            "ttft_сумма": 0.0
+        }
     
-    async def __aenter__(self):
-        """Создание HTTP сессии при входе в async context manager"""
-        # Настройка connection pool для эффективного использования соединений
+    async def start(self):
+        """Создание HTTP сессии (один раз на время жизни клиента)"""
+        if self.session is not None and not self.session.closed:
+            return self
+        
+        # Настройка connection pool: keep-alive соединения переиспользуются между запросами
         connector = aiohttp.TCPConnector(
             ssl=True,           # Принудительное использование SSL
             limit=100,          # Общий лимит соединений
-            limit_per_host=10   # Лимит соединений на хост
+            limit_per_host=max(10, self.config.max_concurrent_requests),  # Лимит соединений на хост
+            keepalive_timeout=self.config.keepalive_timeout,
+            ttl_dns_cache=300   # Кэш DNS, чтобы не резолвить хост на каждый запрос
         )
         
         # Настройка таймаутов
         timeout = aiohttp.ClientTimeout(total=self.config.request_timeout)
         
-        # Создание сессии с заголовками
+        # Трассировка соединений для статистики
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        trace_config.on_dns_resolvehost_end.append(self._on_dns_resolve)
+        
+        # Создание сессии с общими заголовками (Authorization - свой у каждого провайдера)
         self.session = aiohttp.ClientSession(
             connector=connector,
             timeout=timeout,
+            trace_configs=[trace_config],
             headers={
-                "Authorization": f"Bearer {self.config.api_token}",
                 "HTTP-Referer": "https://github.com",
                 "X-Title": "Gift Recommendation Agent",
                 "Content-Type": "application/json"
@@ -745,76 +1067,655 @@ class APIClient:
         self.logger.info("🔗 HTTP сессия создана")
         return self
     
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        """Закрытие HTTP сессии при выходе из context manager"""
+    async def close(self):
+        """Закрытие HTTP сессии и пула соединений"""
         if self.session:
             await self.session.close()
-            self.logger.info("🔌 HTTP сессия закрыта")
+            self.session = None
+            self.logger.info(f"🔌 HTTP сессия закрыта, статистика: {self.get_stats()}")
+        if self._cache is not None:
+            self._cache.close()
+    
+    async def __aenter__(self):
+        """Создание HTTP сессии при входе в async context manager"""
+        return await self.start()
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Закрытие HTTP сессии при выходе из context manager"""
+        await self.close()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика соединений: сколько запросов обслужено без нового TCP/TLS рукопожатия"""
+        stats = dict(self._stats)
+        connections = stats["новых_соединений"] + stats["переиспользовано_соединений"]
+        stats["доля_переиспользования"] = (
+            round(stats["переиспользовано_соединений"] / connections, 3) if connections else 0.0
+        )
+        ttft_total = stats.pop("ttft_сумма")
+        stats["средний_ttft"] = (
+            round(ttft_total / stats["стриминг_запросов"], 3) if stats["стриминг_запросов"] else 0.0
+        )
+        stats["провайдеры"] = self._pool.stats()
+        stats["планировщик"] = self._scheduler.stats()
+        stats["разбор_ответов"] = self._parse_stats.stats()
+        if self._cache is not None:
+            stats["кэш"] = self._cache.stats()
+        if self.config.coalesce_requests:
+            stats["склейка"] = self._singleflight.stats()
+        if self.config.hedge_requests:
+            stats["хеджирование"] = self.hedge_report()
+        return stats
     
-    async def make_request(self, prompt: str) -> str:
+    def hedge_report(self) -> Dict[str, Dict[str, Any]]:
+        """Эффект хеджирования по этапам: p99 с хеджированием и без него"""
+        return self._hedge_report.summary()
+    
+    async def _on_request_start(self, session, trace_ctx, params):
+        self._stats["запросов"] += 1
+    
+    async def _on_connection_create(self, session, trace_ctx, params):
+        self._stats["новых_соединений"] += 1
+    
+    async def _on_connection_reuse(self, session, trace_ctx, params):
+        self._stats["переиспользовано_соединений"] += 1
+    
+    async def _on_dns_resolve(self, session, trace_ctx, params):
+        self._stats["dns_запросов"] += 1
+    
+    async def make_request(self, prompt: str, stage: str = "default",
+                           deadline: Optional[Deadline] = None, use_cache: bool = True,
+                           call_log: Optional[CallLog] = None, priority: str = PRIORITY_INTERACTIVE,
+                           user_id: Optional[str] = None) -> str:
         """
         Выполнение HTTP запроса с retry логикой и exponential backoff
         
         Args:
             prompt: Текст промпта для ИИ
+            stage: Этап pipeline (generation, selector, agent, panel) - модель, параметры и статистика задержек
+            deadline: Дедлайн запроса пользователя - таймауты и повторы укладываются в него
+            use_cache: False - не читать и не писать кэш ответов
+            call_log: Журнал вызовов запуска - сюда записывается модель, обслужившая вызов
+            priority: Класс приоритета (interactive, background, warmup)
+            user_id: Пользователь - внутри класса пользователи обслуживаются по очереди
             
         Returns:
             Ответ от ИИ модели
             
         Raises:
+            DeadlineExceeded: Если бюджет времени исчерпан
             Exception: Если все попытки запроса неудачны
         """
-        # Ограничиваем количество одновременных запросов
-        async with self._semaphore:
-            for attempt in range(self.config.max_retries):
-                try:
-                    self.logger.info(f"🔄 API запрос: {self.config.base_url} {prompt}")
-                    self.logger.info(f"🔄 API запрос, попытка {attempt + 1}/{self.config.max_retries}")
+        content, _ = await self._request(prompt, stage, deadline, use_cache, call_log, priority, user_id)
+        return content
+    
+    async def request_json(self, prompt: str, stage: str, expected: type = dict, **options) -> Any:
+        """
+        Запрос с разбором JSON ответа
+        
+        Ответ, полученный по JSON схеме этапа (response_format), разбирается напрямую,
+        остальные - поиском JSON в тексте с починкой (JSONParser).
+        Ошибки разбора учитываются по модели этапа
+        
+        Args:
+            prompt: Текст промпта для ИИ
+            stage: Этап pipeline
+            expected: dict или list - что ожидается без схемы
+            **options: Параметры make_request (deadline, call_log, priority, user_id)
+            
+        Raises:
+            ValueError: Если ответ не разобрался
+        """
+        content, meta = await self._request(prompt, stage, **options)
+        structured = meta.get("structured", False)
+        model = self.config.stage_settings(stage).model
+        # Ответы из кэша и склеенных вызовов уже учтены при исходном запросе
+        fresh = meta.get("source", SOURCE_API) == SOURCE_API
+        try:
+            if structured:
+                # Ответ по схеме - чистый JSON, эвристики не нужны
+                parsed = json.loads(content)
+            elif expected is list:
+                parsed = JSONParser.parse_json_array(content)
+            else:
+                parsed = JSONParser.parse_json_response(content)
+        except ValueError:
+            if fresh:
+                self._parse_stats.record_response(model, structured, parsed=False)
+            raise
+        if fresh:
+            self._parse_stats.record_response(model, structured, parsed=True)
+        return parsed
+    
+    def record_fallback(self, stage: str, count: int = 1):
+        """Вызывающий код подставил резервный результат вместо ответа модели этапа"""
+        self._parse_stats.record_fallback(self.config.stage_settings(stage).model, count)
+    
+    async def _request(self, prompt: str, stage: str = "default",
+                       deadline: Optional[Deadline] = None, use_cache: bool = True,
+                       call_log: Optional[CallLog] = None, priority: str = PRIORITY_INTERACTIVE,
+                       user_id: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
+        """make_request с метаданными ответа (провайдер, модель, usage, ответ по схеме)"""
+        deadline = deadline or Deadline.unlimited()
+        started = time.monotonic()
+        
+        # Отпечаток запроса - общий ключ для кэша и склейки одинаковых запросов (включает модель этапа)
+        payload = self._build_payload(prompt, stage)
+        request_key = LLMResponseCache.make_key(payload)
+        use_cache = use_cache and self._cache is not None and stage in self._cached_stages
+        
+        if use_cache:
+            cached = await self._cache.get(request_key)
+            if cached is not None:
+                self.logger.info(f"💾 Ответ этапа {stage} взят из кэша")
+                self._log_call(call_log, stage, payload["model"], started, SOURCE_CACHE)
+                return cached, {"source": SOURCE_CACHE}
+        
+        leader = False
+        
+        async def fetch() -> Tuple[str, Dict[str, Any]]:
+            nonlocal leader
+            leader = True
+            if self.config.hedge_requests:
+                content, meta = await self._hedged_request(prompt, stage, deadline, priority, user_id, call_log)
+            else:
+                content, meta = await self._request_with_retries(prompt, stage, deadline, priority, user_id, call_log)
+            
+            # Кэшируем только ответы с полным JSON, чтобы не закрепить в кэше битый ответ
+            if use_cache and JSONStreamExtractor(STAGE_JSON_TYPES.get(stage)).feed(content):
+                await self._cache.set(request_key, content)
+            return content, meta
+        
+        if self.config.coalesce_requests:
+            # Первый вызов выполняет запрос, одновременные с ним - ждут его результат, но не дольше
+            # своего дедлайна; интерактивный запрос не склеивается с фоновым, идущим с низким приоритетом
+            try:
+                content, meta = await asyncio.wait_for(
+                    self._singleflight.do(f"{priority}:{request_key}", fetch), timeout=deadline.cap(None)
+                )
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"Бюджет времени исчерпан в ожидании общего запроса этапа {stage}")
+            except DeadlineExceeded:
+                # Общий запрос уперся в дедлайн первого вызова - у этого вызова время еще есть
+                if leader or deadline.expired():
+                    raise
+                self.logger.info(f"🔗 Общий запрос этапа {stage} не успел, выполняем свой ({deadline})")
+                content, meta = await fetch()
+        else:
+            content, meta = await fetch()
+        
+        # Токены тратит только вызов, который сам выполнил запрос; склеенные с ним вызовы учитываются без usage
+        self._log_call(call_log, stage, meta.get("model") or payload["model"], started,
+                       SOURCE_API if leader else SOURCE_COALESCED, meta.get("provider", ""),
+                       meta.get("usage") if leader else None)
+        return content, {**meta, "source": SOURCE_API if leader else SOURCE_COALESCED}
+    
+    def _log_call(self, call_log: Optional[CallLog], stage: str, model: str, started: float, source: str,
+                  provider: str = "", usage: Optional[Dict[str, Any]] = None, **fields):
+        """Запись вызова в журнал запуска (если он передан)"""
+        if call_log is not None:
+            call = CallRecord(
+                stage=stage, model=model, latency=time.monotonic() - started, source=source, provider=provider,
+                **fields
+            )
+            call.apply_usage(usage)
+            call_log.record(call)
+    
+    def _log_attempt(self, call_log: Optional[CallLog], stage: str, started: float,
+                     meta: Dict[str, Any], outcome: str):
+        """Запись HTTP попытки, ответ которой не вернулся вызову: ошибка или проигравший дубликат хеджа"""
+        self._log_call(call_log, stage, meta.get("model") or self.config.stage_settings(stage).model, started,
+                       SOURCE_API, meta.get("provider", ""), meta.get("usage"), outcome=outcome)
+    
+    async def _hedged_request(self, prompt: str, stage: str, deadline: Deadline,
+                              priority: str, user_id: Optional[str],
+                              call_log: Optional[CallLog] = None) -> Tuple[str, Dict[str, Any]]:
+        """
+        Запрос с хеджированием: если основной запрос не ответил за перцентиль задержек
+        этапа и бюджет позволяет, отправляется дубликат; побеждает первый успешный ответ.
+        Проигравший запрос, успевший ответить, попадает в журнал с исходом lost
+        """
+        self._hedge_budget.on_request()
+        start_time = time.monotonic()
+        # Вызов из выборки для отчета: основной запрос дорабатывает до конца, даже если победил хедж
+        shadow = random.random() < self.config.hedge_shadow_ratio
+        
+        threshold = None
+        if self._latency_tracker.count(stage) >= self.config.hedge_min_samples:
+            threshold = self._latency_tracker.percentile(stage, self.config.hedge_percentile)
+        
+        primary = asyncio.create_task(
+            self._request_with_retries(prompt, stage, deadline, priority, user_id, call_log)
+        )
+        hedge = None
+        try:
+            if threshold is not None:
+                await asyncio.wait({primary}, timeout=threshold)
+            
+            if primary.done() or threshold is None or not self._hedge_budget.try_spend():
+                result = await primary
+                latency = time.monotonic() - start_time
+                self._hedge_report.record(stage, latency, hedged=False, hedge_won=False)
+                if shadow:
+                    self._hedge_report.record_counterfactual(stage, latency, latency)
+                return result
+            
+            self.logger.info(f"🪞 Хедж: запрос этапа {stage} дольше {threshold:.2f}с, отправляем дубликат")
+            hedge = asyncio.create_task(
+                self._request_with_retries(prompt, stage, deadline, priority, user_id, call_log)
+            )
+            
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        latency = time.monotonic() - start_time
+                        hedge_won = task is hedge
+                        self._hedge_report.record(stage, latency, hedged=True, hedge_won=hedge_won)
+                        loser = primary if hedge_won else hedge
+                        if loser.done() and not loser.cancelled() and loser.exception() is None:
+                            # Оба ответили в одном цикле событий - токены второго ответа тоже потрачены
+                            self._log_attempt(call_log, stage, start_time, loser.result()[1], OUTCOME_LOST)
+                        if hedge_won:
+                            self.logger.info(f"🏁 Хедж этапа {stage} ответил первым за {latency:.2f}с")
+                            if shadow and not primary.done():
+                                # Основной запрос не отменяется: его задержка - задержка вызова без хеджа
+                                primary.add_done_callback(
+                                    lambda done_primary: self._record_shadow(
+                                        done_primary, stage, latency, start_time, call_log
+                                    )
+                                )
+                                self._shadow_tasks[primary] = call_log
+                                primary = None
+                            elif shadow and primary.exception() is None:
+                                self._hedge_report.record_counterfactual(stage, latency, latency)
+                        elif shadow:
+                            self._hedge_report.record_counterfactual(stage, latency, latency)
+                        return task.result()
+            
+            # Оба запроса завершились ошибкой
+            raise primary.exception()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+    
+    def _record_shadow(self, primary: asyncio.Task, stage: str, effective_latency: float, start_time: float,
+                       call_log: Optional[CallLog] = None):
+        """Основной запрос из выборки доработал после победы хеджа - его задержка в отчет, токены в журнал"""
+        self._shadow_tasks.pop(primary, None)
+        # Ошибка и таймаут тоже идут в выборку: без хеджа вызов ждал бы столько же, и это самые медленные вызовы
+        self._hedge_report.record_counterfactual(stage, effective_latency, time.monotonic() - start_time)
+        # Токены неудачных попыток уже записал _request_with_retries
+        if not primary.cancelled() and primary.exception() is None:
+            self._log_attempt(call_log, stage, start_time, primary.result()[1], OUTCOME_LOST)
+    
+    def pending_shadows(self, call_log: CallLog) -> List[asyncio.Task]:
+        """Незавершенные основные запросы из выборки хеджа, которые еще допишут вызовы в журнал"""
+        return [task for task, task_log in self._shadow_tasks.items() if task_log is call_log]
+    
+    async def _request_with_retries(self, prompt: str, stage: str, deadline: Deadline,
+                                    priority: str = PRIORITY_INTERACTIVE, user_id: Optional[str] = None,
+                                    call_log: Optional[CallLog] = None) -> Tuple[str, Dict[str, Any]]:
+        """
+        Запрос с повторами и exponential backoff (без хеджирования), возвращает ответ и метаданные API
+        После ошибки следующая попытка уходит другому провайдеру пула, если такой есть - без паузы.
+        Каждая неудачная попытка пишется в журнал с исходом error, отмененная (проиграла хеджу) - lost;
+        удачную записывает _request
+        """
+        tried_providers = set()
+        for attempt in range(self.config.max_retries):
+            # Попытку, которая не успеет завершиться (медиана задержек этапа), не начинаем
+            expected_latency = self._latency_tracker.percentile(stage, 0.5) or 0.0
+            if deadline.expired() or (attempt > 0 and deadline.remaining() < expected_latency):
+                raise DeadlineExceeded(f"Нет времени на попытку {attempt + 1} этапа {stage} ({deadline})")
+            
+            retry_after = None
+            provider = self._pool.choose(tried_providers)
+            tried_providers.add(provider.provider.name)
+            
+            # Недоступны все провайдеры - ждем ближайшего, если пауза укладывается в дедлайн
+            wait = provider.wait_time(time.monotonic())
+            if wait > 0:
+                if wait >= deadline.remaining():
+                    raise DeadlineExceeded(
+                        f"Все провайдеры недоступны еще {wait:.1f}с, этап {stage} не успеет ({deadline})"
+                    )
+                self.logger.info(f"⏳ Все провайдеры недоступны, ждем {provider.provider.name} {wait:.1f}с")
+                await asyncio.sleep(wait)
+            
+            attempt_started = time.monotonic()
+            meta: Dict[str, Any] = {"provider": provider.provider.name}
+            try:
+                self.logger.info(f"🔄 API запрос: {provider.provider.base_url} {prompt}")
+                self.logger.info(
+                    f"🔄 API запрос к {provider.provider.name}, попытка {attempt + 1}/{self.config.max_retries}"
+                )
+                
+                # Ожидание слота лимитера тоже входит в бюджет запроса
+                content, latency = await asyncio.wait_for(
+                    self._attempt(prompt, stage, deadline, provider, meta, priority, user_id),
+                    timeout=deadline.cap(None)
+                )
+                
+                if content:
+                    await provider.limiter.on_success(latency)
+                    self._pool.on_success(provider)
+                    self._latency_tracker.record(stage, latency)
+                    self.logger.info(f"✅ Получен ответ длиной {len(content)} символов")
+                    self.logger.info(f"✅ Получен ответ {content}")
+                    return content, meta
+                # Пустой ответ оплачен так же, как обычный
+                self._log_attempt(call_log, stage, attempt_started, meta, OUTCOME_ERROR)
                     
-                    # Подготовка payload для OpenRouter API
-                    payload = {
-                        "model": self.config.model,
-                        "messages": [{"role": "user", "content": prompt}]
-                    }
+            except asyncio.CancelledError:
+                # Запрос отменен, пока попытка шла: обычно хедж ответил первым
+                self._log_attempt(call_log, stage, attempt_started, meta, OUTCOME_LOST)
+                raise
+            except asyncio.TimeoutError:
+                self._log_attempt(call_log, stage, attempt_started, meta, OUTCOME_ERROR)
+                if deadline.expired():
+                    raise DeadlineExceeded(f"Бюджет времени исчерпан на попытке {attempt + 1} этапа {stage}")
+                self.logger.warning(f"⏰ Таймаут на попытке {attempt + 1}")
+                print(traceback.format_exc())
+                await provider.limiter.on_overload()
+                self._pool.on_failure(provider)
+            except APIStatusError as e:
+                self._log_attempt(call_log, stage, attempt_started, meta, OUTCOME_ERROR)
+                self.logger.warning(f"⚠️ {str(e)} на попытке {attempt + 1} ({provider.provider.name})")
+                if e.is_overload or e.status == 408:
+                    retry_after = e.retry_after
+                    await provider.limiter.on_overload(retry_after)
+                    self._pool.on_failure(provider, retry_after)
+                else:
+                    # 400/401/404 и т.п. - ошибка нашего запроса или ключа, а не здоровья провайдера:
+                    # без паузы для провайдера; у другого провайдера свой ключ и модели, иначе повтор бесполезен
+                    self._pool.on_rejected(provider)
+                    if not self._pool.has_alternative(tried_providers):
+                        raise
+                    self.logger.info("🔀 Повтор на другом провайдере")
+                    continue
+            except aiohttp.ClientError as e:
+                self._log_attempt(call_log, stage, attempt_started, meta, OUTCOME_ERROR)
+                self.logger.error(f"❌ Ошибка соединения на попытке {attempt + 1}: {str(e)}")
+                print(traceback.format_exc())
+                self._pool.on_failure(provider)
+            except Exception as e:
+                self._log_attempt(call_log, stage, attempt_started, meta, OUTCOME_ERROR)
+                self.logger.error(f"❌ Ошибка API на попытке {attempt + 1}: {str(e)}")
+                print(traceback.format_exc())
+            
+            # Другой провайдер отвечает за свои лимиты - переключаемся на него без паузы
+            if attempt < self.config.max_retries - 1 and self._pool.has_alternative(tried_providers):
+                self.logger.info("🔀 Повтор на другом провайдере")
+                continue
+            
+            # Exponential backoff: задержка увеличивается с каждой попыткой, но не меньше Retry-After
+            if attempt < self.config.max_retries - 1:
+                delay = max(self.config.retry_delay * (2 ** attempt), retry_after or 0.0)
+                if delay >= deadline.remaining():
+                    raise DeadlineExceeded(f"Повтор этапа {stage} не успеет до дедлайна ({deadline})")
+                self.logger.info(f"⏳ Ожидание {delay}с перед следующей попыткой")
+                await asyncio.sleep(delay)
+        
+        # Если все попытки исчерпаны
+        error_msg = f"API запрос не удался после {self.config.max_retries} попыток"
+        self.logger.error(f"💥 {error_msg}")
+        raise Exception(error_msg)
+    
+    async def _attempt(self, prompt: str, stage: str, deadline: Deadline, provider: ProviderState,
+                       meta: Dict[str, Any], priority: str = PRIORITY_INTERACTIVE,
+                       user_id: Optional[str] = None) -> Tuple[Optional[str], float]:
+        """
+        Одна попытка: слот планировщика, квота и слот лимитера провайдера + HTTP запрос
+        с таймаутом в пределах дедлайна; meta заполняется данными ответа (модель, usage)
+        """
+        # Квота RPM/TPM: оценка промпта плюс максимальная длина ответа этапа, после ответа сверяется с usage
+        completion_budget = self.config.stage_settings(stage).max_tokens or DEFAULT_COMPLETION_TOKENS
+        estimated_tokens = estimate_tokens(prompt) + completion_budget
+        
+        # Интерактивные запросы обгоняют фоновые в очереди, фоновые не занимают больше своей доли
+        async with self._scheduler.slot(priority, user_id):
+            await provider.rate_limiter.acquire(estimated_tokens)
+            
+            content = None
+            try:
+                # Ограничиваем количество одновременных запросов (слот занят только на время HTTP запроса)
+                async with provider.limiter.slot():
+                    timeout = aiohttp.ClientTimeout(total=deadline.cap(self.config.request_timeout))
+                    request_start = time.monotonic()
+                    try:
+                        content = await self._send(prompt, provider, timeout, stage, meta)
+                    except StructuredOutputUnsupported:
+                        # Провайдер уже отмечен как не поддерживающий схемы - сразу повторяем без response_format
+                        content = await self._send(prompt, provider, timeout, stage, meta)
+                    latency = time.monotonic() - request_start
+            finally:
+                # Сверка и при ошибке, таймауте и отмене: иначе квота TPM "теряет" оценку каждой неудачной попытки
+                usage = meta.get("usage") or {}
+                if usage.get("total_tokens") is not None:
+                    provider.rate_limiter.reconcile(estimated_tokens, usage["total_tokens"])
+                else:
+                    # Без usage промпт считаем потраченным, а из запаса на ответ возвращаем то, что не пришло
+                    provider.rate_limiter.release(completion_budget - estimate_tokens(content or ""))
+        return content, latency
+    
+    async def _send(self, prompt: str, provider: ProviderState, timeout: aiohttp.ClientTimeout,
+                    stage: str, meta: Dict[str, Any]) -> Optional[str]:
+        """HTTP запрос попытки: потоковый или обычный, в зависимости от конфигурации"""
+        if self.config.stream_responses:
+            return "".join([chunk async for chunk in self._iter_stream(prompt, provider, timeout, stage, meta)])
+        return await self._post_completion(prompt, provider, timeout, stage, meta)
+    
+    async def stream_request(self, prompt: str, stage: str = "default") -> AsyncIterator[str]:
+        """
+        Стриминг ответа по частям (одна попытка, без повторов)
+        
+        Фрагменты отдаются по мере генерации, поток закрывается сразу
+        после получения полного JSON объекта или массива
+        
+        Args:
+            prompt: Текст промпта для ИИ
+            stage: Этап pipeline - определяет модель и параметры генерации
+            
+        Yields:
+            Фрагменты текста ответа
+        """
+        provider = self._pool.choose()
+        async with provider.limiter.slot():
+            async for chunk in self._iter_stream(prompt, provider, stage=stage):
+                yield chunk
+    
+    def _build_payload(self, prompt: str, stage: str = "default") -> Dict[str, Any]:
+        """Подготовка payload для OpenRouter API с моделью и параметрами этапа"""
+        settings = self.config.stage_settings(stage)
+        payload = {
+            "model": settings.model,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+        if settings.max_tokens is not None:
+            payload["max_tokens"] = settings.max_tokens
+        if settings.temperature is not None:
+            payload["temperature"] = settings.temperature
+        if settings.reasoning_effort == "none":
+            payload["reasoning"] = {"enabled": False}
+        elif settings.reasoning_effort:
+            payload["reasoning"] = {"effort": settings.reasoning_effort}
+        if self.config.structured_output and stage in STAGE_RESPONSE_FORMATS:
+            payload["response_format"] = STAGE_RESPONSE_FORMATS[stage]
+        return payload
+    
+    def _provider_payload(self, prompt: str, stage: str, provider: ProviderState) -> Dict[str, Any]:
+        """Payload этапа с именем модели, под которым ее знает провайдер"""
+        payload = self._build_payload(prompt, stage)
+        payload["model"] = provider.provider.map_model(payload["model"])
+        if "response_format" in payload and not provider.structured_output_allowed(payload["model"], stage):
+            payload.pop("response_format", None)
+        # OpenRouter сообщает стоимость запроса в usage только по запросу
+        if "openrouter.ai" in provider.provider.base_url:
+            payload["usage"] = {"include": True}
+        return payload
+    
+    async def _post_completion(self, prompt: str, provider: ProviderState,
+                               timeout: Optional[aiohttp.ClientTimeout] = None,
+                               stage: str = "default", meta: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Один обычный (не потоковый) запрос, None при некорректном ответе; meta заполняется данными ответа"""
+        payload = self._provider_payload(prompt, stage, provider)
+        async with self.session.post(
+            f"{provider.provider.base_url}/chat/completions",
+            json=payload,
+            headers=provider.provider.headers(),
+            timeout=timeout or self.session.timeout
+        ) as response:
+            self._pool.on_response(provider, response.headers)
+            
+            if response.status == 200:
+                data = await response.json()
+                if meta is not None:
+                    if data.get("model"):
+                        meta["model"] = data["model"]
+                    if data.get("usage"):
+                        meta["usage"] = data["usage"]
+                    meta["structured"] = "response_format" in payload
+                # Проверяем корректность структуры ответа
+                if (data.get("choices") and 
+                    len(data["choices"]) > 0 and 
+                    data["choices"][0].get("message", {}).get("content")):
                     
-                    # Выполнение HTTP POST запроса
-                    async with self.session.post(
-                        f"{self.config.base_url}/chat/completions",
-                        json=payload
-                    ) as response:
-                        
-                        if response.status == 200:
-                            data = await response.json()
-                            # Проверяем корректность структуры ответа
-                            if (data.get("choices") and 
-                                len(data["choices"]) > 0 and 
-                                data["choices"][0].get("message", {}).get("content")):
-                                
-                                content = data["choices"][0]["message"]["content"]
-                                self.logger.info(f"✅ Получен ответ длиной {len(content)} символов")
-                                self.logger.info(f"✅ Получен ответ {content}")
-                                
-                                return content
-                        
-                        self.logger.warning(f"⚠️ API вернул статус {response.status}")
-                        
-                except asyncio.TimeoutError:
-                    self.logger.warning(f"⏰ Таймаут на попытке {attempt + 1}")
-                    print(traceback.format_exc())
-                except Exception as e:
-                    self.logger.error(f"❌ Ошибка API на попытке {attempt + 1}: {str(e)}")
-                    print(traceback.format_exc())
+                    return data["choices"][0]["message"]["content"]
                 
-                # Exponential backoff: задержка увеличивается с каждой попыткой
-                if attempt < self.config.max_retries - 1:
-                    delay = self.config.retry_delay * (2 ** attempt)
-                    self.logger.info(f"⏳ Ожидание {delay}с перед следующей попыткой")
-                    await asyncio.sleep(delay)
+                self.logger.warning("⚠️ API вернул ответ без содержимого")
+                return None
             
-            # Если все попытки исчерпаны
-            error_msg = f"API запрос не удался после {self.config.max_retries} попыток"
-            self.logger.error(f"💥 {error_msg}")
-            raise Exception(error_msg)
+            await self._check_structured_output(response, provider, payload, stage)
+            raise APIStatusError(response.status, parse_retry_after(response.headers.get("Retry-After")))
+    
+    async def _check_structured_output(self, response: aiohttp.ClientResponse, provider: ProviderState,
+                                       payload: Dict[str, Any], stage: str):
+        """
+        Ответ 400 на запрос со схемой: модель не умеет response_format - больше ей схемы не шлем;
+        провайдер отклонил схему этапа - не шлем только эту схему этой модели (остальные этапы со схемами)
+        """
+        if response.status != 400 or "response_format" not in payload:
+            return
+        body = await response.text()
+        model = payload["model"]
+        if is_unsupported_error(response.status, body):
+            provider.structured_output_unsupported.add(model)
+            self.logger.warning(f"🧩 {provider.provider.name}: модель {model} не поддерживает response_format, "
+                                f"дальше без JSON схем")
+        elif is_invalid_schema_error(response.status, body):
+            provider.rejected_schemas.add((model, stage))
+            self.logger.error(f"🧩 {provider.provider.name}: схема этапа {stage} отклонена для модели {model}, "
+                              f"этап идет без схемы: {body[:300]}")
+        else:
+            return
+        raise StructuredOutputUnsupported()
+    
+    async def _iter_stream(self, prompt: str, provider: ProviderState,
+                           timeout: Optional[aiohttp.ClientTimeout] = None,
+                           stage: str = "default", meta: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """Один потоковый запрос (SSE) с досрочным закрытием после полного JSON"""
+        payload = self._provider_payload(prompt, stage, provider)
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
+        
+        start_time = time.monotonic()
+        first_token_time = None
+        tracker = JSONStreamExtractor(STAGE_JSON_TYPES.get(stage))
+        
+        async with self.session.post(
+            f"{provider.provider.base_url}/chat/completions",
+            json=payload,
+            headers=provider.provider.headers(),
+            timeout=timeout or self.session.timeout
+        ) as response:
+            self._pool.on_response(provider, response.headers)
+            
+            if response.status != 200:
+                await self._check_structured_output(response, provider, payload, stage)
+                raise APIStatusError(response.status, parse_retry_after(response.headers.get("Retry-After")))
+            
+            self._stats["стриминг_запросов"] += 1
+            if meta is not None:
+                meta["structured"] = "response_format" in payload
+            
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                # Пустые строки и SSE комментарии (": OPENROUTER PROCESSING") пропускаем
+                if not line.startswith("data:"):
+                    continue
+                
+                data_str = line[len("data:"):].strip()
+                if data_str == "[DONE]":
+                    break
+                
+                data = json.loads(data_str)
+                if data.get("error"):
+                    raise Exception(f"Ошибка в потоке: {data['error']}")
+                if meta is not None:
+                    if data.get("model"):
+                        meta["model"] = data["model"]
+                    # usage приходит в последнем событии потока (если поток не закрыт досрочно)
+                    if data.get("usage"):
+                        meta["usage"] = data["usage"]
+                
+                choices = data.get("choices") or []
+                if not choices:
+                    continue
+                chunk = (choices[0].get("delta") or {}).get("content")
+                if not chunk:
+                    continue
+                
+                if first_token_time is None:
+                    first_token_time = time.monotonic() - start_time
+                    self._stats["ttft_сумма"] += first_token_time
+                    self.logger.info(f"⚡ Первый токен через {first_token_time:.2f}с")
+                
+                if tracker.feed(chunk):
+                    # Обрезаем все, что пришло после закрывающей скобки, и закрываем поток
+                    yield chunk[:tracker.end_in_chunk]
+                    self._stats["досрочно_закрыто_стримов"] += 1
+                    self.logger.info(f"✂️ Полный JSON получен за {time.monotonic() - start_time:.2f}с, поток закрыт")
+                    return
+                
+                yield chunk
+
+# Общий для процесса клиент: создается при старте приложения и закрывается при остановке,
+# так что все пользователи делят один пул соединений и один лимит одновременных запросов
+_shared_api_client: Optional[APIClient] = None
+
+async def start_shared_api_client(config: Optional[Configuration] = None) -> APIClient:
+    """Создание общего API клиента (вызывать внутри работающего event loop)"""
+    global _shared_api_client
+    if _shared_api_client is None:
+        _shared_api_client = APIClient(config or Configuration.from_env())
+    await _shared_api_client.start()
+    return _shared_api_client
+
+async def close_shared_api_client():
+    """Закрытие общего API клиента"""
+    global _shared_api_client
+    if _shared_api_client is not None:
+        await _shared_api_client.close()
+        _shared_api_client = None
+
+def get_shared_api_client() -> Optional[APIClient]:
+    """Общий API клиент или None, если он не запущен"""
+    return _shared_api_client
+
+def request_options(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Параметры make_request из состояния запуска: дедлайн, журнал вызовов, приоритет и пользователь"""
+    return {
+        "deadline": state.get("deadline"),
+        "call_log": state.get("call_log"),
+        "priority": state.get("priority", PRIORITY_INTERACTIVE),
+        "user_id": state.get("user_id")
+    }
+
+def gift_index_for(state: Dict[str, Any]) -> GiftIndex:
+    """Индекс подарков запуска (строится генератором; для состояния без индекса - по gifts_data)"""
+    return state.get("gift_index") or GiftIndex(state.get("gifts_data", []))
 
 print("✅ API клиент готов к работе")
 
@@ -823,20 +1724,97 @@ print("✅ API клиент готов к работе")
 Добавлен селектор агентов и поддержка всех новых агентов
 """
 
+_recipient_classifier: Optional[RecipientClassifier] = None
+
+def get_recipient_classifier(config: Configuration) -> RecipientClassifier:
+    """Локальный классификатор получателя (создается один раз на процесс)"""
+    global _recipient_classifier
+    if _recipient_classifier is None:
+        _recipient_classifier = load_classifier(config.recipient_model_path or None)
+    return _recipient_classifier
+
 class AgentSelector:
     """Селектор агентов для определения подходящих агентов под конкретную задачу"""
     
+    # Получатель не указан явно - селектор определяет его по описанию
+    UNKNOWN_RECIPIENT = "не указан (определи по описанию)"
+    
     def __init__(self, api_client: APIClient):
         self.api_client = api_client
         self.logger = logging.getLogger("AgentSelector")
     
-    async def select_agents(self, person_info: str, recipient_type: str) -> List[str]:
+    async def select_agents_node(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Узел LangGraph для выбора агентов: в state попадают только подходящие типы агентов
+        Сначала работает локальный классификатор, LLM селектор вызывается только при низкой уверенности
+        """
+        config = self.api_client.config
+        recipient_type = state.get("recipient_type") or self.UNKNOWN_RECIPIENT
+        selector_llm_used = False
+        
+        prediction = None
+        if config.local_classifier_enabled:
+            prediction = get_recipient_classifier(config).classify(state["person_info"])
+            self.logger.info(
+                f"🧭 Локальный классификатор: {prediction.recipient_type} "
+                f"(уверенность {prediction.confidence:.2f})"
+            )
+        
+        if prediction is not None and prediction.confidence >= config.classifier_min_confidence:
+            recipient_type = state.get("recipient_type") or prediction.recipient_type
+            agent_names = prediction.agents
+        else:
+            agent_names = await self.select_agents(state["person_info"], recipient_type, **request_options(state))
+            selector_llm_used = True
+        selected = self._normalize_selection(agent_names, recipient_type, config.min_agents, config.max_agents)
+        
+        self.logger.info(f"🎯 LangGraph: Будут работать {len(selected)} агентов: {', '.join(a.value for a in selected)}")
+        return {
+            **state,
+            "recipient_type": recipient_type,
+            "selected_agents": selected,
+            "selector_llm_used": selector_llm_used,
+            "current_step": "agents_selected"
+        }
+    
+    def _normalize_selection(self, agent_names: List[str], recipient_type: str,
+                             min_agents: int, max_agents: int) -> List[AgentType]:
+        """Проверка имен агентов и приведение их числа к диапазону min..max"""
+        known_agents = {agent.value: agent for agent in AgentType if agent != AgentType.AGENT_SELECTOR}
+        
+        selected = []
+        for name in agent_names:
+            agent = known_agents.get(str(name).strip().lower())
+            if agent is not None and agent not in selected:
+                selected.append(agent)
+            elif agent is None:
+                self.logger.warning(f"⚠️ Селектор вернул неизвестного агента: {name}")
+        
+        # Добираем до минимума резервным набором для типа получателя, затем универсальными агентами
+        if len(selected) < min_agents:
+            backup_names = self._get_fallback_agents(recipient_type) + self._get_fallback_agents("")
+            for name in backup_names:
+                agent = known_agents.get(name)
+                if agent is not None and agent not in selected and len(selected) < min_agents:
+                    selected.append(agent)
+        
+        return selected[:max_agents]
+    
+    async def select_agents(self, person_info: str, recipient_type: str,
+                            deadline: Optional[Deadline] = None,
+                            call_log: Optional[CallLog] = None,
+                            priority: str = PRIORITY_INTERACTIVE,
+                            user_id: Optional[str] = None) -> List[str]:
         """
         Выбор подходящих агентов на основе информации о человеке и типе получателя
         
         Args:
             person_info: Информация о человеке
             recipient_type: Тип получателя подарка
+            deadline: Дедлайн запроса пользователя
+            call_log: Журнал вызовов запуска
+            priority: Класс приоритета запроса
+            user_id: Пользователь, для которого выбираются агенты
             
         Returns:
             Список имен выбранных агентов
@@ -847,21 +1825,14 @@ class AgentSelector:
             # Получаем промпт для селектора
             prompt = PromptTemplate.get_agent_selector_prompt(person_info, recipient_type)
             
-            # Запрос к API
-            response = await self.api_client.make_request(prompt)
-            
-            # Парсинг ответа
-            cleaned_response = response.strip()
-            if not cleaned_response.startswith('{'):
-                start_idx = cleaned_response.find('{')
-                end_idx = cleaned_response.rfind('}')
-                if start_idx != -1 and end_idx != -1:
-                    cleaned_response = cleaned_response[start_idx:end_idx + 1]
-            
-            parsed_response = JSONParser.parse_json_response(cleaned_response)
+            # Запрос к API с разбором ответа (по JSON схеме, если провайдер ее поддерживает)
+            parsed_response = await self.api_client.request_json(
+                prompt, stage="selector", deadline=deadline, call_log=call_log, priority=priority, user_id=user_id
+            )
+            selection = AgentSelectionModel(**parsed_response)
             
-            selected_agents = parsed_response.get("selected_agents", [])
-            reasoning = parsed_response.get("reasoning", "")
+            selected_agents = selection.selected_agents
+            reasoning = selection.reasoning
             
             self.logger.info(f"✅ Выбрано {len(selected_agents)} агентов: {', '.join(selected_agents)}")
             self.logger.info(f"📝 Обоснование: {reasoning}")
@@ -871,26 +1842,14 @@ class AgentSelector:
         except Exception as e:
             self.logger.error(f"❌ Ошибка селектора агентов: {str(e)}")
             # Fallback: возвращаем базовый набор агентов
+            self.api_client.record_fallback("selector")
             return self._get_fallback_agents(recipient_type)
     
     def _get_fallback_agents(self, recipient_type: str) -> List[str]:
         """Резервный выбор агентов на основе типа получателя"""
         
-        # Предустановленные наборы агентов для разных типов получателей
-        fallback_mappings = {
-            "коллега": ["colleague_connector", "prof_rost", "praktik_bot", "budget_saver"],
-            "ребенок": ["kids_expert", "creative_soul", "surprise_master", "tech_guru"],
-            "девушка": ["romantic_advisor", "wellness_coach", "luxury_curator", "creative_soul"],
-            "парень": ["tech_guru", "hobby_hunter", "praktik_bot", "surprise_master"],
-            "пожилой человек": ["elderly_care", "wellness_coach", "family_bonds", "praktik_bot"], 
-            "родственник": ["family_bonds", "universal_guru", "wellness_coach", "hobby_hunter"],
-            "друг": ["surprise_master", "hobby_hunter", "universal_guru", "wow_factor"],
-            "начальник": ["luxury_curator", "prof_rost", "colleague_connector", "universal_guru"],
-            "супруг/супруга": ["romantic_advisor", "luxury_curator", "family_bonds", "wellness_coach"]
-        }
-        
-        selected = fallback_mappings.get(recipient_type, 
-                                       ["universal_guru", "praktik_bot", "surprise_master", "fin_expert"])
+        # Предустановленные наборы агентов для разных типов получателей - общие с локальным классификатором
+        selected = RECIPIENT_AGENTS.get(recipient_type, DEFAULT_AGENTS)
         
         self.logger.warning(f"⚠️ Используем резервный набор агентов для '{recipient_type}': {selected}")
         return selected
@@ -900,15 +1859,17 @@ class LangGraphAgent:
     
     def __init__(self, agent_type: AgentType, api_client: APIClient):
         self.agent_type = agent_type
+        self.spec = agent_spec(agent_type.value)
         self.api_client = api_client
         self.logger = logging.getLogger(f"LangGraphAgent.{agent_type.value}")
     
-    def format_gifts_for_prompt(self, gifts_data: List[Dict[str, Any]]) -> str:
+    @staticmethod
+    def format_gifts_for_prompt(gifts_data: List[Dict[str, Any]]) -> str:
         """Форматирование подарков для промпта"""
         formatted_text = ""
         for i, gift in enumerate(gifts_data, 1):
             formatted_text += (
-                f"{i}. {gift['подарок']} - {gift['описание']} - "
+                f"{gift.get('id') or gift_id(i)}. {gift['подарок']} - {gift['описание']} - "
                 f"Стоимость: {gift['стоимость']}₽ - Релевантность: {gift['релевантность']}/10\n"
             )
         return formatted_text
@@ -923,28 +1884,21 @@ class LangGraphAgent:
             
             # Подготовка промпта
             formatted_gifts = self.format_gifts_for_prompt(gifts_data)
-            base_prompt = PromptTemplate.get_agent_prompt(self.agent_type, person_info)
-            prompt = base_prompt.replace("{gifts}", formatted_gifts)
-            
-            # Запрос к API
-            response = await self.api_client.make_request(prompt)
-            
-            # Парсинг ответа
-            cleaned_response = response.strip()
-            if not cleaned_response.startswith('{'):
-                start_idx = cleaned_response.find('{')
-                end_idx = cleaned_response.rfind('}')
-                if start_idx != -1 and end_idx != -1:
-                    cleaned_response = cleaned_response[start_idx:end_idx + 1]
+            prompt = PromptTemplate.get_agent_prompt(
+                self.agent_type, person_info, formatted_gifts, score_all=self.api_client.config.agent_score_all_gifts
+            )
             
-            parsed_response = JSONParser.parse_json_response(cleaned_response)
-            validated_response = AgentResponseModel(**parsed_response)
+            # Запрос к API с разбором ответа (по JSON схеме, если провайдер ее поддерживает)
+            parsed_response = await self.api_client.request_json(
+                prompt, stage="agent", **request_options(state)
+            )
+            validated_response = self.spec.validate(parsed_response, gift_index_for(state))
             
-            self.logger.info(f"✅ LangGraph: {self.agent_type.value} выбрал {validated_response.выбранный_подарок}")
+            self.logger.info(f"✅ LangGraph: {self.agent_type.value} выбрал {validated_response['выбранный_подарок']}")
             
             # Обновляем состояние
             agent_responses = state.get("agent_responses", {})
-            agent_responses[self.agent_type.value] = validated_response.model_dump()
+            agent_responses[self.agent_type.value] = validated_response
             
             return {
                 **state,
@@ -956,10 +1910,11 @@ class LangGraphAgent:
             self.logger.error(f"❌ LangGraph: Ошибка агента {self.agent_type.value}: {str(e)}")
             
             # Fallback ответ
-            fallback_response = self._get_fallback_response(state["gifts_data"])
+            self.api_client.record_fallback("agent")
+            fallback_response = self._get_fallback_response(state)
             
             agent_responses = state.get("agent_responses", {})
-            agent_responses[self.agent_type.value] = fallback_response.model_dump()
+            agent_responses[self.agent_type.value] = fallback_response
             
             error_messages = state.get("error_messages", [])
             error_messages.append(f"Ошибка агента {self.agent_type.value}: {str(e)}")
@@ -971,47 +1926,73 @@ class LangGraphAgent:
                 "current_step": f"agent_{self.agent_type.value}_fallback"
             }
     
-    def _get_fallback_response(self, gifts_data: List[Dict[str, Any]]) -> AgentResponseModel:
-        """Создание fallback ответа для любого агента"""
-        if not gifts_data:
+    def _get_fallback_response(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Создание fallback ответа для любого агента (оценка по умолчанию - из реестра агентов)"""
+        gift_index = gift_index_for(state)
+        if not gift_index:
             raise ValueError("Нет подарков для fallback ответа")
         
-        fallback_gift = gifts_data[0]
+        return self.spec.fallback_response(gift_index)
+
+class LangGraphAgentPanel:
+    """
+    Панель агентов: все выбранные агенты голосуют одним запросом к LLM
+    Ответ - JSON объект с ответами агентов, каждый проверяется так же, как в режиме по одному агенту
+    """
+    
+    def __init__(self, agent_types: List[AgentType], api_client: APIClient):
+        self.agents = [LangGraphAgent(agent_type, api_client) for agent_type in agent_types]
+        self.api_client = api_client
+        self.logger = logging.getLogger("LangGraphAgentPanel")
+    
+    async def analyze_gifts_node(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Узел LangGraph: голосование всей панели за один вызов"""
+        agent_types = [agent.agent_type for agent in self.agents]
+        agent_responses = {}
+        error_messages = list(state.get("error_messages", []))
+        fallback_agents = []
         
-        # Универсальный fallback ответ
-        fallback_data = {
-            "выбранный_подарок": fallback_gift["подарок"],
-            "обоснование": f"Подарок выбран агентом {self.agent_type.value} (резервный режим)"
-        }
+        panel_answers = {}
+        gift_index = gift_index_for(state)
+        try:
+            self.logger.info(f"🔍 LangGraph: Панель из {len(agent_types)} агентов")
+            
+            formatted_gifts = LangGraphAgent.format_gifts_for_prompt(state["gifts_data"])
+            prompt = PromptTemplate.get_panel_prompt(
+                agent_types, state["person_info"], formatted_gifts, score_all=self.api_client.config.agent_score_all_gifts
+            )
+            
+            panel_answers = await self.api_client.request_json(
+                prompt, stage="panel", **request_options(state)
+            )
+        except Exception as e:
+            self.logger.error(f"❌ LangGraph: Ошибка панели агентов: {str(e)}")
+            error_messages.append(f"Ошибка панели агентов: {str(e)}")
         
-        # Добавляем специфичное поле в зависимости от типа агента
-        agent_specific_fields = {
-            AgentType.PRAKTIK_BOT: {"коэффициент_практической_ценности": 75},
-            AgentType.FIN_EXPERT: {"roi_индекс": 2.5},
-            AgentType.WOW_FACTOR: {"степень_восторга_процент": 75},
-            AgentType.UNIVERSAL_GURU: {"процент_сценариев_использования": 70},
-            AgentType.SURPRISE_MASTER: {"шанс_запомниться_процент": 75},
-            AgentType.PROF_ROST: {"прогноз_роста_ценности_процент": 70},
-            AgentType.ROMANTIC_ADVISOR: {"уровень_романтики_процент": 80},
-            AgentType.KIDS_EXPERT: {"детская_радость_процент": 85},
-            AgentType.ELDERLY_CARE: {"возрастная_уместность_процент": 80},
-            AgentType.HOBBY_HUNTER: {"соответствие_хобби_процент": 75},
-            AgentType.LUXURY_CURATOR: {"уровень_роскоши_процент": 90},
-            AgentType.BUDGET_SAVER: {"экономичность_процент": 85},
-            AgentType.TECH_GURU: {"уровень_технологий_процент": 80},
-            AgentType.CREATIVE_SOUL: {"творческий_потенциал_процент": 75},
-            AgentType.WELLNESS_COACH: {"польза_здоровью_процент": 80},
-            AgentType.TRAVEL_EXPERT: {"туристическая_ценность_процент": 75},
-            AgentType.FOODIE_GUIDE: {"кулинарная_привлекательность_процент": 80},
-            AgentType.FAMILY_BONDS: {"семейная_ценность_процент": 85},
-            AgentType.COLLEAGUE_CONNECTOR: {"корпоративная_уместность_процент": 70}
-        }
+        # Ответ каждого агента проверяется отдельно: ошибка одного не портит голоса остальных
+        for agent in self.agents:
+            name = agent.agent_type.value
+            try:
+                validated_response = agent.spec.validate(panel_answers[name], gift_index)
+                agent_responses[name] = validated_response
+                self.logger.info(f"✅ LangGraph: {name} выбрал {validated_response['выбранный_подарок']}")
+            except Exception as e:
+                if panel_answers:
+                    self.logger.warning(f"⚠️ LangGraph: Панель не дала корректного ответа за {name}: {str(e)}")
+                    error_messages.append(f"Ошибка агента {name} в панели: {str(e)}")
+                agent_responses[name] = agent._get_fallback_response(state)
+                fallback_agents.append(name)
         
-        # Добавляем специфичное поле для агента
-        specific_field = agent_specific_fields.get(self.agent_type, {"оценка": 75})
-        fallback_data.update(specific_field)
+        if fallback_agents:
+            self.api_client.record_fallback("panel", len(fallback_agents))
         
-        return AgentResponseModel(**fallback_data)
+        return {
+            **state,
+            "agent_responses": agent_responses,
+            "fallback_agents": fallback_agents,
+            "error_messages": error_messages,
+            "current_step": "agent_panel_fallback" if len(fallback_agents) == len(self.agents) else "agent_panel_completed"
+        }
 
 print("✅ Исправленный селектор агентов и LangGraph агенты готовы")
 print(f"🎯 Поддерживается {len(AgentType) - 1} специализированных агентов + селектор")
@@ -1021,6 +2002,16 @@ print(f"🎯 Поддерживается {len(AgentType) - 1} специали
 Устранено предупреждение Pydantic
 """
 
+# Отдельный ограниченный пул потоков для синхронного GigaChat клиента: анализ фото, переживший
+# дедлайн запроса, не занимает потоки default executor (asyncio.to_thread остального кода)
+_photo_executor: Optional[ThreadPoolExecutor] = None
+
+def _get_photo_executor(workers: int) -> ThreadPoolExecutor:
+    global _photo_executor
+    if _photo_executor is None:
+        _photo_executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="gigachat")
+    return _photo_executor
+
 class LangGraphGiftGenerator:
     """Генератор подарков для LangGraph workflow"""
     
@@ -1028,35 +2019,62 @@ class LangGraphGiftGenerator:
         self.api_client = api_client
         self.logger = logging.getLogger("LangGraphGiftGenerator")
     
+    async def analyze_photos_node(self, state: GraphState) -> GraphState:
+        """Узел LangGraph для дополнения профиля описаниями фотографий"""
+        person_info = state["person_info"]
+        deadline = state.get("deadline") or Deadline.unlimited()
+        
+        config = self.api_client.config
+        executor = _get_photo_executor(config.photo_workers)
+        loop = asyncio.get_running_loop()
+        
+        for file in state.get("photos", []):
+            try:
+                # GigaChat клиент синхронный - выносим в свой пул потоков, чтобы не блокировать event loop;
+                # поток после wait_for не останавливается, поэтому у самого клиента тоже есть таймаут
+                photo_description = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        executor, gigafile.analyze_picture, file, deadline.cap(config.photo_timeout)
+                    ),
+                    timeout=deadline.cap(None)
+                )
+            except asyncio.TimeoutError:
+                self.logger.warning("⏰ Анализ фото не уложился в бюджет, продолжаем без него")
+                break
+            
+            if not photo_description:
+                self.logger.warning("⚠️ Не удалось получить описание по картинке")
+                continue
+            person_info += "\n" + photo_description
+            self.logger.info(f"✅ Добавлено описание по картинке: {photo_description}")
+        
+        self.logger.info(f"✅ Описание обновлено: {person_info}")
+        return {
+            **state,
+            "person_info": person_info,
+            "current_step": "photos_analyzed"
+        }
+    
     async def generate_gifts_node(self, state: GraphState) -> GraphState:
         """Узел LangGraph для генерации подарков"""
         try:
             self.logger.info("🎁 LangGraph: Генерация списка подарков")
             
             person_info = state["person_info"]
-            photos = state["photos"]
             
             # Валидация входных данных
             validated_person_info = PersonInfoModel(info=person_info)
             
-            for file in photos:
-                photo_description = gigafile.analyze_picture(file)
-                person_info += "\n" + photo_description
-                self.logger.info(f"✅ Добавлено описание по картинке: {photo_description}")
-            
-            self.logger.info(f"✅ Описание обновлено: {person_info}")
-            state["person_info"] = person_info
-            
             # Подготовка промпта
             prompt = PromptTemplate.GIFT_GENERATION_PROMPT.format(
                 person_info=person_info
             )
             
-            # Запрос к API
-            response = await self.api_client.make_request(prompt)
-            
-            # Парсинг JSON массива
-            gifts_data = JSONParser.parse_json_array(response)
+            # Запрос к API: по JSON схеме приходит объект {"gifts": [...]}, без схемы - JSON массив
+            parsed_response = await self.api_client.request_json(
+                prompt, stage="generation", expected=list, **request_options(state)
+            )
+            gifts_data = parsed_response.get("gifts", []) if isinstance(parsed_response, dict) else parsed_response
             
             # Валидация подарков (ИСПРАВЛЕНО: используем model_dump вместо dict)
             validated_gifts = []
@@ -1069,14 +2087,18 @@ class LangGraphGiftGenerator:
             
             if not validated_gifts:
                 self.logger.warning("🔄 Используем резервный список подарков")
+                self.api_client.record_fallback("generation")
                 validated_gifts = self._get_fallback_gifts()
             
+            # Короткие id: агенты ссылаются на подарок по id, а не по полному названию
+            validated_gifts = assign_gift_ids(validated_gifts)
             self.logger.info(f"✅ LangGraph: Сгенерировано {len(validated_gifts)} подарков")
             
             # Обновляем состояние LangGraph
             return {
                 **state,
                 "gifts_data": validated_gifts,
+                "gift_index": GiftIndex(validated_gifts),
                 "current_step": "gifts_generated"
             }
             
@@ -1084,11 +2106,13 @@ class LangGraphGiftGenerator:
             self.logger.error(f"❌ LangGraph: Ошибка генерации подарков: {str(e)}")
             
             # В случае ошибки используем fallback
-            fallback_gifts = self._get_fallback_gifts()
+            self.api_client.record_fallback("generation")
+            fallback_gifts = assign_gift_ids(self._get_fallback_gifts())
             
             return {
                 **state,
                 "gifts_data": fallback_gifts,
+                "gift_index": GiftIndex(fallback_gifts),
                 "current_step": "gifts_generated_fallback",
                 "error_messages": state.get("error_messages", []) + [f"Ошибка генерации: {str(e)}"]
             }
@@ -1141,76 +2165,22 @@ class LangGraphGiftSelectionService:
             
             agent_responses = state.get("agent_responses", {})
             gifts_data = state["gifts_data"]
+            gift_index = gift_index_for(state)
             
-            # Подсчет голосов
-            gift_scores = {}
             participating_agents = list(agent_responses.keys())  # Список участвовавших агентов
             
-            for agent_name, response in agent_responses.items():
-                gift_name = response.get("выбранный_подарок")
-                if not gift_name:
-                    continue
-                
-                # Извлечение оценки (ИСПРАВЛЕНО: поддержка всех агентов)
-                score = self._extract_score_from_response(agent_name, response)
-                
-                if gift_name not in gift_scores:
-                    gift_scores[gift_name] = []
-                gift_scores[gift_name].append((agent_name, score))
-                
-                self.logger.info(f"🗳️ LangGraph: {agent_name} выбрал '{gift_name}' с оценкой {score}")
-            
-            # Расчет средних оценок
-            average_scores = {}
-            for gift, scores in gift_scores.items():
-                total_score = sum(score for _, score in scores)
-                avg_score = total_score / len(scores) if scores else 0
-                
-                average_scores[gift] = {
-                    "средний_балл": avg_score,
-                    "голоса_агентов": [agent for agent, _ in scores],
-                    "количество_голосов": len(scores),
-                    "детали_голосов": scores
-                }
-            
-            # Сортировка
-            sorted_gifts = sorted(
-                average_scores.items(),
-                key=lambda x: (x[1]["количество_голосов"], x[1]["средний_балл"]),
-                reverse=True
+            # Матрица агенты × подарки: голоса и (в режиме оценки всех подарков) оценки каждого подарка
+            score_matrix = self.build_score_matrix(agent_responses, gift_index)
+            final_selection = self.selection_entries(
+                score_matrix, gift_index, self.config.score_aggregation, self.config.final_top_k
             )
             
-            # Формирование финального списка
-            final_selection = []
-            for i, (gift_name, metrics) in enumerate(sorted_gifts[:2]):
-                gift_details = next(
-                    (gift for gift in gifts_data if gift["подарок"] == gift_name),
-                    None
-                )
-                
-                if gift_details:
-                    final_selection.append({
-                        "место": i + 1,
-                        "подарок": gift_name,
-                        "описание": gift_details["описание"],
-                        "стоимость": gift_details["стоимость"],
-                        "релевантность": gift_details["релевантность"],
-                        "query" : gift_details["query"],
-                        "средний_балл": round(metrics["средний_балл"], 2),
-                        "количество_голосов": metrics["количество_голосов"],
-                        "выбран_агентами": metrics["голоса_агентов"],
-                        "детали_оценок": metrics["детали_голосов"]
-                    })
-            
-            # Дополнение до 2 подарков
-            if len(final_selection) < 2:
-                self._add_backup_gifts(final_selection, gifts_data)
-            
             self.logger.info(f"🏆 LangGraph: Финальный выбор завершен, подарков: {len(final_selection)}")
             
             return {
                 **state,
                 "final_selection": final_selection,
+                "score_matrix": score_matrix,
                 "participating_agents": participating_agents,  # Добавляем список агентов
                 "current_step": "final_selection_completed"
             }
@@ -1229,74 +2199,111 @@ class LangGraphGiftSelectionService:
                 "error_messages": state.get("error_messages", []) + [f"Ошибка финального выбора: {str(e)}"]
             }
     
+    def quorum_reached(self, votes: Dict[str, Dict[str, Any]], total_agents: int) -> bool:
+        """
+        Можно ли завершить голосование досрочно
+        
+        Args:
+            votes: Полученные (не резервные) ответы агентов
+            total_agents: Сколько агентов запущено
+            
+        Returns:
+            True, если набран кворум и, при заданном пороге, есть консенсус
+        """
+        quorum = self.config.agent_quorum_votes
+        if quorum <= 0 or quorum >= total_agents or len(votes) < quorum:
+            return False
+        
+        threshold = self.config.agent_consensus_threshold
+        if threshold <= 0:
+            return True
+        
+        vote_counts = {}
+        for response in votes.values():
+            gift_key = response.get("подарок_id")
+            vote_counts[gift_key] = vote_counts.get(gift_key, 0) + 1
+        leader_share = max(vote_counts.values()) / len(votes)
+        return leader_share >= threshold
+    
     def _extract_score_from_response(self, agent_name: str, response: Dict[str, Any]) -> float:
-        """Извлечение оценки из ответа агента (ИСПРАВЛЕНО: поддержка всех агентов)"""
+        """Извлечение оценки из ответа агента, приведенной к шкале 0..100"""
         try:
-            # Расширенная карта оценок для всех агентов
-            score_mappings = {
-                "praktik_bot": response.get("коэффициент_практической_ценности"),
-                "fin_expert": response.get("roi_индекс"),
-                "wow_factor": response.get("степень_восторга_процент"),
-                "universal_guru": response.get("процент_сценариев_использования"),
-                "surprise_master": response.get("шанс_запомниться_процент"),
-                "prof_rost": response.get("прогноз_роста_ценности_процент"),
-                # Новые агенты
-                "romantic_advisor": response.get("уровень_романтики_процент"),
-                "kids_expert": response.get("детская_радость_процент"),
-                "elderly_care": response.get("возрастная_уместность_процент"),
-                "hobby_hunter": response.get("соответствие_хобби_процент"),
-                "luxury_curator": response.get("уровень_роскоши_процент"),
-                "budget_saver": response.get("экономичность_процент"),
-                "tech_guru": response.get("уровень_технологий_процент"),
-                "creative_soul": response.get("творческий_потенциал_процент"),
-                "wellness_coach": response.get("польза_здоровью_процент"),
-                "travel_expert": response.get("туристическая_ценность_процент"),
-                "foodie_guide": response.get("кулинарная_привлекательность_процент"),
-                "family_bonds": response.get("семейная_ценность_процент"),
-                "colleague_connector": response.get("корпоративная_уместность_процент"),
-                "agent_selector": response.get("оценка", 50)  # Селектор агентов использует общую оценку
-            }
-            
-            raw_score = score_mappings.get(agent_name)
-            
-            # Обработка None значений
-            if raw_score is None:
-                self.logger.warning(f"⚠️ Отсутствует оценка для {agent_name}, используем 75")
-                return 75.0
+            return agent_spec(agent_name).score(response)
+        except (TypeError, ValueError) as e:
+            self.logger.warning(f"⚠️ Ошибка извлечения оценки для {agent_name}: {e}, используем {DEFAULT_VOTE_SCORE}")
+            return DEFAULT_VOTE_SCORE
+    
+    def build_score_matrix(self, agent_responses: Dict[str, Dict[str, Any]], gift_index: GiftIndex) -> ScoreMatrix:
+        """Матрица оценок агенты × подарки по ответам агентов"""
+        score_matrix = ScoreMatrix(list(agent_responses), list(gift_index.by_id))
+        
+        for agent_name, response in agent_responses.items():
+            if response.get("оценки"):
+                score_matrix.add_scores(agent_name, response["оценки"])
             
-            # Нормализация для fin_expert
-            if agent_name == "fin_expert":
-                return min(float(raw_score) * 20, 100.0)
+            gift_key = gift_index.resolve(response.get("подарок_id") or response.get("выбранный_подарок"))
+            if gift_key is None:
+                self.logger.warning(f"⚠️ LangGraph: Голос {agent_name} не сопоставлен с подарком: {response}")
+                continue
             
-            return float(raw_score)
+            # Оценка по полю и шкале агента из реестра
+            score = self._extract_score_from_response(agent_name, response)
+            score_matrix.add_vote(agent_name, gift_key, score)
             
-        except (TypeError, ValueError) as e:
-            self.logger.warning(f"⚠️ Ошибка извлечения оценки для {agent_name}: {e}, используем 75")
-            return 75.0
-    
-    def _add_backup_gifts(self, final_selection: List[Dict], gifts_data: List[Dict]):
-        """Добавление резервных подарков"""
-        selected_gifts = {item["подарок"] for item in final_selection}
-        
-        for gift in gifts_data:
-            if gift["подарок"] not in selected_gifts and len(final_selection) < 2:
-                final_selection.append({
-                    "место": len(final_selection) + 1,
-                    "подарок": gift["подарок"],
-                    "описание": gift["описание"],
-                    "стоимость": gift["стоимость"],
-                    "релевантность": gift["релевантность"],
+            self.logger.info(f"🗳️ LangGraph: {agent_name} выбрал {gift_key} с оценкой {score}")
+        
+        return score_matrix
+    
+    @staticmethod
+    def selection_entries(score_matrix: ScoreMatrix, gift_index: GiftIndex, method: str,
+                          count: int, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        Подарки с offset по offset + count места рейтинга матрицы
+        Подарки без голосов и оценок идут после оцененных как автодополнение
+        """
+        ratings = score_matrix.aggregate(method)
+        means = score_matrix.means()
+        evaluated = score_matrix.evaluated()
+        columns = {gift_key: column for column, gift_key in enumerate(score_matrix.gift_ids)}
+        
+        entries = []
+        for place, gift_key in enumerate(score_matrix.top_k(method, count, offset), offset + 1):
+            gift = gift_index.get(gift_key)
+            column = columns[gift_key]
+            voters = score_matrix.voters(gift_key)
+            entry = {
+                "место": place,
+                "id": gift_key,
+                "подарок": gift["подарок"],
+                "описание": gift["описание"],
+                "стоимость": gift["стоимость"],
+                "релевантность": gift["релевантность"],
+                "query": gift.get("query", "")
+            }
+            if evaluated[column]:
+                entry.update({
+                    "средний_балл": round(float(means[column]), 2),
+                    "рейтинг": round(float(ratings[column]), 3),
+                    "количество_голосов": len(voters),
+                    "выбран_агентами": [agent for agent, _ in voters],
+                    "детали_оценок": voters
+                })
+            else:
+                entry.update({
                     "средний_балл": 75.0,
                     "количество_голосов": 0,
                     "выбран_агентами": ["автодополнение"],
                     "детали_оценок": []
                 })
+            entries.append(entry)
+        return entries
     
     def _get_fallback_final_selection(self, gifts_data: List[Dict]) -> List[Dict[str, Any]]:
         """Резервный финальный выбор"""
         if gifts_data:
             return [{
                 "место": 1,
+                "id": gifts_data[0].get("id"),
                 "подарок": gifts_data[0]["подарок"],
                 "описание": gifts_data[0]["описание"],
                 "стоимость": gifts_data[0]["стоимость"],
@@ -1351,33 +2358,9 @@ class ResultFormatter:
             result += "🤖 УЧАСТВОВАВШИЕ ИИ-АГЕНТЫ:\n"
             result += "-" * 30 + "\n"
             
-            # Разделяем агентов на группы для красивого отображения
-            agent_names = {
-                "praktik_bot": "ПрактикБот",
-                "fin_expert": "ФинЭксперт", 
-                "wow_factor": "ВауФактор",
-                "universal_guru": "УниверсалГуру",
-                "surprise_master": "СюрпризМастер",
-                "prof_rost": "ПрофРост",
-                "romantic_advisor": "РомантикСоветник",
-                "kids_expert": "ДетскийЭксперт",
-                "elderly_care": "ЗаботаОПожилых",
-                "hobby_hunter": "ОхотникХобби",
-                "luxury_curator": "КураторЛюкса",
-                "budget_saver": "БюджетСпаситель",
-                "tech_guru": "ТехГуру",
-                "creative_soul": "ТворческаяДуша",
-                "wellness_coach": "ВелнесТренер",
-                "travel_expert": "ЭкспертПутешествий",
-                "foodie_guide": "ГидГурмана",
-                "family_bonds": "СемейныеУзы",
-                "colleague_connector": "КоллегиальныйСвязующий",
-                "agent_selector": "СелекторАгентов"
-            }
-            
             agent_display_names = []
             for agent in participating_agents:
-                display_name = agent_names.get(agent, agent)
+                display_name = AGENT_DISPLAY_NAMES.get(agent, agent)
                 agent_display_names.append(display_name)
             
             result += f"Всего агентов: {len(participating_agents)}\n"
@@ -1415,7 +2398,7 @@ class ResultFormatter:
             if gift.get('детали_оценок'):
                 result += f"📊 Детальные оценки LangGraph агентов:\n"
                 for agent, score in gift['детали_оценок']:
-                    display_name = agent_names.get(agent, agent) if 'agent_names' in locals() else agent
+                    display_name = AGENT_DISPLAY_NAMES.get(agent, agent)
                     result += f"     • {display_name}: {score}\n"
             
             result += "\n"
@@ -1445,6 +2428,286 @@ print("✅ Обновленный ResultFormatter с информацией об
 Убран LangGraphWorkflowBuilder, код упрощен и работает напрямую
 """
 
+async def _report_progress(context: AgentContext, stage: str, payload: Dict[str, Any]):
+    """Передача промежуточного результата наружу (ошибки колбэка не ломают pipeline)"""
+    callback = getattr(context, "progress_callback", None)
+    if callback is None:
+        return
+    try:
+        await callback(stage, payload)
+    except Exception as e:
+        logger.warning(f"⚠️ Ошибка колбэка прогресса на этапе {stage}: {str(e)}")
+
+async def _run_agents_fanout(context: AgentContext, state: Dict[str, Any], agent_types: List[AgentType],
+                             api_client: APIClient, selection_service: 'LangGraphGiftSelectionService',
+                             agents_deadline: Deadline) -> Tuple[Dict[str, Dict[str, Any]], List[str], List[str]]:
+    """
+    Отдельный запрос на каждого агента, ожидание до кворума или дедлайна этапа
+    Возвращает ответы агентов, отброшенных агентов и агентов с резервным ответом вместо ответа модели
+    """
+    agents = [LangGraphAgent(agent_type, api_client) for agent_type in agent_types]
+    
+    # Запускаем всех агентов параллельно, о каждом голосе сообщаем сразу
+    completed_agents = 0
+    
+    async def run_agent(agent: LangGraphAgent) -> Dict[str, Any]:
+        nonlocal completed_agents
+        result = await agent.analyze_gifts_node(state)
+        completed_agents += 1
+        await _report_progress(context, "agent_vote", {
+            "agent": agent.agent_type.value,
+            "response": result.get("agent_responses", {}).get(agent.agent_type.value, {}),
+            "completed": completed_agents,
+            "total": len(agents)
+        })
+        return result
+    
+    agent_tasks = {}
+    for agent in agents:
+        task = asyncio.create_task(run_agent(agent))
+        agent_tasks[task] = agent
+    
+    # Ждем агентов до кворума, дедлайна этапа или завершения всех
+    combined_agent_responses = {}
+    successful_votes = {}
+    fallback_agents = []
+    pending = set(agent_tasks)
+    try:
+        while pending:
+            timeout = agents_deadline.cap(None)
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.warning(f"⏰ LangGraph: Дедлайн голосования, не ответили {len(pending)} агентов")
+                break
+            
+            # Объединяем результаты агентов в единое состояние
+            for task in done:
+                agent_name = agent_tasks[task].agent_type.value
+                if task.exception() is not None:
+                    logger.error(f"❌ LangGraph: Ошибка агента {agent_name}: {task.exception()}")
+                    continue
+                
+                result = task.result()
+                response = result.get("agent_responses", {}).get(agent_name)
+                if response is None:
+                    continue
+                combined_agent_responses[agent_name] = response
+                if result.get("current_step", "").endswith("_fallback"):
+                    fallback_agents.append(agent_name)
+                else:
+                    successful_votes[agent_name] = response
+            
+            if pending and selection_service.quorum_reached(successful_votes, len(agents)):
+                logger.info(f"🗳️ LangGraph: Кворум набран ({len(successful_votes)}/{len(agents)}), голосование завершено")
+                break
+    finally:
+        # Оставшиеся агенты больше не нужны - отменяем их запросы
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    
+    dropped_agents = [agent_tasks[task].agent_type.value for task in pending]
+    if dropped_agents:
+        logger.info(f"✂️ LangGraph: Отброшены агенты: {', '.join(dropped_agents)}")
+    return combined_agent_responses, dropped_agents, fallback_agents
+
+async def _run_agents_panel(context: AgentContext, state: Dict[str, Any], agent_types: List[AgentType],
+                            api_client: APIClient) -> Tuple[Dict[str, Dict[str, Any]], List[str], List[str]]:
+    """
+    Все агенты одним запросом: общий контекст оплачивается один раз
+    Возвращает ответы агентов, ошибки и агентов с резервным ответом вместо ответа модели
+    """
+    result = await LangGraphAgentPanel(agent_types, api_client).analyze_gifts_node(state)
+    agent_responses = result.get("agent_responses", {})
+    
+    for completed, (agent_name, response) in enumerate(agent_responses.items(), 1):
+        await _report_progress(context, "agent_vote", {
+            "agent": agent_name,
+            "response": response,
+            "completed": completed,
+            "total": len(agent_types)
+        })
+    return agent_responses, result.get("error_messages", []), result.get("fallback_agents", [])
+
+def _usage_report(call_log: CallLog) -> Dict[str, Any]:
+    """Вызовы и расход токенов запуска для run_report"""
+    return {
+        "calls": call_log.to_list(),
+        "usage": {"by_stage": call_log.usage_by_stage(), "total": call_log.usage_total()}
+    }
+
+# Отложенные записи журнала токенов (сильные ссылки на задачи до их завершения)
+_usage_exports: Set[asyncio.Task] = set()
+
+async def _export_usage(context: AgentContext, config: Configuration, call_log: CallLog, request_id: str,
+                        extra: Dict[str, Any], shadows: Optional[List[asyncio.Task]] = None):
+    """Итог расхода токенов в run_report и запись журнала вызовов (после завершения запросов из выборки хеджа)"""
+    if shadows:
+        await asyncio.wait(shadows)
+    context.run_report.update(_usage_report(call_log), usage_pending=False)
+    usage_total = context.run_report["usage"]["total"]
+    logger.info(f"🧾 LangGraph: Токенов {usage_total['total_tokens']} "
+                f"(промпт {usage_total['prompt_tokens']}, из кэша {usage_total['cached_tokens']}, "
+                f"ответ {usage_total['completion_tokens']}, "
+                f"рассуждения {usage_total['reasoning_tokens']}), стоимость ${usage_total['cost']}")
+    if config.usage_log_path:
+        try:
+            await asyncio.to_thread(call_log.export_jsonl, config.usage_log_path, request_id, extra)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось записать журнал расхода токенов: {e}")
+
+async def _run_gift_workflow(context: AgentContext, config: Configuration, api_client: APIClient,
+                             start_time: float) -> List[Dict[str, Any]]:
+    """Этапы workflow: генерация → агенты (параллельно) → финальный выбор"""
+    person_info = context.person_info
+    
+    # Единый бюджет времени на запрос пользователя, этапы получают свою долю
+    deadline = Deadline(timeout=config.request_deadline if config.request_deadline > 0 else None)
+    # Журнал вызовов LLM: какая модель обслужила каждый вызов
+    call_log = CallLog()
+    
+    # Создаем начальное состояние LangGraph
+    state = {
+        "person_info": person_info,
+        "gifts_data": [],
+        "agent_responses": {},
+        "final_selection": [],
+        "current_step": "initialized",
+        "error_messages": [],
+        "execution_time": 0.0,
+        "photos" : context.photos,
+        "call_log": call_log,
+        "priority": getattr(context, "priority", PRIORITY_INTERACTIVE),
+        "user_id": getattr(context, "user_id", None)
+    }
+    
+    # ЭТАП 1: Генерация подарков (LangGraph узел)
+    logger.info("📝 LangGraph Этап 1: Генерация подарков")
+    gift_generator = LangGraphGiftGenerator(api_client)
+    if state["photos"]:
+        state = await gift_generator.analyze_photos_node({**state, "deadline": deadline.share(config.photo_budget_share)})
+    
+    # Выбор агентов идет параллельно с генерацией - он зависит только от профиля
+    generation_deadline = deadline.share(config.generation_budget_share)
+    if config.agent_selection_enabled:
+        agent_selector = AgentSelector(api_client)
+        state, selection_state = await asyncio.gather(
+            gift_generator.generate_gifts_node({**state, "deadline": generation_deadline}),
+            agent_selector.select_agents_node({**state, "deadline": generation_deadline})
+        )
+        selected_agent_types = selection_state["selected_agents"]
+        selector_calls = 1 if selection_state.get("selector_llm_used") else 0
+    else:
+        state = await gift_generator.generate_gifts_node({**state, "deadline": generation_deadline})
+        selected_agent_types = [agent for agent in AgentType if agent != AgentType.AGENT_SELECTOR]
+        selector_calls = 0
+    
+    if not state.get("gifts_data"):
+        logger.error("❌ LangGraph: Не удалось сгенерировать подарки")
+        raise Exception("Генерация подарков не удалась")
+    
+    await _report_progress(context, "gifts_generated", {"gifts_data": state["gifts_data"]})
+    
+    # ЭТАП 2: Параллельный анализ агентами (LangGraph узлы)
+    logger.info("🤖 LangGraph Этап 2: Параллельный анализ агентами")
+    
+    # Агенты получают весь оставшийся бюджет (или дедлайн этапа, если он меньше)
+    agents_deadline = deadline
+    if config.agent_stage_deadline > 0:
+        agents_deadline = Deadline(timeout=deadline.cap(config.agent_stage_deadline))
+    state = {**state, "deadline": agents_deadline}
+    
+    # Выбранные агенты (если бюджет исчерпан - обходимся без них, финал по релевантности)
+    selection_service = LangGraphGiftSelectionService(config)
+    combined_agent_responses, dropped_agents, fallback_agents = {}, [], []
+    agent_llm_calls = 0
+    if agents_deadline.expired():
+        logger.warning("⏰ LangGraph: Бюджет исчерпан до голосования, агенты пропущены")
+    elif config.agent_evaluation_mode == "panel":
+        combined_agent_responses, error_messages, fallback_agents = await _run_agents_panel(
+            context, state, selected_agent_types, api_client
+        )
+        state = {**state, "error_messages": error_messages}
+        agent_llm_calls = 1 if selected_agent_types else 0
+    else:
+        combined_agent_responses, dropped_agents, fallback_agents = await _run_agents_fanout(
+            context, state, selected_agent_types, api_client, selection_service, agents_deadline
+        )
+        agent_llm_calls = len(selected_agent_types)
+    
+    # Экономия относительно прежней схемы "запрос на каждый тип агента, включая селектор"
+    agent_calls_saved = len(AgentType) - agent_llm_calls - selector_calls
+    logger.info(f"💰 LangGraph: Агентов {len(selected_agent_types)}, LLM вызовов агентов {agent_llm_calls}, "
+                f"сэкономлено: {agent_calls_saved}")
+    if fallback_agents:
+        logger.warning(f"🛟 LangGraph: Резервные ответы вместо ответа модели: {', '.join(fallback_agents)}")
+    
+    # Обновляем состояние с результатами агентов
+    state = {
+        **state,
+        "agent_responses": combined_agent_responses,
+        "dropped_agents": dropped_agents
+    }
+    
+    logger.info(f"✅ LangGraph: Получены ответы от {len(combined_agent_responses)} агентов")
+    
+    # ЭТАП 3: Финальный выбор (LangGraph узел)
+    logger.info("🎯 LangGraph Этап 3: Финальный выбор")
+    final_state = await selection_service.final_selection_node(state)
+    
+    execution_time = time.time() - start_time
+    logger.info(f"⏱️ LangGraph workflow завершен за {execution_time:.2f} секунд")
+    logger.info(f"🔗 Статистика соединений: {api_client.get_stats()}")
+    
+    request_id = uuid.uuid4().hex
+    shadows = api_client.pending_shadows(call_log)
+    
+    # Отчет о запуске доступен вызывающему коду через контекст
+    context.run_report = {
+        "request_id": request_id,
+        "execution_time": round(execution_time, 2),
+        "deadline_exceeded": deadline.expired(),
+        "participating_agents": final_state.get("participating_agents", []),
+        "dropped_agents": dropped_agents,
+        "fallback_agents": fallback_agents,
+        "selected_agents": [agent.value for agent in selected_agent_types],
+        "agent_calls_saved": agent_calls_saved,
+        "agent_evaluation_mode": config.agent_evaluation_mode,
+        "agent_llm_calls": agent_llm_calls,
+        "agent_score_all_gifts": config.agent_score_all_gifts,
+        "score_aggregation": config.score_aggregation,
+        "models": call_log.models_by_stage(),
+        **_usage_report(call_log),
+        # Основные запросы из выборки хеджа еще идут: calls и usage обновятся после их завершения
+        "usage_pending": bool(shadows),
+        "error_messages": final_state.get("error_messages", [])
+    }
+    
+    # Журнал токенов: если основные запросы из выборки хеджа еще идут, он пишется после них,
+    # чтобы их токены попали в итог; ответ пользователю их не ждет
+    usage_extra = {"user_id": state.get("user_id"), "priority": state.get("priority")}
+    if shadows:
+        task = asyncio.create_task(_export_usage(context, config, call_log, request_id, usage_extra, shadows))
+        _usage_exports.add(task)
+        task.add_done_callback(_usage_exports.discard)
+    else:
+        await _export_usage(context, config, call_log, request_id, usage_extra)
+    
+    # Матрица оценок остается в контексте: следующие подарки рейтинга - без новых вызовов LLM
+    context.score_matrix = final_state.get("score_matrix")
+    context.gift_index = gift_index_for(final_state)
+    
+    final_selection = final_state.get("final_selection", [])
+    
+    if final_selection:
+        logger.info("🎉 LangGraph система успешно завершила работу!")
+        await _report_progress(context, "final_selection", {"final_selection": final_selection})
+        return final_selection
+    else:
+        logger.warning("⚠️ LangGraph: Финальный выбор пуст, используем fallback")
+        return selection_service._get_fallback_final_selection(state.get("gifts_data", []))
+
 async def run_neuro_gift_async(context: AgentContext) -> List[Dict[str, Any]]:
     """
     Асинхронная версия с упрощенным LangGraph workflow
@@ -1457,7 +2720,8 @@ async def run_neuro_gift_async(context: AgentContext) -> List[Dict[str, Any]]:
     """
     try:
         # Создание конфигурации
-        config = Configuration.from_env()
+        shared_client = get_shared_api_client()
+        config = shared_client.config if shared_client is not None else Configuration.from_env()
         person_info = context.person_info
         logger.info(f"🔧 LangGraph система инициализирована с моделью: {config.model}")
         
@@ -1466,82 +2730,13 @@ async def run_neuro_gift_async(context: AgentContext) -> List[Dict[str, Any]]:
         
         start_time = time.time()
         
-        # Используем API клиент для создания workflow напрямую
+        # Общий клиент процесса (телеграм бот) - без нового TCP/TLS рукопожатия на каждый запрос
+        if shared_client is not None:
+            return await _run_gift_workflow(context, shared_client.config, shared_client, start_time)
+        
+        # Скрипты и Jupyter: клиент живет только на время одного запуска
         async with APIClient(config) as api_client:
-            
-            # Создаем начальное состояние LangGraph
-            state = {
-                "person_info": person_info,
-                "gifts_data": [],
-                "agent_responses": {},
-                "final_selection": [],
-                "current_step": "initialized",
-                "error_messages": [],
-                "execution_time": 0.0,
-                "photos" : context.photos
-            }
-            
-            # ЭТАП 1: Генерация подарков (LangGraph узел)
-            logger.info("📝 LangGraph Этап 1: Генерация подарков")
-            gift_generator = LangGraphGiftGenerator(api_client)
-            state = await gift_generator.generate_gifts_node(state)
-            
-            if not state.get("gifts_data"):
-                logger.error("❌ LangGraph: Не удалось сгенерировать подарки")
-                raise Exception("Генерация подарков не удалась")
-            
-            # ЭТАП 2: Параллельный анализ агентами (LangGraph узлы)
-            logger.info("🤖 LangGraph Этап 2: Параллельный анализ агентами")
-            
-            # Создаем всех агентов
-            agents = []
-            for agent_type in AgentType:
-                agent = LangGraphAgent(agent_type, api_client)
-                agents.append(agent)
-            
-            # Запускаем всех агентов параллельно
-            agent_tasks = []
-            for agent in agents:
-                task = agent.analyze_gifts_node(state)
-                agent_tasks.append(task)
-            
-            # Ждем завершения всех агентов
-            agent_results = await asyncio.gather(*agent_tasks, return_exceptions=True)
-            
-            # Объединяем результаты агентов в единое состояние
-            combined_agent_responses = {}
-            for i, (agent, result) in enumerate(zip(agents, agent_results)):
-                if isinstance(result, Exception):
-                    logger.error(f"❌ LangGraph: Ошибка агента {agent.agent_type.value}: {result}")
-                    continue
-                
-                agent_responses = result.get("agent_responses", {})
-                combined_agent_responses.update(agent_responses)
-            
-            # Обновляем состояние с результатами всех агентов
-            state = {
-                **state,
-                "agent_responses": combined_agent_responses
-            }
-            
-            logger.info(f"✅ LangGraph: Получены ответы от {len(combined_agent_responses)} агентов")
-            
-            # ЭТАП 3: Финальный выбор (LangGraph узел)
-            logger.info("🎯 LangGraph Этап 3: Финальный выбор")
-            selection_service = LangGraphGiftSelectionService(config)
-            final_state = await selection_service.final_selection_node(state)
-            
-            execution_time = time.time() - start_time
-            logger.info(f"⏱️ LangGraph workflow завершен за {execution_time:.2f} секунд")
-            
-            final_selection = final_state.get("final_selection", [])
-            
-            if final_selection:
-                logger.info("🎉 LangGraph система успешно завершила работу!")
-                return final_selection
-            else:
-                logger.warning("⚠️ LangGraph: Финальный выбор пуст, используем fallback")
-                return selection_service._get_fallback_final_selection(state.get("gifts_data", []))
+            return await _run_gift_workflow(context, config, api_client, start_time)
         
     except Exception as e:
         logger.error(f"💥 Критическая ошибка в LangGraph функции: {str(e)}")
@@ -1561,9 +2756,32 @@ async def run_neuro_gift_async(context: AgentContext) -> List[Dict[str, Any]]:
             "детали_оценок": []
         }]
 
+def show_more_gifts(context: AgentContext, offset: int, count: int = 2,
+                    method: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Следующие подарки рейтинга последнего запуска - из сохраненной матрицы оценок, без вызовов LLM
+
+    Args:
+        context: Контекст завершенного запуска
+        offset: Сколько подарков уже показано
+        count: Сколько подарков показать
+        method: Стратегия агрегации (по умолчанию - стратегия запуска)
+
+    Returns:
+        Подарки в формате финального выбора (пустой список, если матрицы нет или подарки кончились)
+    """
+    score_matrix = getattr(context, "score_matrix", None)
+    gift_index = getattr(context, "gift_index", None)
+    if score_matrix is None or gift_index is None:
+        return []
+    method = method or (context.run_report or {}).get("score_aggregation") or Configuration.score_aggregation
+    return LangGraphGiftSelectionService.selection_entries(score_matrix, gift_index, method, count, offset)
+
 def run_neuro_gift(context: AgentContext) -> List[Dict[str, Any]]:
     """
     Синхронная обертка для LangGraph системы
+    Только для скриптов и Jupyter - внутри event loop (например, в телеграм боте)
+    используйте await run_neuro_gift_async, иначе весь loop блокируется на время запуска
     """
     try:
         # Валидация входных данных
@@ -2002,7 +3220,7 @@ def system_check():
    
    # Проверка 6: Промпты
    try:
-       test_prompt = PromptTemplate.get_agent_prompt(AgentType.PRAKTIK_BOT, "тест")
+       test_prompt = PromptTemplate.get_agent_prompt(AgentType.PRAKTIK_BOT, "тест", "g1. Тест")
        if "JSON" in test_prompt:
            print("✅ 6. Промпты с JSON инструкциями готовы")
            checks_passed += 1
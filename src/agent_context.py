@@ -1,7 +1,16 @@
-from typing import TypedDict, Annotated, List, Dict, Any, Union
+from typing import TypedDict, Annotated, List, Dict, Any, Union, Optional, Callable, Awaitable
 
 class AgentContext:
     """Состояние"""
     person_info: str     # Информация о человеке
     photos: List[bytes]  # Список картинок
-    
\ No newline at end of file
+    # Колбэк прогресса: await progress_callback(stage, payload) после каждого этапа
+    progress_callback: Optional[Callable[[str, Dict[str, Any]], Awaitable[None]]] = None
+    # Пользователь и класс приоритета запросов к LLM (interactive, background, warmup)
+    user_id: Optional[str] = None
+    priority: str = "interactive"
+    # Отчет о запуске (время, участвовавшие и отброшенные агенты, ошибки) - заполняется pipeline
+    run_report: Optional[Dict[str, Any]] = None
+    # Матрица оценок агенты × подарки и индекс подарков последнего запуска - для "показать еще" без вызовов LLM
+    score_matrix: Optional[Any] = None
+    gift_index: Optional[Any] = None
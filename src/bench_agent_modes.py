@@ -0,0 +1,108 @@
+"""
+Сравнение режимов оценки агентами: fanout (запрос на агента) и panel (один запрос на всех)
+Подарки и набор агентов генерируются один раз, затем оба режима прогоняются на одинаковых данных
+
+Запуск: python bench_agent_modes.py --runs 3
+Кэш ответов и склейка запросов выключены, чтобы каждый прогон шел в API.
+Токены и стоимость берутся из usage ответов через журнал вызовов прогона
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import statistics
+import time
+from typing import Any, Dict, List
+
+from agent5 import (
+    AgentSelector, APIClient, Configuration, Deadline, LangGraphGiftGenerator,
+    LangGraphGiftSelectionService, _run_agents_fanout, _run_agents_panel
+)
+from agent_context import AgentContext
+from call_log import CallLog
+
+DEFAULT_PROFILE = """
+Мужчина 37 лет, проживающий в Москве.
+Увлекается велосипедом, кино, музыкой.
+Ходит в спортзал и любит путешествовать.
+Работает программистом на Java.
+"""
+
+async def run_benchmark(profile: str, runs: int) -> Dict[str, List[Dict[str, Any]]]:
+    config = dataclasses.replace(Configuration.from_env(), llm_cache_enabled=False, coalesce_requests=False)
+    context = AgentContext()
+    context.person_info = profile
+    context.photos = []
+
+    async with APIClient(config) as api_client:
+        base_state = {"person_info": profile, "gifts_data": [], "agent_responses": {}, "error_messages": []}
+        state = await LangGraphGiftGenerator(api_client).generate_gifts_node(base_state)
+        if not state.get("gifts_data"):
+            raise RuntimeError("Не удалось сгенерировать подарки для бенчмарка")
+        agent_types = (await AgentSelector(api_client).select_agents_node(state))["selected_agents"]
+        print(f"🎁 Подарков: {len(state['gifts_data'])}, агентов: {', '.join(a.value for a in agent_types)}")
+
+        selection_service = LangGraphGiftSelectionService(config)
+        results: Dict[str, List[Dict[str, Any]]] = {"fanout": [], "panel": []}
+
+        for run in range(runs):
+            for mode in ("fanout", "panel"):
+                call_log = CallLog()
+                run_state = {**state, "call_log": call_log}
+                started = time.perf_counter()
+                if mode == "panel":
+                    _, _, fallback_agents = await _run_agents_panel(context, run_state, agent_types, api_client)
+                else:
+                    _, _, fallback_agents = await _run_agents_fanout(
+                        context, run_state, agent_types, api_client, selection_service, Deadline.unlimited()
+                    )
+                latency = time.perf_counter() - started
+                fallbacks = len(fallback_agents)
+                usage = call_log.usage_total()
+                results[mode].append({
+                    "latency": latency,
+                    "calls": usage["calls"],
+                    "prompt_tokens": usage["prompt_tokens"],
+                    "cached_tokens": usage["cached_tokens"],
+                    "completion_tokens": usage["completion_tokens"],
+                    "reasoning_tokens": usage["reasoning_tokens"],
+                    "cost": usage["cost"],
+                    "fallbacks": fallbacks
+                })
+                print(f"  прогон {run + 1} {mode}: {latency:.2f}с, запросов {usage['calls']}, "
+                      f"токенов {usage['total_tokens']}, резервных ответов {fallbacks}")
+
+    return results
+
+
+def print_summary(results: Dict[str, List[Dict[str, Any]]]):
+    print("\n📊 Итог (среднее по прогонам):")
+    print(f"{'режим':<8} {'задержка, с':>12} {'запросов':>9} {'токены промпта':>15} {'из кэша':>8} {'токены ответа':>14} {'рассуждения':>12} {'стоимость, $':>13} {'резервных':>10}")
+    for mode, rows in results.items():
+        if not rows:
+            continue
+        print(
+            f"{mode:<8} "
+            f"{statistics.mean(r['latency'] for r in rows):>12.2f} "
+            f"{statistics.mean(r['calls'] for r in rows):>9.1f} "
+            f"{statistics.mean(r['prompt_tokens'] for r in rows):>15.0f} "
+            f"{statistics.mean(r['cached_tokens'] for r in rows):>8.0f} "
+            f"{statistics.mean(r['completion_tokens'] for r in rows):>14.0f} "
+            f"{statistics.mean(r['reasoning_tokens'] for r in rows):>12.0f} "
+            f"{statistics.mean(r['cost'] for r in rows):>13.5f} "
+            f"{statistics.mean(r['fallbacks'] for r in rows):>10.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение режимов fanout и panel")
+    parser.add_argument("--runs", type=int, default=3, help="Сколько раз прогнать каждый режим")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, help="Описание получателя подарка")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args.profile, args.runs))
+    print_summary(results)
+
+
+if __name__ == "__main__":
+    main()
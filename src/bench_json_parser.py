@@ -0,0 +1,164 @@
+"""
+Сравнение прежнего парсера JSON ответов (split по markdown + цикл по скобкам + re.sub) с json_extract
+На типичных ответах моделей меряется время разбора, на испорченных - сколько ответов удалось разобрать
+
+Запуск: python bench_json_parser.py --number 2000
+"""
+
+import argparse
+import json
+import re
+import timeit
+from typing import Any, Callable, Dict, List
+
+from json_extract import JSONExtractError, extract_json
+
+
+def legacy_parse_json_response(response: str) -> Dict[str, Any]:
+    """Копия прежнего JSONParser.parse_json_response (без логирования)"""
+    clean_response = response.strip()
+    if "```json" in clean_response:
+        parts = clean_response.split("```json")
+        if len(parts) > 1:
+            clean_response = parts[1].split("```")[0].strip()
+    elif "```" in clean_response:
+        parts = clean_response.split("```")
+        if len(parts) > 1:
+            clean_response = parts[1].split("```")[0].strip()
+
+    json_str = clean_response
+    start_idx = clean_response.find('{')
+    if start_idx != -1:
+        brace_count = 0
+        end_idx = -1
+        for i in range(start_idx, len(clean_response)):
+            if clean_response[i] == '{':
+                brace_count += 1
+            elif clean_response[i] == '}':
+                brace_count -= 1
+                if brace_count == 0:
+                    end_idx = i
+                    break
+        if end_idx != -1:
+            json_str = clean_response[start_idx:end_idx + 1]
+
+    json_str = json_str.replace('\n', ' ').replace('\r', ' ')
+    json_str = re.sub(r'\s+', ' ', json_str)
+    parsed_data = json.loads(json_str)
+    if not isinstance(parsed_data, dict):
+        raise ValueError("Ответ должен быть JSON объектом (словарем)")
+    return parsed_data
+
+
+def legacy_parse_json_array(response: str) -> List[Dict[str, Any]]:
+    """Копия прежнего JSONParser.parse_json_array (без логирования)"""
+    clean_response = response.strip()
+    if "```json" in clean_response:
+        clean_response = clean_response.split("```json")[1].split("```")[0].strip()
+    elif "```" in clean_response:
+        clean_response = clean_response.split("```")[1].split("```")[0].strip()
+
+    start_idx = clean_response.find('[')
+    json_str = clean_response
+    if start_idx != -1:
+        bracket_count = 0
+        end_idx = -1
+        for i in range(start_idx, len(clean_response)):
+            if clean_response[i] == '[':
+                bracket_count += 1
+            elif clean_response[i] == ']':
+                bracket_count -= 1
+                if bracket_count == 0:
+                    end_idx = i
+                    break
+        if end_idx != -1:
+            json_str = clean_response[start_idx:end_idx + 1]
+
+    json_str = json_str.replace('\n', ' ').replace('\r', ' ')
+    json_str = re.sub(r'\s+', ' ', json_str)
+    parsed_data = json.loads(json_str)
+    if not isinstance(parsed_data, list):
+        raise ValueError("Ответ должен быть JSON массивом")
+    return parsed_data
+
+
+_AGENT_ANSWER = json.dumps({
+    "выбранный_подарок": "Велосипедный компьютер с GPS",
+    "обоснование": "Человек много катается на велосипеде. " * 8,
+    "коэффициент_практической_ценности": 87
+}, ensure_ascii=False, indent=2)
+
+_GIFTS = json.dumps([
+    {
+        "подарок": f"Подарок {i}",
+        "описание": "Подробное описание подарка и обоснование выбора для этого человека. " * 3,
+        "стоимость": f"{1000 * i} - {2000 * i}",
+        "релевантность": 10 - i % 5,
+        "query": f"подарок {i} купить"
+    }
+    for i in range(1, 11)
+], ensure_ascii=False, indent=2)
+
+# Ответы, которые разбирают оба парсера
+VALID_CASES: Dict[str, Any] = {
+    "объект": (_AGENT_ANSWER, dict),
+    "объект в markdown": (f"```json\n{_AGENT_ANSWER}\n```", dict),
+    "объект с текстом вокруг": (f"Вот мой выбор:\n{_AGENT_ANSWER}\nНадеюсь, это поможет!", dict),
+    "массив подарков": (_GIFTS, list),
+    "массив в markdown": (f"```json\n{_GIFTS}\n```", list)
+}
+
+# Типичные дефекты ответов моделей
+DEFECT_CASES: Dict[str, Any] = {
+    "лишняя запятая": (_AGENT_ANSWER[:-2] + ",\n}", dict),
+    "обрезанный ответ": (_AGENT_ANSWER[:-40], dict),
+    "умные кавычки": ('{“выбранный_подарок”: “Книга”, “обоснование”: “любит читать”}', dict),
+    "обрезанный массив": (_GIFTS[:len(_GIFTS) * 2 // 3], list),
+    "перенос строки в значении": ('{"выбранный_подарок": "Книга", "обоснование": "строка 1\nстрока 2"}', dict)
+}
+
+
+def _new_parser(expected: type) -> Callable[[str], Any]:
+    return lambda text: extract_json(text, expected)[0]
+
+
+def _legacy_parser(expected: type) -> Callable[[str], Any]:
+    return legacy_parse_json_response if expected is dict else legacy_parse_json_array
+
+
+def run_speed(number: int):
+    print(f"⏱️ Время разбора, мкс на ответ ({number} повторов):")
+    print(f"{'ответ':<28} {'прежний':>10} {'новый':>10} {'ускорение':>10}")
+    for name, (text, expected) in VALID_CASES.items():
+        legacy = _legacy_parser(expected)
+        new = _new_parser(expected)
+        assert legacy(text) == new(text), name
+        legacy_time = timeit.timeit(lambda: legacy(text), number=number) / number * 1e6
+        new_time = timeit.timeit(lambda: new(text), number=number) / number * 1e6
+        print(f"{name:<28} {legacy_time:>10.1f} {new_time:>10.1f} {legacy_time / new_time:>9.1f}x")
+
+
+def run_defects():
+    print("\n🩹 Испорченные ответы (разобран ли ответ):")
+    print(f"{'дефект':<28} {'прежний':>10} {'новый':>10}")
+    for name, (text, expected) in DEFECT_CASES.items():
+        results = []
+        for parser in (_legacy_parser(expected), _new_parser(expected)):
+            try:
+                parser(text)
+                results.append("да")
+            except (ValueError, JSONExtractError):
+                results.append("нет")
+        print(f"{name:<28} {results[0]:>10} {results[1]:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение парсеров JSON ответов")
+    parser.add_argument("--number", type=int, default=2000, help="Повторов на каждый ответ")
+    args = parser.parse_args()
+    run_speed(args.number)
+    run_defects()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Журнал вызовов LLM в рамках одного запроса пользователя
+Для каждого вызова: этап, модель и провайдер, которые его обслужили, задержка, источник ответа
+и расход токенов из usage ответа; сводка по этапам и по запросу, выгрузка в JSONL.
+Отдельной записью учитывается каждая HTTP попытка, ответ которой не пошел в работу (ошибка,
+проигравший дубликат хеджа), - токены, потраченные на нее, тоже попадают в сводку
+"""
+
+import json
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional
+
+# Источник ответа
+SOURCE_API = "api"              # Запрос к API выполнен этим вызовом
+SOURCE_CACHE = "cache"          # Ответ взят из кэша
+SOURCE_COALESCED = "coalesced"  # Ответ получен от одновременного одинакового запроса
+
+# Исход HTTP попытки
+OUTCOME_WON = "won"             # Ответ попытки вернул вызов
+OUTCOME_LOST = "lost"           # Дубликат хеджа, ответивший вторым или отмененный
+OUTCOME_ERROR = "error"         # Попытка завершилась ошибкой, таймаутом или пустым ответом
+
+# Счетчики, которые суммируются в сводках
+_USAGE_FIELDS = ("prompt_tokens", "cached_tokens", "completion_tokens", "reasoning_tokens", "total_tokens", "cost")
+
+
+@dataclass
+class CallRecord:
+    """Один вызов make_request или одна неудачная (проигравшая) HTTP попытка"""
+    stage: str                  # Этап pipeline (generation, selector, agent, panel)
+    model: str                  # Модель, которая обслужила запрос (по ответу API, если он есть)
+    latency: float              # Время вызова, сек
+    source: str = SOURCE_API    # api / cache / coalesced
+    provider: str = ""          # Провайдер пула, выполнивший запрос
+    outcome: str = OUTCOME_WON  # won / lost / error
+    prompt_tokens: int = 0      # Токены промпта
+    cached_tokens: int = 0      # Из них взяты из кэша префиксов провайдера
+    completion_tokens: int = 0  # Токены ответа (включая рассуждения)
+    reasoning_tokens: int = 0   # Из них токены рассуждений
+    total_tokens: int = 0
+    cost: float = 0.0           # Стоимость, если провайдер ее сообщает (OpenRouter)
+
+    def apply_usage(self, usage: Optional[Dict[str, Any]]):
+        """Заполнение счетчиков из usage ответа (кэш и склеенные вызовы токены не тратят)"""
+        if not usage:
+            return
+        self.prompt_tokens = int(usage.get("prompt_tokens") or 0)
+        self.completion_tokens = int(usage.get("completion_tokens") or 0)
+        self.total_tokens = int(usage.get("total_tokens") or self.prompt_tokens + self.completion_tokens)
+        prompt_details = usage.get("prompt_tokens_details") or {}
+        self.cached_tokens = int(prompt_details.get("cached_tokens") or 0)
+        details = usage.get("completion_tokens_details") or {}
+        self.reasoning_tokens = int(details.get("reasoning_tokens") or 0)
+        self.cost = float(usage.get("cost") or 0.0)
+
+
+def _empty_summary() -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"calls": 0, "api_calls": 0, "lost_attempts": 0, "failed_attempts": 0, "latency": 0.0}
+    summary.update({field: 0 for field in _USAGE_FIELDS})
+    return summary
+
+
+def _add(summary: Dict[str, Any], call: CallRecord):
+    # Вызовы и задержка - по ответам, которые пошли в работу; токены - по всем попыткам
+    if call.outcome == OUTCOME_WON:
+        summary["calls"] += 1
+        summary["api_calls"] += int(call.source == SOURCE_API)
+        summary["latency"] += call.latency
+    summary["lost_attempts"] += int(call.outcome == OUTCOME_LOST)
+    summary["failed_attempts"] += int(call.outcome == OUTCOME_ERROR)
+    for field in _USAGE_FIELDS:
+        summary[field] += getattr(call, field)
+
+
+def _rounded(summary: Dict[str, Any]) -> Dict[str, Any]:
+    cached_share = summary["cached_tokens"] / summary["prompt_tokens"] if summary["prompt_tokens"] else 0.0
+    return {**summary, "latency": round(summary["latency"], 3), "cost": round(summary["cost"], 6),
+            "cached_share": round(cached_share, 3)}
+
+
+class CallLog:
+    """Вызовы LLM одного запуска pipeline"""
+
+    def __init__(self):
+        self.calls: List[CallRecord] = []
+
+    def record(self, call: CallRecord):
+        self.calls.append(call)
+
+    def models_by_stage(self) -> Dict[str, List[str]]:
+        """Какие модели обслуживали каждый этап"""
+        models: Dict[str, List[str]] = {}
+        for call in self.calls:
+            if call.outcome != OUTCOME_WON:
+                continue
+            stage_models = models.setdefault(call.stage, [])
+            if call.model not in stage_models:
+                stage_models.append(call.model)
+        return models
+
+    def usage_by_stage(self) -> Dict[str, Dict[str, Any]]:
+        """Вызовы, токены, стоимость и суммарная задержка по этапам"""
+        stages: Dict[str, Dict[str, Any]] = {}
+        for call in self.calls:
+            _add(stages.setdefault(call.stage, _empty_summary()), call)
+        return {stage: _rounded(summary) for stage, summary in stages.items()}
+
+    def usage_total(self) -> Dict[str, Any]:
+        """Итог по всему запросу"""
+        summary = _empty_summary()
+        for call in self.calls:
+            _add(summary, call)
+        return _rounded(summary)
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return [{**asdict(call), "latency": round(call.latency, 3)} for call in self.calls]
+
+    def export_jsonl(self, path: str, request_id: str, extra: Optional[Dict[str, Any]] = None):
+        """Дописывает вызовы запроса в JSONL файл: одна строка - один вызов или неудачная попытка"""
+        timestamp = time.time()
+        with open(path, "a", encoding="utf-8") as f:
+            for call in self.to_list():
+                line = {"request_id": request_id, "timestamp": timestamp, **(extra or {}), **call}
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
@@ -0,0 +1,56 @@
+"""
+Дедлайн запроса пользователя
+Один бюджет времени создается в run_neuro_gift_async и делится между этапами pipeline
+"""
+
+import math
+import time
+from typing import Optional
+
+
+class DeadlineExceeded(Exception):
+    """Бюджет времени исчерпан - новую работу начинать нет смысла"""
+
+
+class Deadline:
+    """
+    Момент времени, к которому работа должна быть завершена
+
+    Args:
+        timeout: Бюджет в секундах от текущего момента (None - без ограничения)
+    """
+
+    def __init__(self, timeout: Optional[float] = None, expires_at: Optional[float] = None):
+        if expires_at is None and timeout is not None:
+            expires_at = time.monotonic() + timeout
+        self.expires_at = expires_at
+
+    @classmethod
+    def unlimited(cls) -> 'Deadline':
+        return cls()
+
+    def remaining(self) -> float:
+        """Оставшееся время в секундах (inf, если дедлайна нет)"""
+        if self.expires_at is None:
+            return math.inf
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+    def share(self, fraction: float) -> 'Deadline':
+        """Дочерний дедлайн этапа: доля оставшегося бюджета"""
+        if self.expires_at is None:
+            return Deadline()
+        return Deadline(timeout=self.remaining() * fraction)
+
+    def cap(self, timeout: Optional[float]) -> Optional[float]:
+        """Таймаут операции, урезанный до оставшегося бюджета"""
+        remaining = self.remaining()
+        if timeout is None:
+            return None if remaining == math.inf else remaining
+        return min(timeout, remaining)
+
+    def __repr__(self) -> str:
+        remaining = self.remaining()
+        return "Deadline(∞)" if remaining == math.inf else f"Deadline({remaining:.1f}с)"
@@ -0,0 +1,107 @@
+"""
+Короткие идентификаторы подарков и индекс для ссылок на подарок по идентификатору
+Генератор присваивает подаркам id (g1, g2, ...), агенты отвечают id вместо полного названия,
+финальный выбор находит подарок по id за O(1). Ответы с названием (старый формат или модель
+перепутала поле) сопоставляются с подарком по нормализованному названию и нечеткому совпадению
+"""
+
+import difflib
+import re
+from typing import Any, Dict, List, Optional
+
+GIFT_ID_PREFIX = "g"
+
+_GIFT_ID_RE = re.compile(rf"^\s*{GIFT_ID_PREFIX}\s*(\d+)\s*$", re.IGNORECASE)
+# Все, кроме букв, цифр и пробелов (кавычки, тире, знаки препинания)
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_SPACES_RE = re.compile(r"\s+")
+
+# Порог нечеткого совпадения названий (difflib ratio)
+FUZZY_CUTOFF = 0.75
+# Минимальная длина части названия для совпадения по вхождению (короче - только нечеткое совпадение)
+MIN_CONTAINED_LENGTH = 4
+
+
+def gift_id(position: int) -> str:
+    """Идентификатор подарка по его номеру в списке (с 1)"""
+    return f"{GIFT_ID_PREFIX}{position}"
+
+
+def assign_gift_ids(gifts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Копии подарков с полем "id" по порядку в списке"""
+    return [{**gift, "id": gift_id(i)} for i, gift in enumerate(gifts, 1)]
+
+
+def normalize_name(name: str) -> str:
+    """Название для сравнения: регистр, ё, кавычки и знаки препинания, лишние пробелы"""
+    name = name.lower().replace("ё", "е").replace("_", " ")
+    name = _PUNCTUATION_RE.sub(" ", name)
+    return _SPACES_RE.sub(" ", name).strip()
+
+
+def _contains_words(name: str, part: str) -> bool:
+    """Нормализованное название содержит part целыми словами подряд и part не слишком короткая"""
+    return len(part) >= MIN_CONTAINED_LENGTH and f" {part} " in f" {name} "
+
+
+class GiftIndex:
+    """Индекс подарков одного запроса: id -> подарок и нормализованное название -> id"""
+
+    def __init__(self, gifts: List[Dict[str, Any]]):
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self.by_name: Dict[str, str] = {}
+        for position, gift in enumerate(gifts, 1):
+            # Подарки без id (старое состояние) получают id по позиции, как в assign_gift_ids
+            gift_key = gift.get("id") or gift_id(position)
+            self.by_id[gift_key] = gift
+            self.by_name.setdefault(normalize_name(gift["подарок"]), gift_key)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __contains__(self, gift_key: str) -> bool:
+        return gift_key in self.by_id
+
+    def get(self, gift_key: str) -> Optional[Dict[str, Any]]:
+        return self.by_id.get(gift_key)
+
+    def resolve(self, reference: Any) -> Optional[str]:
+        """
+        id подарка по ответу агента
+
+        Порядок: id как есть ("g3", "G3", "3"), точное нормализованное название,
+        единственное название, содержащее ответ целыми словами или содержащееся в нем так же,
+        нечеткое совпадение
+
+        Returns:
+            id подарка или None, если подарок не найден
+        """
+        if reference is None:
+            return None
+        reference = str(reference).strip()
+        if not reference:
+            return None
+        if reference in self.by_id:
+            return reference
+
+        match = _GIFT_ID_RE.match(reference)
+        if match or reference.isdigit():
+            candidate = gift_id(int(match.group(1) if match else reference))
+            return candidate if candidate in self.by_id else None
+
+        name = normalize_name(reference)
+        if not name:
+            return None
+        if name in self.by_name:
+            return self.by_name[name]
+
+        # Модель сократила или дополнила название
+        containing = {
+            gift_key for known, gift_key in self.by_name.items()
+            if _contains_words(known, name) or _contains_words(name, known)
+        }
+        if len(containing) == 1:
+            return containing.pop()
+
+        close = difflib.get_close_matches(name, list(self.by_name), n=1, cutoff=FUZZY_CUTOFF)
+        return self.by_name[close[0]] if close else None
@@ -0,0 +1,141 @@
+"""
+Очередь запросов на подбор подарков
+Фиксированный пул воркеров, ограниченная глубина очереди и уведомления о позиции
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, List, Optional
+
+
+class QueueFullError(Exception):
+    """Очередь переполнена - запрос не принят"""
+
+
+@dataclass
+class GiftJob:
+    """Задача на подбор подарка"""
+    run: Callable[[], Awaitable[Any]]                                  # Запуск агента
+    on_position: Optional[Callable[[int], Awaitable[None]]] = None     # Уведомление о позиции (1 - следующий)
+    on_start: Optional[Callable[[], Awaitable[None]]] = None           # Уведомление о начале обработки
+    enqueued_at: float = field(default_factory=time.monotonic)         # Время постановки в очередь
+    last_position: int = 0                                             # Последняя отправленная позиция
+    started: bool = False                                              # Задача уже взята воркером
+
+
+class GiftJobQueue:
+    """
+    Очередь между телеграм-хендлером и run_neuro_gift_async
+
+    Одновременно выполняется не больше workers запусков агента, в ожидании
+    находится не больше max_queue_size задач - остальным сразу отвечаем "занято"
+    """
+
+    def __init__(self, workers: int, max_queue_size: int):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self._pending: Deque[GiftJob] = deque()
+        self._condition: Optional[asyncio.Condition] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._in_progress = 0
+        self._completed = 0
+        self._rejected = 0
+        self._notifications = set()  # Ссылки на фоновые уведомления, чтобы их не собрал GC
+        self.logger = logging.getLogger("GiftJobQueue")
+
+    async def start(self):
+        """Запуск пула воркеров (вызывать внутри работающего event loop)"""
+        self._condition = asyncio.Condition()
+        for i in range(self.workers):
+            self._worker_tasks.append(asyncio.create_task(self._worker(i)))
+        self.logger.info(f"🚦 Очередь запущена: воркеров {self.workers}, глубина {self.max_queue_size}")
+
+    async def stop(self):
+        """Остановка воркеров, ожидающие задачи отбрасываются"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._pending.clear()
+        self.logger.info("🛑 Очередь остановлена")
+
+    async def submit(self, job: GiftJob) -> int:
+        """
+        Постановка задачи в очередь
+
+        Returns:
+            Позиция задачи в очереди (1 - будет взята первой)
+
+        Raises:
+            QueueFullError: Если очередь заполнена
+        """
+        if self._condition is None:
+            raise RuntimeError("Очередь не запущена")
+
+        if len(self._pending) >= self.max_queue_size:
+            self._rejected += 1
+            self.logger.warning(f"⛔ Очередь заполнена ({len(self._pending)}), запрос отклонен")
+            raise QueueFullError("Очередь заполнена")
+
+        async with self._condition:
+            self._pending.append(job)
+            job.last_position = len(self._pending)
+            self._condition.notify()
+
+        self.logger.info(f"📥 Задача в очереди, позиция {job.last_position}")
+        return job.last_position
+
+    def stats(self) -> dict:
+        """Текущее состояние очереди"""
+        return {
+            "в_очереди": len(self._pending),
+            "в_работе": self._in_progress,
+            "выполнено": self._completed,
+            "отклонено": self._rejected,
+            "воркеров": self.workers,
+            "максимум_очереди": self.max_queue_size,
+        }
+
+    async def _worker(self, index: int):
+        """Воркер: берет задачи по одной и выполняет их"""
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(lambda: len(self._pending) > 0)
+                job = self._pending.popleft()
+                job.started = True
+
+            self._notify_positions()
+            self._in_progress += 1
+            wait_time = time.monotonic() - job.enqueued_at
+            self.logger.info(f"⚙️ Воркер {index}: задача взята в работу, ожидание {wait_time:.1f}с")
+
+            try:
+                if job.on_start:
+                    await self._safe_callback(job.on_start())
+                await job.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"❌ Воркер {index}: ошибка задачи: {str(e)}")
+            finally:
+                self._in_progress -= 1
+                self._completed += 1
+
+    def _notify_positions(self):
+        """Рассылка новых позиций оставшимся в очереди задачам"""
+        for position, job in enumerate(self._pending, 1):
+            if job.on_position and job.last_position != position:
+                job.last_position = position
+                task = asyncio.create_task(self._safe_callback(job.on_position(position)))
+                self._notifications.add(task)
+                task.add_done_callback(self._notifications.discard)
+
+    async def _safe_callback(self, awaitable: Awaitable[None]):
+        """Ошибки уведомлений не должны ронять воркер"""
+        try:
+            await awaitable
+        except Exception as e:
+            self.logger.warning(f"⚠️ Ошибка уведомления пользователя: {str(e)}")
@@ -1,6 +1,7 @@
 import traceback
 from dotenv import load_dotenv
 import os
+from typing import Optional
 from gigachat import GigaChat
 
 
@@ -8,13 +9,14 @@ load_dotenv()
 giga_token = os.getenv("GIGA_CHAT_TOKEN")
 
 
-def analyze_picture(file_data: bytes) -> str:
-    
+def analyze_picture(file_data: bytes, timeout: Optional[float] = None) -> str:
+    # timeout - на каждый HTTP запрос клиента (загрузка файла и чат), None - значение GigaChat по умолчанию
     try:
         giga = GigaChat(
             credentials=giga_token,
             verify_ssl_certs=False,
-            model="GigaChat-2-Pro"
+            model="GigaChat-2-Pro",
+            timeout=timeout
         )
         
         file = giga.upload_file(("file.png", file_data))
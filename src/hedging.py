@@ -0,0 +1,121 @@
+"""
+Хеджирование запросов к LLM
+Если запрос отвечает дольше обычного (перцентиль задержек по этапу), отправляется дубликат,
+побеждает первый корректный ответ, а проигравший запрос отменяется
+(кроме случайной выборки вызовов, на которой отчет меряет задержку без хеджа)
+"""
+
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Перцентиль q (0..1) по списку значений, None для пустого списка"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class LatencyTracker:
+    """Скользящее окно задержек успешных запросов по этапам (генерация, агенты, ...)"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, stage: str, latency: float):
+        if stage not in self._samples:
+            self._samples[stage] = deque(maxlen=self.window)
+        self._samples[stage].append(latency)
+
+    def count(self, stage: str) -> int:
+        return len(self._samples.get(stage, ()))
+
+    def percentile(self, stage: str, q: float) -> Optional[float]:
+        return percentile(list(self._samples.get(stage, ())), q)
+
+
+class HedgeBudget:
+    """
+    Бюджет хеджирования: каждый запрос добавляет ratio токена, хедж тратит один токен
+    Так доля дополнительных запросов не превышает ratio от общего потока
+    """
+
+    def __init__(self, ratio: float, burst: float = 5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def on_request(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class HedgeReport:
+    """
+    Отчет об эффекте хеджирования по этапам
+
+    Фактическая задержка сохраняется для каждого вызова. Задержка "без хеджа" известна не всегда:
+    если победил хедж, основной запрос обычно отменяется. Поэтому для оценки выигрыша берется
+    случайная выборка вызовов, в которых основной запрос не отменяется и дорабатывает в фоне
+    (контрфакт), и p99 с хеджем и без него сравниваются на одной и той же выборке
+    """
+
+    def __init__(self, window: int = 1000, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples    # Размер выборки, начиная с которого выигрыш попадает в отчет
+        self._stages: Dict[str, Dict[str, Any]] = {}
+
+    def _stage(self, stage: str) -> Dict[str, Any]:
+        return self._stages.setdefault(stage, {
+            "effective": deque(maxlen=self.window),
+            "sampled_effective": deque(maxlen=self.window),
+            "sampled_primary": deque(maxlen=self.window),
+            "calls": 0,
+            "hedged": 0,
+            "hedge_wins": 0
+        })
+
+    def record(self, stage: str, effective_latency: float, hedged: bool, hedge_won: bool):
+        """Вызов с хеджированием: фактическая задержка"""
+        data = self._stage(stage)
+        data["effective"].append(effective_latency)
+        data["calls"] += 1
+        data["hedged"] += int(hedged)
+        data["hedge_wins"] += int(hedge_won)
+
+    def record_counterfactual(self, stage: str, effective_latency: float, primary_latency: float):
+        """Вызов из выборки: фактическая задержка и задержка основного запроса, доработавшего до конца"""
+        data = self._stage(stage)
+        data["sampled_effective"].append(effective_latency)
+        data["sampled_primary"].append(primary_latency)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Сводка по этапам: p50/p99 с хеджированием; p99 без него - когда выборка достаточна"""
+        result = {}
+        for stage, data in self._stages.items():
+            effective = list(data["effective"])
+            stage_summary = {
+                "вызовов": data["calls"],
+                "хеджировано": data["hedged"],
+                "побед_хеджа": data["hedge_wins"],
+                "p50": round(percentile(effective, 0.5), 3) if effective else None,
+                "p99": round(percentile(effective, 0.99), 3) if effective else None,
+                "выборка_без_хеджа": len(data["sampled_primary"])
+            }
+            if len(data["sampled_primary"]) >= self.min_samples:
+                p99_with = percentile(list(data["sampled_effective"]), 0.99)
+                p99_without = percentile(list(data["sampled_primary"]), 0.99)
+                stage_summary["p99_выборки"] = round(p99_with, 3)
+                stage_summary["p99_без_хеджа"] = round(p99_without, 3)
+                if p99_without:
+                    stage_summary["улучшение_p99_процент"] = round((p99_without - p99_with) / p99_without * 100, 1)
+            result[stage] = stage_summary
+        return result
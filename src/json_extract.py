@@ -0,0 +1,280 @@
+"""
+Извлечение JSON из ответа LLM за один проход
+Первое JSON значение ищется прямо в исходной строке через JSONDecoder.raw_decode без копирования
+и без предварительной очистки (markdown, текст вокруг JSON, переносы строк внутри значений не мешают).
+Если ответ испорчен, он чинится: лишние запятые, "умные" кавычки, обрезанный хвост.
+Для стриминга есть инкрементальный вариант, который принимает ответ по фрагментам
+"""
+
+import json
+import re
+from typing import List, Optional, Tuple, Type, Union
+
+# strict=False разрешает управляющие символы (переносы строк) внутри строк
+_DECODER = json.JSONDecoder(strict=False)
+
+_OPENERS = {"{": "}", "[": "]"}
+_SMART_QUOTES = "“”„«»"
+
+# Символы, на которых меняется состояние разбора; все остальное пропускается поиском regex
+_STRUCTURE_RE = re.compile(r'[{}\[\]"\\]')
+_IN_STRING_RE = re.compile(r'["\\]')
+
+# Чем может начинаться содержимое после открывающей скобки JSON (включая "умные" кавычки для починки)
+_WHITESPACE = " \t\r\n"
+_VALUE_STARTS = {
+    "{": '"}' + _SMART_QUOTES,
+    "[": '"{[]-0123456789tfn' + _SMART_QUOTES
+}
+
+JSONValue = Union[dict, list]
+
+
+class JSONExtractError(ValueError):
+    """В тексте нет JSON значения нужного типа, которое удалось бы разобрать или починить"""
+
+
+def _candidates(text: str, openers: str):
+    """Позиции открывающих скобок нужного типа в порядке появления"""
+    positions = {char: text.find(char) for char in openers}
+    while True:
+        found = [(pos, char) for char, pos in positions.items() if pos != -1]
+        if not found:
+            return
+        pos, char = min(found)
+        yield pos
+        positions[char] = text.find(char, pos + 1)
+
+
+def repair_json(fragment: str) -> str:
+    """
+    Починка JSON, начинающегося с открывающей скобки
+
+    - "умные" кавычки вне обычных строк считаются кавычками JSON
+    - запятая перед } или ] удаляется
+    - обрезанный ответ закрывается: незакрытая строка и скобки закрываются,
+      недописанный элемент отбрасывается до последнего целого
+    Текст после закрытия значения верхнего уровня отбрасывается
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    quote = ""                          # Закрывающая кавычка текущей строки ("" - вне строки)
+    escape = False
+    # Последняя точка, где значение можно закрыть без потерь: длина out и открытые скобки
+    safe: Optional[Tuple[int, Tuple[str, ...]]] = None
+
+    for char in fragment:
+        if quote:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == quote or (quote != '"' and char in _SMART_QUOTES):
+                out.append('"')
+                quote = ""
+                continue
+            elif quote != '"' and char == '"':
+                # Обычная кавычка внутри строки в "умных" кавычках
+                out.append('\\"')
+                continue
+            out.append(char)
+            continue
+
+        if char == '"':
+            quote = '"'
+        elif char in _SMART_QUOTES:
+            quote = "”"
+            out.append('"')
+            continue
+        elif char in _OPENERS:
+            stack.append(_OPENERS[char])
+        elif char in "}]":
+            # Лишняя запятая перед закрывающей скобкой
+            while out and out[-1] in " \t\r\n":
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if not stack:
+                break
+            stack.pop()
+            out.append(char)
+            if not stack:
+                return "".join(out)
+            safe = (len(out), tuple(stack))
+            continue
+        elif char == "," and stack:
+            safe = (len(out), tuple(stack))
+        out.append(char)
+
+    # Ответ обрезан: сначала пробуем закрыть как есть, затем откатываемся к последнему целому элементу
+    tail = list(out)
+    if quote:
+        tail.append('"')
+    candidate = "".join(tail).rstrip().rstrip(",:") + "".join(reversed(stack))
+    try:
+        _DECODER.decode(candidate)
+        return candidate
+    except ValueError:
+        pass
+    if safe is None:
+        return candidate
+    length, open_stack = safe
+    return "".join(out[:length]).rstrip().rstrip(",") + "".join(reversed(open_stack))
+
+
+def extract_json(text: str, expected: Optional[Type] = None) -> Tuple[JSONValue, bool]:
+    """
+    Первое JSON значение (объект или массив) в тексте
+
+    Args:
+        text: Ответ модели как есть
+        expected: dict или list - искать значение только этого типа
+
+    Returns:
+        Значение и признак того, что ответ пришлось чинить
+
+    Raises:
+        JSONExtractError: Если JSON не найден и не чинится
+    """
+    openers = "{" if expected is dict else "[" if expected is list else "{["
+    first = -1
+    for pos in _candidates(text, openers):
+        if first == -1:
+            first = pos
+        try:
+            value, _ = _DECODER.raw_decode(text, pos)
+        except json.JSONDecodeError as e:
+            # Ошибка не сразу после скобки - это JSON с дефектом, а не скобка в тексте:
+            # чиним его, а не ищем дальше (иначе вместо обрезанного ответа найдется вложенный объект)
+            if text[pos + 1:e.pos].strip():
+                first = pos
+                break
+            continue
+        if expected is None or isinstance(value, expected):
+            return value, False
+
+    if first == -1:
+        kind = "объекта" if expected is dict else "массива" if expected is list else "значения"
+        raise JSONExtractError(f"В ответе нет JSON {kind}")
+
+    repaired = repair_json(text[first:])
+    try:
+        value = _DECODER.decode(repaired)
+    except ValueError as e:
+        raise JSONExtractError(f"Некорректный JSON в ответе: {e}") from e
+    if expected is not None and not isinstance(value, expected):
+        raise JSONExtractError(f"Ожидался JSON {'объект' if expected is dict else 'массив'}")
+    return value, True
+
+
+class JSONStreamExtractor:
+    """
+    Инкрементальный разбор ответа, приходящего фрагментами
+
+    feed() отслеживает баланс скобок первого JSON значения и сообщает, когда оно закрыто
+    (поток можно закрывать досрочно); value - разобранное значение, partial() - починенное
+    значение по уже полученной части ответа
+    """
+
+    def __init__(self, expected: Optional[Type] = None):
+        self.expected = expected
+        self.openers = "{" if expected is dict else "[" if expected is list else "{["
+        self.depth = 0
+        self.started = False
+        self.complete = False
+        self.end_in_chunk = -1    # Позиция после закрывающей скобки в последнем фрагменте
+        self._verified = False    # После открывающей скобки встретилось начало значения
+        self._in_string = False
+        self._escape = False
+        self._parts: List[str] = []
+        self._value: Optional[JSONValue] = None
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Обработка очередного фрагмента
+
+        Returns:
+            True, если JSON значение верхнего уровня закрыто
+        """
+        if self.complete:
+            return True
+
+        pos = 0
+        begin = 0
+        while not self._verified:
+            if not self.started:
+                starts = [index for index in (chunk.find(char, pos) for char in self.openers) if index != -1]
+                if not starts:
+                    return False
+                pos = min(starts)
+                self.started = True
+                self.depth = 1
+                self._parts = [chunk[pos]]
+                pos += 1
+                begin = pos
+
+            # Скобка начинает JSON, только если за ней может идти значение ("[см. ниже]" - это текст)
+            while pos < len(chunk) and chunk[pos] in _WHITESPACE:
+                pos += 1
+            if pos == len(chunk):
+                self._parts.append(chunk[begin:])
+                return False
+            if chunk[pos] in _VALUE_STARTS[self._parts[0]]:
+                self._verified = True
+            else:
+                self.started = False
+                self.depth = 0
+                self._parts = []
+
+        length = len(chunk)
+        while pos < length:
+            if self._escape:
+                self._escape = False
+                pos += 1
+                continue
+            match = (_IN_STRING_RE if self._in_string else _STRUCTURE_RE).search(chunk, pos)
+            if match is None:
+                break
+            char = match.group()
+            pos = match.end()
+            if char == "\\":
+                self._escape = self._in_string
+            elif char == '"':
+                self._in_string = not self._in_string
+            elif char in "{[":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+                    self.end_in_chunk = pos
+                    self._parts.append(chunk[begin:pos])
+                    return True
+
+        self._parts.append(chunk[begin:])
+        return False
+
+    @property
+    def text(self) -> str:
+        """Полученная часть JSON значения (начиная с открывающей скобки)"""
+        return "".join(self._parts)
+
+    @property
+    def value(self) -> Optional[JSONValue]:
+        """Значение верхнего уровня, если оно уже закрыто"""
+        if not self.complete:
+            return None
+        if self._value is None:
+            self._value, _ = extract_json(self.text, self.expected)
+        return self._value
+
+    def partial(self) -> Optional[JSONValue]:
+        """Починенное значение по уже полученной части ответа (None, если JSON еще не начался)"""
+        if not self.started:
+            return None
+        if self.complete:
+            return self.value
+        try:
+            return _DECODER.decode(repair_json(self.text))
+        except ValueError:
+            return None
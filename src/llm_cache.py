@@ -0,0 +1,166 @@
+"""
+Кэш ответов LLM
+Два уровня: LRU в памяти и SQLite на диске, ключ - хэш модели, промпта и параметров генерации
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class LLMResponseCache:
+    """
+    Двухуровневый кэш ответов LLM с TTL
+
+    Args:
+        memory_size: Сколько ответов держать в памяти (LRU)
+        db_path: Путь к SQLite файлу (None - только память)
+        ttl: Время жизни записи в секундах
+        disk_max_entries: Максимум записей на диске, лишние вытесняются по давности использования
+    """
+
+    def __init__(self, memory_size: int = 512, db_path: Optional[str] = None,
+                 ttl: float = 24 * 3600, disk_max_entries: int = 20000):
+        self.memory_size = memory_size
+        self.db_path = db_path
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._writes_since_evict = 0
+        self._stats = {
+            "попаданий_память": 0,
+            "попаданий_диск": 0,
+            "промахов": 0,
+            "записей": 0
+        }
+        self.logger = logging.getLogger("LLMResponseCache")
+
+        if db_path:
+            self._open_db()
+
+    @staticmethod
+    def make_key(payload: Dict[str, Any]) -> str:
+        """
+        Ключ кэша по телу запроса (модель, сообщения, параметры генерации)
+        Пробелы в тексте сообщений нормализуются, чтобы повтор с другим форматированием попадал в кэш
+        """
+        normalized = dict(payload)
+        normalized["messages"] = [
+            {**message, "content": re.sub(r"\s+", " ", str(message.get("content", ""))).strip()}
+            for message in payload.get("messages", [])
+        ]
+        raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Поиск ответа: сначала память, затем диск"""
+        now = time.time()
+
+        cached = self._memory.get(key)
+        if cached is not None:
+            value, expires_at = cached
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                self._stats["попаданий_память"] += 1
+                return value
+            del self._memory[key]
+
+        if self._db is not None:
+            row = await asyncio.to_thread(self._db_get, key, now)
+            if row is not None:
+                value, expires_at = row
+                self._remember(key, value, expires_at)
+                self._stats["попаданий_диск"] += 1
+                return value
+
+        self._stats["промахов"] += 1
+        return None
+
+    async def set(self, key: str, value: str):
+        """Сохранение ответа в оба уровня"""
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        self._stats["записей"] += 1
+        if self._db is not None:
+            await asyncio.to_thread(self._db_set, key, value, expires_at)
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий и промахов"""
+        stats = dict(self._stats)
+        lookups = stats["попаданий_память"] + stats["попаданий_диск"] + stats["промахов"]
+        hits = stats["попаданий_память"] + stats["попаданий_диск"]
+        stats["доля_попаданий"] = round(hits / lookups, 3) if lookups else 0.0
+        stats["в_памяти"] = len(self._memory)
+        return stats
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    def _remember(self, key: str, value: str, expires_at: float):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _open_db(self):
+        try:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            with self._db_lock:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+                )
+                self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+                self._db.commit()
+            self.logger.info(f"💾 Дисковый кэш LLM: {self.db_path}")
+        except sqlite3.Error as e:
+            self.logger.error(f"❌ Не удалось открыть дисковый кэш, работаем только в памяти: {str(e)}")
+            self._db = None
+
+    def _db_get(self, key: str, now: float) -> Optional[Tuple[str, float]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._db.commit()
+            return row
+
+    def _db_set(self, key: str, value: str, expires_at: float):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, time.time())
+            )
+            self._writes_since_evict += 1
+            # Вытеснение раз в 100 записей, чтобы не считать размер таблицы на каждую вставку
+            if self._writes_since_evict >= 100:
+                self._writes_since_evict = 0
+                self._evict_locked()
+            self._db.commit()
+
+    def _evict_locked(self):
+        now = time.time()
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        overflow = count - self.disk_max_entries
+        if overflow > 0:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_access LIMIT ?)", (overflow,)
+            )
+            self.logger.info(f"🧹 Дисковый кэш: вытеснено {overflow} записей")
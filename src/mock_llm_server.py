@@ -0,0 +1,200 @@
+"""
+Локальный OpenAI-совместимый сервер-заглушка для проверки пула провайдеров без реального API
+Отвечает правдоподобным JSON для этапов pipeline (подарки, выбор агентов, голоса агентов, панель),
+умеет задержку, случайные ошибки, лимит запросов в минуту с заголовками x-ratelimit-* и SSE стриминг.
+Кэш префиксов промптов имитируется блоками: совпавшее с прошлыми запросами начало промпта
+возвращается в usage.prompt_tokens_details.cached_tokens.
+response_format с JSON схемой поддерживается (или отклоняется ответом 400 с флагом --no-structured)
+
+Пример: два провайдера, второй медленный и с ошибками
+    python mock_llm_server.py --port 8001
+    python mock_llm_server.py --port 8002 --latency 3 --error-rate 0.3
+    LLM_PROVIDERS='[{"name": "a", "base_url": "http://localhost:8001/v1", "api_token": "x"},
+                    {"name": "b", "base_url": "http://localhost:8002/v1", "api_token": "x"}]' python agent5.py
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Set
+
+from aiohttp import web
+
+_GIFT_LINE_RE = re.compile(r"^(g\d+)\.\s+", re.MULTILINE)
+_METRIC_RE = re.compile(r'"([^"]+)":\s*число(_коэффициент)?')
+_EXPERT_RE = re.compile(r"=== ЭКСПЕРТ (\w+) ===")
+
+# Размер блока кэша префиксов в символах (~128 токенов, как у провайдеров)
+_PREFIX_BLOCK = 512
+
+_MOCK_GIFTS = [
+    "Умная колонка", "Велосипедный компьютер", "Абонемент в кино", "Беспроводные наушники",
+    "Сертификат на массаж", "Книга о путешествиях", "Кофемашина", "Настольная игра",
+    "Рюкзак для путешествий", "Фитнес-браслет"
+]
+
+
+def _agent_answer(block: str, gifts: List[str], score_all: bool = False) -> Dict[str, Any]:
+    answer: Dict[str, Any] = {
+        "подарок_id": random.choice(gifts) if gifts else "g1",
+        "обоснование": "Ответ тестового сервера"
+    }
+    for field, is_ratio in _METRIC_RE.findall(block):
+        if field not in answer:
+            answer[field] = round(random.uniform(1.0, 4.0), 2) if is_ratio else random.randint(50, 95)
+    if score_all:
+        answer["оценки"] = {gift: random.randint(10, 95) for gift in gifts}
+    return answer
+
+
+def build_content(prompt: str) -> str:
+    """Ответ в формате, который ожидает этап pipeline по тексту промпта"""
+    gifts = _GIFT_LINE_RE.findall(prompt.split("СПИСОК ПОДАРКОВ:", 1)[-1]) if "СПИСОК ПОДАРКОВ:" in prompt else []
+    # Режим оценки всех подарков (AGENT_SCORE_ALL_GIFTS)
+    score_all = '"оценки"' in prompt
+
+    if "selected_agents" in prompt:
+        return json.dumps({
+            "selected_agents": ["universal_guru", "praktik_bot", "surprise_master", "hobby_hunter"],
+            "reasoning": "Ответ тестового сервера"
+        }, ensure_ascii=False)
+
+    experts = _EXPERT_RE.findall(prompt)
+    if experts:
+        blocks = _EXPERT_RE.split(prompt)[1:]
+        answers = {name: _agent_answer(body, gifts, score_all) for name, body in zip(blocks[::2], blocks[1::2])}
+        return json.dumps(answers, ensure_ascii=False)
+
+    if "подарок_id" in prompt:
+        return json.dumps(_agent_answer(prompt, gifts, score_all), ensure_ascii=False)
+
+    return json.dumps([
+        {
+            "подарок": name,
+            "описание": "Описание от тестового сервера",
+            "стоимость": f"{1000 * (i + 1)} - {2000 * (i + 1)}",
+            "релевантность": 10 - i % 5,
+            "query": name.lower()
+        }
+        for i, name in enumerate(_MOCK_GIFTS)
+    ], ensure_ascii=False)
+
+
+class MockLLMServer:
+    """Состояние сервера: задержка, доля ошибок и скользящее окно запросов для лимита RPM"""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, rpm: int, model: str,
+                 structured_output: bool = True):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rpm = rpm
+        self.model = model
+        self.structured_output = structured_output
+        self._requests: Deque[float] = deque()
+        self._prefixes: Set[str] = set()
+
+    def _cached_chars(self, prompt: str) -> int:
+        """Длина начала промпта (целыми блоками), которое уже встречалось в прошлых запросах"""
+        cached = 0
+        digest = hashlib.sha256()
+        for end in range(_PREFIX_BLOCK, len(prompt) + 1, _PREFIX_BLOCK):
+            digest.update(prompt[end - _PREFIX_BLOCK:end].encode("utf-8"))
+            key = digest.hexdigest()
+            if key in self._prefixes and cached == end - _PREFIX_BLOCK:
+                cached = end
+            self._prefixes.add(key)
+        return cached
+
+    def _rate_headers(self) -> Dict[str, str]:
+        if not self.rpm:
+            return {}
+        now = time.time()
+        while self._requests and self._requests[0] <= now - 60:
+            self._requests.popleft()
+        remaining = max(0, self.rpm - len(self._requests))
+        reset = (self._requests[0] + 60 - now) if self._requests else 0.0
+        return {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s"
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if body.get("response_format") and not self.structured_output:
+            return web.json_response(
+                {"error": {"message": "response_format is not supported for this model"}}, status=400
+            )
+        headers = self._rate_headers()
+        if self.rpm and headers["x-ratelimit-remaining-requests"] == "0":
+            retry_after = headers["x-ratelimit-reset-requests"].rstrip("s")
+            return web.json_response({"error": {"message": "rate limit"}}, status=429,
+                                     headers={**headers, "Retry-After": retry_after})
+        self._requests.append(time.time())
+        headers = self._rate_headers()
+
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            return web.json_response({"error": {"message": "mock failure"}}, status=503, headers=headers)
+
+        prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+        content = build_content(prompt)
+        schema_name = ((body.get("response_format") or {}).get("json_schema") or {}).get("name")
+        if schema_name == "gift_list":
+            # Корень схемы - объект, список подарков в поле gifts
+            content = json.dumps({"gifts": json.loads(content)}, ensure_ascii=False)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(content) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_details": {"cached_tokens": self._cached_chars(prompt) // 4},
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+        if body.get("stream"):
+            response = web.StreamResponse(headers={**headers, "Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for start in range(0, len(content), 40):
+                chunk = {"model": self.model, "choices": [{"delta": {"content": content[start:start + 40]}}]}
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await response.write(
+                f"data: {json.dumps({'model': self.model, 'choices': [], 'usage': usage})}\n\n".encode("utf-8")
+            )
+            await response.write(b"data: [DONE]\n\n")
+            return response
+
+        return web.json_response({
+            "id": f"mock-{int(time.time() * 1000)}",
+            "model": self.model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage
+        }, headers=headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-совместимый сервер-заглушка")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.5, help="Средняя задержка ответа, сек")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Разброс задержки, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 503")
+    parser.add_argument("--rpm", type=int, default=0, help="Лимит запросов в минуту (0 - без лимита)")
+    parser.add_argument("--model", default="mock-model")
+    parser.add_argument("--no-structured", action="store_true", help="Отклонять запросы с response_format")
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.latency, args.jitter, args.error_rate, args.rpm, args.model,
+                           structured_output=not args.no_structured)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", server.chat_completions)
+    web.run_app(app, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Планировщик исходящих запросов к LLM с классами приоритета
+interactive - запросы пользователей телеграм бота, background - пакетные задачи, warmup - прогрев кэша.
+Свободный слот всегда получает самый приоритетный класс, внутри класса пользователи обслуживаются по кругу,
+а фоновые классы занимают не больше своей доли слотов, чтобы интерактивным запросам всегда оставалось место
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional
+
+from hedging import percentile
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+PRIORITY_WARMUP = "warmup"
+
+# Порядок обслуживания: от самого приоритетного класса
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, PRIORITY_WARMUP)
+
+
+class _PriorityClass:
+    """Очереди одного класса: своя очередь у каждого пользователя, пользователи чередуются"""
+
+    def __init__(self, share: float, window: int):
+        self.share = share
+        self.queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self.depth = 0
+        self.in_flight = 0
+        self.granted = 0
+        self.max_depth = 0
+        self.waits: Deque[float] = deque(maxlen=window)
+
+    def push(self, user_id: str, waiter: asyncio.Future):
+        self.queues.setdefault(user_id, deque()).append(waiter)
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def pop_next(self) -> Optional[asyncio.Future]:
+        """Первый ожидающий следующего по кругу пользователя"""
+        while self.queues:
+            user_id, queue = next(iter(self.queues.items()))
+            waiter = queue.popleft()
+            self.depth -= 1
+            # Пользователь уходит в конец круга
+            if queue:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            if not waiter.done():
+                return waiter
+        return None
+
+    def remove(self, user_id: str, waiter: asyncio.Future) -> bool:
+        queue = self.queues.get(user_id)
+        if queue is None or waiter not in queue:
+            return False
+        queue.remove(waiter)
+        self.depth -= 1
+        if not queue:
+            del self.queues[user_id]
+        return True
+
+
+class PriorityScheduler:
+    """
+    Слоты исходящих запросов с приоритетами
+
+    Args:
+        capacity: Текущее число слотов (например, сумма лимитов провайдеров - она меняется AIMD)
+        shares: Максимальная доля слотов на класс (interactive - все слоты)
+        window: Сколько последних ожиданий хранить для перцентилей
+    """
+
+    def __init__(self, capacity: Callable[[], int], shares: Optional[Dict[str, float]] = None, window: int = 500):
+        shares = {PRIORITY_INTERACTIVE: 1.0, PRIORITY_BACKGROUND: 0.5, PRIORITY_WARMUP: 0.25, **(shares or {})}
+        self.capacity = capacity
+        self.classes = {priority: _PriorityClass(shares[priority], window) for priority in PRIORITIES}
+        self.in_flight = 0
+        self.logger = logging.getLogger("PriorityScheduler")
+
+    @asynccontextmanager
+    async def slot(self, priority: str = PRIORITY_INTERACTIVE, user_id: Optional[str] = None) -> AsyncIterator[None]:
+        """Занять слот на время одной попытки запроса"""
+        await self.acquire(priority, user_id)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    async def acquire(self, priority: str = PRIORITY_INTERACTIVE, user_id: Optional[str] = None):
+        if priority not in self.classes:
+            raise ValueError(f"Неизвестный класс приоритета: {priority}")
+        priority_class = self.classes[priority]
+        user_key = str(user_id) if user_id is not None else "anonymous"
+        started = time.monotonic()
+
+        waiter = asyncio.get_running_loop().create_future()
+        priority_class.push(user_key, waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Ушли из очереди; если слот уже был выдан - возвращаем его
+            if not priority_class.remove(user_key, waiter) and waiter.done() and not waiter.cancelled():
+                self.release(priority)
+            raise
+        priority_class.waits.append(time.monotonic() - started)
+
+    def release(self, priority: str):
+        self.in_flight -= 1
+        self.classes[priority].in_flight -= 1
+        self._dispatch()
+
+    def _class_limit(self, priority_class: _PriorityClass, capacity: int) -> int:
+        return max(1, int(capacity * priority_class.share))
+
+    def _dispatch(self):
+        """Раздача свободных слотов: строго по приоритету классов, с учетом доли класса"""
+        capacity = max(1, self.capacity())
+        while self.in_flight < capacity:
+            for priority in PRIORITIES:
+                priority_class = self.classes[priority]
+                if priority_class.depth and priority_class.in_flight < self._class_limit(priority_class, capacity):
+                    waiter = priority_class.pop_next()
+                    if waiter is not None:
+                        waiter.set_result(None)
+                        self.in_flight += 1
+                        priority_class.in_flight += 1
+                        priority_class.granted += 1
+                        break
+            else:
+                return
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Глубина очереди и время ожидания по классам"""
+        result = {}
+        for priority, priority_class in self.classes.items():
+            waits = list(priority_class.waits)
+            result[priority] = {
+                "в_очереди": priority_class.depth,
+                "макс_очередь": priority_class.max_depth,
+                "в_работе": priority_class.in_flight,
+                "выдано_слотов": priority_class.granted,
+                "ожидание_p50": round(percentile(waits, 0.5) or 0.0, 3),
+                "ожидание_p95": round(percentile(waits, 0.95) or 0.0, 3),
+                "пользователей_в_очереди": len(priority_class.queues)
+            }
+        return result
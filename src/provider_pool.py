@@ -0,0 +1,265 @@
+"""
+Пул OpenAI-совместимых провайдеров LLM
+Запрос уходит провайдеру с лучшим сочетанием веса, задержки, свободных слотов и остатка лимита,
+при ошибках провайдер временно выводится из ротации, а запрос повторяется на другом
+"""
+
+import json
+import logging
+import os
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple
+
+from adaptive_limiter import AdaptiveConcurrencyLimiter
+from rate_limiter import RateLimiter
+
+
+@dataclass
+class Provider:
+    """OpenAI-совместимый endpoint со своими учетными данными"""
+    name: str
+    base_url: str
+    api_token: str
+    weight: float = 1.0                                     # Доля трафика относительно других провайдеров
+    models: Dict[str, str] = field(default_factory=dict)    # Имя модели в пайплайне -> имя у провайдера
+    rpm: Optional[int] = None                               # Квота запросов в минуту (None - общая из конфигурации)
+    tpm: Optional[int] = None                               # Квота токенов в минуту (None - общая из конфигурации)
+    structured_output: Optional[bool] = None                # Поддержка response_format всеми моделями (None - проверить по ответу)
+
+    def map_model(self, model: str) -> str:
+        return self.models.get(model, model)
+
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.api_token}"}
+
+
+def load_providers(raw: str, default_base_url: str, default_token: str) -> List[Provider]:
+    """
+    Список провайдеров из JSON (переменная LLM_PROVIDERS)
+
+    Формат: [{"name": "...", "base_url": "...", "api_token": "..." | "token_env": "ИМЯ_ПЕРЕМЕННОЙ",
+              "weight": 1.0, "models": {"модель пайплайна": "модель провайдера"}, "rpm": 60, "tpm": 100000,
+              "structured_output": true}]
+    Пустая строка - один провайдер из base_url и api_token конфигурации
+    """
+    if not raw or not raw.strip():
+        return [Provider(name="default", base_url=default_base_url, api_token=default_token)]
+
+    providers = []
+    for index, item in enumerate(json.loads(raw)):
+        token = item.get("api_token") or os.getenv(item.get("token_env", ""), "") or default_token
+        providers.append(Provider(
+            name=item.get("name") or f"provider{index + 1}",
+            base_url=item["base_url"].rstrip("/"),
+            api_token=token,
+            weight=float(item.get("weight", 1.0)),
+            models=dict(item.get("models", {})),
+            rpm=int(item["rpm"]) if item.get("rpm") is not None else None,
+            tpm=int(item["tpm"]) if item.get("tpm") is not None else None,
+            structured_output=item.get("structured_output")
+        ))
+    if not providers:
+        raise ValueError("LLM_PROVIDERS не содержит ни одного провайдера")
+    return providers
+
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _parse_reset(value: Optional[str]) -> Optional[float]:
+    """Время до сброса лимита: "6m0s"/"20ms" (OpenAI) или момент времени в мс/с (OpenRouter)"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        number = float(value)
+    except ValueError:
+        parts = _DURATION_RE.findall(value)
+        if not parts:
+            return None
+        return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+    if number > 1e12:       # Unix время в миллисекундах
+        return max(0.0, number / 1000 - time.time())
+    if number > 1e9:        # Unix время в секундах
+        return max(0.0, number - time.time())
+    return number           # Секунды до сброса
+
+
+def parse_rate_limit(headers: Mapping[str, str]) -> Tuple[Optional[int], Optional[float]]:
+    """Остаток запросов и время до сброса по заголовкам x-ratelimit-* (форматы OpenAI и OpenRouter)"""
+    lowered = {key.lower(): value for key, value in headers.items()}
+    remaining = lowered.get("x-ratelimit-remaining-requests", lowered.get("x-ratelimit-remaining"))
+    reset = lowered.get("x-ratelimit-reset-requests", lowered.get("x-ratelimit-reset"))
+    try:
+        remaining_value = int(float(remaining)) if remaining is not None else None
+    except ValueError:
+        remaining_value = None
+    return remaining_value, _parse_reset(reset)
+
+
+class ProviderState:
+    """Состояние провайдера в пуле: лимитеры, здоровье и остаток лимита"""
+
+    def __init__(self, provider: Provider, limiter: AdaptiveConcurrencyLimiter, rate_limiter: RateLimiter):
+        self.provider = provider
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        # Модели, для которых провайдер ответил, что не поддерживает response_format
+        self.structured_output_unsupported: Set[str] = set()
+        # (модель, этап), схему которых провайдер отклонил как некорректную
+        self.rejected_schemas: Set[Tuple[str, str]] = set()
+        self.consecutive_failures = 0
+        self.unavailable_until = 0.0
+        self.rate_remaining: Optional[int] = None
+        self.rate_reset_at = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def structured_output_allowed(self, model: str, stage: str) -> bool:
+        """Отправлять ли response_format для модели (имя у провайдера) и этапа"""
+        if (model, stage) in self.rejected_schemas:
+            return False
+        if self.provider.structured_output is not None:
+            return self.provider.structured_output
+        return model not in self.structured_output_unsupported
+
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд провайдер еще недоступен (пауза после ошибок или исчерпанный лимит)"""
+        resume_at = self.unavailable_until
+        if self.rate_remaining == 0:
+            resume_at = max(resume_at, self.rate_reset_at)
+        return max(0.0, resume_at - now)
+
+    def available(self, now: float) -> bool:
+        if self.unavailable_until > now:
+            return False
+        # Лимит провайдера исчерпан до момента сброса
+        return not (self.rate_remaining == 0 and self.rate_reset_at > now)
+
+
+class ProviderPool:
+    """
+    Маршрутизация запросов между провайдерами
+
+    Args:
+        providers: Провайдеры пула
+        limiter_factory: Создает лимитер одновременных запросов для каждого провайдера
+        rate_limiter_factory: Возвращает лимитер квот RPM/TPM провайдера (None - без квот)
+        failure_threshold: Сколько ошибок подряд выводит провайдера из ротации
+        base_cooldown: Начальная пауза для нездорового провайдера (удваивается при повторных ошибках)
+        max_cooldown: Максимальная пауза
+    """
+
+    def __init__(self, providers: List[Provider],
+                 limiter_factory: Callable[[], AdaptiveConcurrencyLimiter],
+                 rate_limiter_factory: Optional[Callable[[Provider], RateLimiter]] = None,
+                 failure_threshold: int = 3, base_cooldown: float = 5.0, max_cooldown: float = 60.0):
+        if not providers:
+            raise ValueError("Пул провайдеров пуст")
+        rate_limiter_factory = rate_limiter_factory or (lambda provider: RateLimiter(name=provider.name))
+        self.states = [
+            ProviderState(provider, limiter_factory(), rate_limiter_factory(provider)) for provider in providers
+        ]
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.logger = logging.getLogger("ProviderPool")
+
+    def choose(self, exclude: Optional[Set[str]] = None) -> ProviderState:
+        """
+        Выбор провайдера для попытки
+
+        Случайный выбор с весом: вес провайдера / задержка EWMA x доля свободных слотов x остаток лимита
+        x остаток собственной квоты RPM/TPM.
+        Если все доступные провайдеры уже опробованы, берется любой доступный,
+        если недоступны все - тот, что освободится раньше (сколько ждать - ProviderState.wait_time)
+        """
+        exclude = exclude or set()
+        now = time.monotonic()
+        available = [state for state in self.states if state.available(now)]
+        candidates = [state for state in available if state.provider.name not in exclude] or available
+        if not candidates:
+            return min(self.states, key=lambda state: state.wait_time(now))
+        if len(candidates) == 1:
+            return candidates[0]
+
+        known_latencies = [state.limiter.latency_ewma for state in candidates if state.limiter.latency_ewma]
+        default_latency = min(known_latencies) if known_latencies else 1.0
+        scores = [self._score(state, default_latency) for state in candidates]
+        return random.choices(candidates, weights=scores)[0]
+
+    def _score(self, state: ProviderState, default_latency: float) -> float:
+        # Новый провайдер без замеров оценивается как лучший из известных, чтобы получить трафик
+        latency = state.limiter.latency_ewma or default_latency
+        limit = max(1, int(state.limiter.limit))
+        free_share = max(0.1, (limit - state.limiter.in_flight) / limit)
+        budget_share = 1.0
+        if state.rate_remaining is not None and state.rate_remaining < 10:
+            budget_share = max(0.05, state.rate_remaining / 10)
+        quota_share = max(0.05, state.rate_limiter.availability())
+        return state.provider.weight / max(latency, 0.01) * free_share * budget_share * quota_share
+
+    def on_response(self, state: ProviderState, headers: Mapping[str, str]):
+        """Обновление остатка лимита по заголовкам ответа (любого статуса)"""
+        remaining, reset_in = parse_rate_limit(headers)
+        if remaining is not None:
+            state.rate_remaining = remaining
+            state.rate_reset_at = time.monotonic() + (reset_in if reset_in is not None else 1.0)
+
+    def on_success(self, state: ProviderState):
+        state.requests += 1
+        if state.consecutive_failures:
+            self.logger.info(f"💚 Провайдер {state.provider.name} снова отвечает")
+        state.consecutive_failures = 0
+        state.unavailable_until = 0.0
+
+    def on_failure(self, state: ProviderState, retry_after: Optional[float] = None):
+        """Ошибка провайдера: после серии ошибок или по Retry-After он временно выводится из ротации"""
+        state.requests += 1
+        state.failures += 1
+        state.consecutive_failures += 1
+        now = time.monotonic()
+        pause = 0.0
+        if state.consecutive_failures >= self.failure_threshold:
+            pause = min(self.max_cooldown,
+                        self.base_cooldown * 2 ** (state.consecutive_failures - self.failure_threshold))
+        if retry_after:
+            pause = max(pause, retry_after)
+        if pause > 0:
+            state.unavailable_until = max(state.unavailable_until, now + pause)
+            self.logger.warning(f"🚧 Провайдер {state.provider.name} выведен из ротации на {pause:.1f}с")
+
+    def on_rejected(self, state: ProviderState):
+        """Провайдер отклонил сам запрос (4xx кроме перегрузки): провайдер здоров, паузы нет"""
+        state.requests += 1
+        state.rejected += 1
+
+    def has_alternative(self, exclude: Set[str]) -> bool:
+        """Есть ли доступный провайдер, который еще не пробовали"""
+        now = time.monotonic()
+        return any(state.available(now) and state.provider.name not in exclude for state in self.states)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        return {
+            state.provider.name: {
+                "доступен": state.available(now),
+                "вес": state.provider.weight,
+                "запросов": state.requests,
+                "ошибок": state.failures,
+                "ошибок_подряд": state.consecutive_failures,
+                "отклонено": state.rejected,
+                "остаток_лимита": state.rate_remaining,
+                "структурированный_вывод": state.provider.structured_output,
+                "модели_без_схем": sorted(state.structured_output_unsupported),
+                "отклоненные_схемы": sorted(f"{model}/{stage}" for model, stage in state.rejected_schemas),
+                "лимитер": state.limiter.metrics(),
+                "квоты": state.rate_limiter.stats()
+            }
+            for state in self.states
+        }
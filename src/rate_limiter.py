@@ -0,0 +1,182 @@
+"""
+Ограничение частоты запросов к LLM по квотам провайдера: запросы в минуту (RPM) и токены в минуту (TPM)
+Перед отправкой токены оцениваются по длине промпта, после ответа оценка сверяется с usage из ответа.
+Вызов, которому не хватает квоты, ждет в очереди, а не получает 429 и не уходит в повторы
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from typing import Any, Dict, Optional
+
+# Сколько токенов закладывать на ответ, если max_tokens этапа не задан
+DEFAULT_COMPLETION_TOKENS = 500
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без токенизатора
+    Латиница и цифры - около 4 символов на токен, кириллица и прочее - около 2.5
+    """
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    other_chars = len(text) - ascii_chars
+    return int(math.ceil(ascii_chars / 4 + other_chars / 2.5))
+
+
+class TokenBucket:
+    """
+    Ведро с равномерным пополнением: capacity единиц в минуту
+    Баланс может уйти в минус, если фактический расход оказался больше оценки
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Через сколько секунд в ведре будет amount единиц"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def refund(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Пара ведер RPM/TPM одного провайдера
+
+    Args:
+        rpm: Запросов в минуту (0 - без ограничения)
+        tpm: Токенов в минуту (0 - без ограничения)
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, name: str = ""):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stats = {
+            "запросов": 0,
+            "ожиданий": 0,
+            "время_ожидания": 0.0,
+            "оценено_токенов": 0,
+            "фактически_токенов": 0
+        }
+        self.logger = logging.getLogger("RateLimiter")
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    async def acquire(self, estimated_tokens: int):
+        """Ожидание квоты на один запрос с оценкой токенов (очередь FIFO)"""
+        self._stats["запросов"] += 1
+        self._stats["оценено_токенов"] += estimated_tokens
+        if not self.enabled:
+            return
+
+        # Под замком ждет только голова очереди: большой запрос не обгоняется мелкими
+        async with self._get_lock():
+            started = time.monotonic()
+            slept = False
+            while True:
+                wait = max(
+                    self.requests.wait_time(1) if self.requests else 0.0,
+                    self.tokens.wait_time(estimated_tokens) if self.tokens else 0.0
+                )
+                if wait <= 0:
+                    break
+                slept = True
+                await asyncio.sleep(wait)
+
+            if slept:
+                waited = time.monotonic() - started
+                self._stats["ожиданий"] += 1
+                self._stats["время_ожидания"] += waited
+                self.logger.info(f"🪣 {self.name}: ожидание квоты {waited:.2f}с ({estimated_tokens} токенов)")
+
+            if self.requests:
+                self.requests.consume(1)
+            if self.tokens:
+                self.tokens.consume(estimated_tokens)
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Сверка оценки с usage из ответа: недобор списывается, перебор возвращается в ведро"""
+        if actual_tokens is None:
+            return
+        self._stats["фактически_токенов"] += actual_tokens
+        if self.tokens is None:
+            return
+        difference = actual_tokens - estimated_tokens
+        if difference > 0:
+            self.tokens.consume(difference)
+        elif difference < 0:
+            self.tokens.refund(-difference)
+
+    def release(self, unused_tokens: int):
+        """Возврат неиспользованной части оценки, когда usage не пришел (ошибка, таймаут, досрочно закрытый поток)"""
+        if self.tokens is not None and unused_tokens > 0:
+            self.tokens.refund(unused_tokens)
+
+    def availability(self) -> float:
+        """Доля оставшейся квоты (0..1) - для выбора провайдера"""
+        shares = []
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket._refill()
+                shares.append(max(0.0, bucket.level / bucket.capacity))
+        return min(shares) if shares else 1.0
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["время_ожидания"] = round(stats["время_ожидания"], 2)
+        if self.requests:
+            stats["остаток_запросов"] = int(self.requests.level)
+        if self.tokens:
+            stats["остаток_токенов"] = int(self.tokens.level)
+        return stats
+
+    def _get_lock(self) -> asyncio.Lock:
+        # Лимитер общий на процесс, а скрипты могут запускать новый event loop на каждый запуск:
+        # замок создается заново для каждого loop, квоты в ведрах при этом сохраняются
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+
+_shared_limiters: Dict[str, RateLimiter] = {}
+
+
+def shared_rate_limiter(name: str, base_url: str, api_token: str, rpm: int, tpm: int) -> RateLimiter:
+    """
+    Лимитер на процесс: все APIClient с одним провайдером делят одну квоту
+    Ключ - адрес провайдера и хэш токена, так что разные аккаунты считаются отдельно
+    """
+    token_hash = hashlib.sha256(api_token.encode("utf-8")).hexdigest()[:16]
+    key = f"{base_url}|{token_hash}"
+    limiter = _shared_limiters.get(key)
+    if limiter is None:
+        limiter = RateLimiter(rpm, tpm, name=name)
+        _shared_limiters[key] = limiter
+    return limiter
@@ -0,0 +1,357 @@
+"""
+Локальный классификатор получателя подарка и маршрутизатор агентов
+Определяет тип получателя и подходящих агентов без обращения к LLM:
+правила по основам слов + небольшой наивный байесовский классификатор
+"""
+
+import json
+import logging
+import math
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("RecipientClassifier")
+
+# Окончания для грубого стемминга русских слов (от длинных к коротким)
+_ENDINGS = sorted([
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ешь", "ете", "ить", "ать", "ять",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ую", "юю", "ом", "ем", "ам", "ям", "ах", "ях",
+    "ов", "ев", "ью", "ия", "ие", "ии", "ся", "сь",
+    "ы", "и", "а", "я", "о", "е", "у", "ю", "ь", "й"
+], key=len, reverse=True)
+
+_TOKEN_RE = re.compile(r"[а-яёa-z0-9]+")
+_AGE_RE = re.compile(r"(\d{1,3})\s*(?:-?\s*(?:лет|год|годик))")
+
+
+def stem(word: str) -> str:
+    """Отсечение типичного окончания, основа не короче 3 символов"""
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Основы слов текста"""
+    return [stem(token) for token in _TOKEN_RE.findall(text.lower().replace("ё", "е"))]
+
+
+# Окончания для правил получателя: слово должно целиком совпасть с основой + одним из окончаний
+# (иначе "муж" находится в "мужик", "тет" - в "тетрис", "мат" - в "матовые")
+_MASC = ("", "а", "у", "ом", "ем", "е", "ы", "и", "ов", "ей", "ам", "ами", "ах")       # друг, брат, муж
+_MASC_OBLIQUE = ("а", "у", "ом", "ем", "е", "ы", "и", "ов", "ей", "ам", "ами", "ах")  # отц-а, ребенк-а
+_MASC_SOFT = ("ь", "я", "ю", "ем", "е", "и", "ей", "ям", "ями", "ях")               # учитель, родитель
+_FEM = ("а", "ы", "и", "е", "у", "ой", "ою", "", "ам", "ами", "ах")                  # мама, коллега
+_FEM_SOFT = ("я", "и", "е", "ю", "ей", "ь", "ям", "ями", "ях")                     # тетя, дядя, бабуля
+_PLURAL_SOFT = ("ья", "ьев", "ей", "ьям", "ьями", "ьях")                           # мужья, братья, друзья
+_ADJ = ("ый", "ий", "ой", "ая", "яя", "ое", "ее", "ые", "ие", "ого", "его", "ому", "ему",
+        "ым", "им", "ую", "юю", "ых", "их", "ыми", "ими", "ом", "ем")
+
+# Правила: тип получателя -> (основа, вес, допустимые окончания)
+RECIPIENT_RULES: Dict[str, List[Tuple[str, float, Tuple[str, ...]]]] = {
+    "коллега": [("коллег", 3.0, _FEM), ("сотрудник", 2.5, _MASC), ("сотрудниц", 2.5, _FEM),
+                ("сослуживец", 3.0, ("",)), ("сослуживц", 3.0, _MASC_OBLIQUE), ("офис", 1.0, _MASC),
+                ("команд", 0.5, _FEM)],
+    "начальник": [("начальник", 3.0, _MASC), ("начальниц", 3.0, _FEM), ("руководител", 3.0, _MASC_SOFT),
+                  ("директор", 3.0, _MASC), ("босс", 3.0, _MASC), ("шеф", 2.5, _MASC)],
+    "ребенок": [("ребенок", 3.0, ("",)), ("ребенк", 3.0, _MASC_OBLIQUE), ("дет", 2.0, ("и", "ей", "ям", "ьми", "ях")),
+                ("малыш", 3.0, _MASC), ("малышк", 3.0, _FEM), ("школьник", 3.0, _MASC),
+                ("школьниц", 3.0, _FEM), ("сын", 1.5, _MASC), ("сынов", 1.5, _PLURAL_SOFT),
+                ("сынишк", 1.5, _FEM), ("доч", 1.5, ("ь",)), ("дочер", 1.5, ("и", "ью", "ей", "ям", "ями", "ях")),
+                ("дочк", 1.5, _FEM), ("внук", 2.0, _MASC), ("внучк", 2.0, _FEM), ("племянник", 1.5, _MASC)],
+    "девушка": [("девушк", 3.0, _FEM), ("подруг", 1.5, _FEM), ("возлюблен", 2.0, _ADJ), ("любим", 1.5, _ADJ)],
+    "парень": [("парен", 3.0, ("ь",)), ("парн", 3.0, ("я", "ю", "ем", "е", "и", "ей", "ям", "ями", "ях")),
+               ("бойфренд", 3.0, _MASC)],
+    "пожилой человек": [("пожил", 3.0, _ADJ), ("пенсионер", 3.0, _MASC), ("пенсионерк", 3.0, _FEM),
+                        ("пенси", 2.0, ("я", "и", "ю", "ей")), ("бабушк", 2.5, _FEM), ("дедушк", 2.5, _FEM),
+                        ("бабул", 2.5, _FEM_SOFT), ("дедул", 2.5, _FEM_SOFT)],
+    "друг": [("друг", 2.5, ("", "а", "у", "ом", "е")), ("друз", 2.5, _PLURAL_SOFT),
+             ("дружищ", 3.0, ("е", "а", "у")), ("приятел", 2.5, _MASC_SOFT), ("приятельниц", 2.5, _FEM),
+             ("товарищ", 2.0, _MASC)],
+    "родитель": [("мам", 3.0, _FEM), ("мамочк", 3.0, _FEM), ("пап", 3.0, _FEM), ("отец", 3.0, ("",)),
+                 ("отц", 3.0, _MASC_OBLIQUE), ("мат", 1.0, ("ь",)), ("матер", 1.0, ("и", "ью", "ей")),
+                 ("родител", 3.0, _MASC_SOFT)],
+    "брат/сестра": [("брат", 3.0, _MASC + _PLURAL_SOFT), ("сестр", 3.0, _FEM), ("сестер", 3.0, ("",)),
+                    ("сестренк", 3.0, _FEM), ("братишк", 3.0, _FEM)],
+    "супруг/супруга": [("муж", 3.0, _MASC + _PLURAL_SOFT), ("жен", 2.5, _FEM), ("супруг", 3.0, _MASC + _FEM),
+                       ("благоверн", 3.0, _ADJ)],
+    "учитель": [("учител", 3.0, _MASC_SOFT), ("учительниц", 3.0, _FEM), ("преподавател", 3.0, _MASC_SOFT),
+                ("преподавательниц", 3.0, _FEM), ("педагог", 3.0, _MASC), ("классн", 1.5, _ADJ),
+                ("воспитател", 3.0, _MASC_SOFT), ("воспитательниц", 3.0, _FEM)],
+    "сосед": [("сосед", 3.0, _MASC + ("ям", "ями", "ях")), ("соседк", 3.0, _FEM)],
+    "знакомый": [("знаком", 2.5, _ADJ), ("малознаком", 3.0, _ADJ)],
+    "родственник": [("родственник", 3.0, _MASC), ("родственниц", 3.0, _FEM), ("тет", 2.5, _FEM_SOFT),
+                    ("тетушк", 2.5, _FEM), ("дяд", 2.5, _FEM_SOFT), ("дядюшк", 2.5, _FEM), ("кузен", 2.5, _MASC),
+                    ("кузин", 2.5, _FEM), ("свекор", 3.0, ("",)), ("свекр", 3.0, _MASC_OBLIQUE),
+                    ("тещ", 3.0, _FEM), ("свекров", 3.0, ("ь", "и", "ью", "ей")), ("племянниц", 2.0, _FEM)],
+}
+
+# Вес, начиная с которого правило считается сильным (прямое указание на получателя)
+STRONG_RULE_WEIGHT = 2.5
+# Потолок уверенности, когда сработало одно слабое правило: решение остается за LLM селектором
+WEAK_RULE_MAX_CONFIDENCE = 0.5
+
+# Базовые агенты по типу получателя (в порядке приоритета)
+RECIPIENT_AGENTS: Dict[str, List[str]] = {
+    "коллега": ["colleague_connector", "prof_rost", "praktik_bot", "budget_saver"],
+    "ребенок": ["kids_expert", "creative_soul", "surprise_master", "tech_guru"],
+    "девушка": ["romantic_advisor", "wellness_coach", "luxury_curator", "creative_soul"],
+    "парень": ["tech_guru", "hobby_hunter", "praktik_bot", "surprise_master"],
+    "пожилой человек": ["elderly_care", "wellness_coach", "family_bonds", "praktik_bot"],
+    "родственник": ["family_bonds", "universal_guru", "wellness_coach", "hobby_hunter"],
+    "друг": ["surprise_master", "hobby_hunter", "universal_guru", "wow_factor"],
+    "начальник": ["luxury_curator", "prof_rost", "colleague_connector", "universal_guru"],
+    "супруг/супруга": ["romantic_advisor", "luxury_curator", "family_bonds", "wellness_coach"],
+    "родитель": ["family_bonds", "wellness_coach", "praktik_bot", "elderly_care"],
+    "брат/сестра": ["hobby_hunter", "surprise_master", "wow_factor", "universal_guru"],
+    "учитель": ["universal_guru", "praktik_bot", "creative_soul", "budget_saver"],
+    "сосед": ["universal_guru", "budget_saver", "foodie_guide", "praktik_bot"],
+    "знакомый": ["universal_guru", "budget_saver", "praktik_bot", "surprise_master"],
+}
+
+DEFAULT_AGENTS = ["universal_guru", "praktik_bot", "surprise_master", "fin_expert"]
+
+# Интересы: начало основы -> агент
+INTEREST_AGENTS: Dict[str, str] = {
+    "программ": "tech_guru", "гаджет": "tech_guru", "компьютер": "tech_guru", "техник": "tech_guru",
+    "игр": "tech_guru", "айти": "tech_guru", "разработ": "tech_guru",
+    "путешеств": "travel_expert", "поездк": "travel_expert", "туризм": "travel_expert", "поход": "travel_expert",
+    "готов": "foodie_guide", "кулинар": "foodie_guide", "еда": "foodie_guide", "кофе": "foodie_guide",
+    "вин": "foodie_guide", "гурман": "foodie_guide", "выпечк": "foodie_guide",
+    "спорт": "wellness_coach", "йог": "wellness_coach", "зал": "wellness_coach", "фитнес": "wellness_coach",
+    "здоров": "wellness_coach", "бег": "wellness_coach", "красот": "wellness_coach",
+    "рисова": "creative_soul", "рису": "creative_soul", "музык": "creative_soul", "фотограф": "creative_soul",
+    "творч": "creative_soul", "дизайн": "creative_soul", "искусств": "creative_soul",
+    "рыбалк": "hobby_hunter", "сад": "hobby_hunter", "шахмат": "hobby_hunter", "хобби": "hobby_hunter",
+    "увлека": "hobby_hunter", "коллекционир": "hobby_hunter", "велосипед": "hobby_hunter", "кино": "hobby_hunter",
+    "карьер": "prof_rost", "бизнес": "prof_rost", "менеджер": "prof_rost", "учеб": "prof_rost",
+    "роскош": "luxury_curator", "премиум": "luxury_curator", "дорог": "luxury_curator", "статус": "luxury_curator",
+    "бюджет": "budget_saver", "недорог": "budget_saver", "дешев": "budget_saver", "эконом": "budget_saver",
+    "семь": "family_bonds", "семейн": "family_bonds",
+    "романтик": "romantic_advisor", "свидани": "romantic_advisor", "годовщин": "romantic_advisor",
+}
+
+# Небольшой обучающий корпус для байесовского классификатора
+SEED_CORPUS: List[Tuple[str, str]] = [
+    ("Коллега по работе, сидим в одном офисе, день рождения отмечаем всем отделом", "коллега"),
+    ("Сотрудник из соседнего отдела, хороший специалист, уходит на повышение", "коллега"),
+    ("Подарок руководителю на юбилей от всего коллектива", "начальник"),
+    ("Наш директор любит гольф и дорогой виски", "начальник"),
+    ("Сыну 7 лет, любит конструкторы и мультики", "ребенок"),
+    ("Девочка 10 лет, школьница, занимается танцами", "ребенок"),
+    ("Малыш, ему исполняется 3 года", "ребенок"),
+    ("Моя девушка, 25 лет, любит йогу и путешествия", "девушка"),
+    ("Подарок любимой девушке на годовщину отношений", "девушка"),
+    ("Мой парень, 27 лет, геймер и фанат техники", "парень"),
+    ("Бабушка 78 лет, любит вязать и выращивать цветы на даче", "пожилой человек"),
+    ("Дедушка на пенсии, любит рыбалку и шахматы", "пожилой человек"),
+    ("Лучший друг со школы, любит футбол и настолки", "друг"),
+    ("Подруга детства, обожает кофе и книги", "друг"),
+    ("Мама, 55 лет, работает бухгалтером, любит сад", "родитель"),
+    ("Папа, любит рыбалку и ремонт машины", "родитель"),
+    ("Старший брат, программист, любит велосипед", "брат/сестра"),
+    ("Младшая сестра студентка, рисует и слушает музыку", "брат/сестра"),
+    ("Муж 40 лет, инженер, любит футбол и гриль", "супруг/супруга"),
+    ("Жена, 35 лет, годовщина свадьбы, любит театр", "супруг/супруга"),
+    ("Классный руководитель сына, учитель математики", "учитель"),
+    ("Преподаватель в университете, научный руководитель", "учитель"),
+    ("Сосед по лестничной клетке помог с ремонтом", "сосед"),
+    ("Малознакомый человек, пригласили на день рождения", "знакомый"),
+    ("Знакомый по спортзалу, общаемся иногда", "знакомый"),
+    ("Тетя из другого города, любит готовить", "родственник"),
+    ("Дядя, родственник со стороны мужа, увлекается охотой", "родственник"),
+]
+
+
+@dataclass
+class RecipientPrediction:
+    """Результат локальной классификации"""
+    recipient_type: str                  # Значение GiftRecipientType
+    confidence: float                    # Уверенность 0..1
+    agents: List[str]                    # Агенты по убыванию релевантности
+    probabilities: Dict[str, float] = field(default_factory=dict)
+
+
+class NaiveBayesModel:
+    """Мультиномиальный наивный Байес по основам слов"""
+
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.labels: List[str] = []
+        self.log_priors: Dict[str, float] = {}
+        self.log_likelihoods: Dict[str, Dict[str, float]] = {}
+        self.log_unknown: Dict[str, float] = {}
+
+    def fit(self, samples: Iterable[Tuple[str, str]]) -> 'NaiveBayesModel':
+        """Обучение на парах (текст, тип получателя)"""
+        token_counts: Dict[str, Dict[str, int]] = {}
+        label_counts: Dict[str, int] = {}
+        vocabulary = set()
+        for text, label in samples:
+            label_counts[label] = label_counts.get(label, 0) + 1
+            counts = token_counts.setdefault(label, {})
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0) + 1
+                vocabulary.add(token)
+
+        total_samples = sum(label_counts.values())
+        vocabulary_size = len(vocabulary) + 1
+        self.labels = sorted(label_counts)
+        self.log_priors = {label: math.log(count / total_samples) for label, count in label_counts.items()}
+        self.log_likelihoods = {}
+        self.log_unknown = {}
+        for label in self.labels:
+            counts = token_counts.get(label, {})
+            denominator = sum(counts.values()) + self.alpha * vocabulary_size
+            self.log_likelihoods[label] = {
+                token: math.log((count + self.alpha) / denominator) for token, count in counts.items()
+            }
+            self.log_unknown[label] = math.log(self.alpha / denominator)
+        return self
+
+    def predict_proba(self, tokens: List[str]) -> Dict[str, float]:
+        if not self.labels:
+            return {}
+        scores = {}
+        for label in self.labels:
+            likelihoods = self.log_likelihoods[label]
+            unknown = self.log_unknown[label]
+            scores[label] = self.log_priors[label] + sum(likelihoods.get(token, unknown) for token in tokens)
+        top = max(scores.values())
+        exp_scores = {label: math.exp(score - top) for label, score in scores.items()}
+        total = sum(exp_scores.values())
+        return {label: value / total for label, value in exp_scores.items()}
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "alpha": self.alpha,
+                "labels": self.labels,
+                "log_priors": self.log_priors,
+                "log_likelihoods": self.log_likelihoods,
+                "log_unknown": self.log_unknown
+            }, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'NaiveBayesModel':
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        model = cls(alpha=data["alpha"])
+        model.labels = data["labels"]
+        model.log_priors = data["log_priors"]
+        model.log_likelihoods = data["log_likelihoods"]
+        model.log_unknown = data["log_unknown"]
+        return model
+
+
+class RecipientClassifier:
+    """
+    Классификатор получателя: правила по основам слов + байесовская модель
+
+    Args:
+        model: Обученная модель (по умолчанию - обучается на SEED_CORPUS)
+        rules_weight: Доля правил в итоговой оценке, когда хотя бы одно правило сработало
+    """
+
+    def __init__(self, model: Optional[NaiveBayesModel] = None, rules_weight: float = 0.7):
+        self.model = model or NaiveBayesModel().fit(SEED_CORPUS)
+        self.rules_weight = rules_weight
+        # Все формы слов правил: слово текста проверяется одним поиском в словаре
+        self._rule_words: Dict[str, List[Tuple[str, float]]] = {}
+        for recipient, rules in RECIPIENT_RULES.items():
+            for rule_stem, weight, endings in rules:
+                for ending in set(endings):
+                    self._rule_words.setdefault(rule_stem + ending, []).append((recipient, weight))
+        self._interest_index = self._build_index(INTEREST_AGENTS.items())
+
+    @staticmethod
+    def _build_index(items) -> Dict[str, List[tuple]]:
+        index: Dict[str, List[tuple]] = {}
+        for prefix, value in items:
+            index.setdefault(prefix[:3], []).append((prefix, value))
+        return index
+
+    @staticmethod
+    def _match(index: Dict[str, List[tuple]], token: str):
+        for prefix, value in index.get(token[:3], ()):
+            if token.startswith(prefix):
+                yield value
+
+    def classify(self, person_info: str) -> RecipientPrediction:
+        """Тип получателя, уверенность и ранжированный список агентов"""
+        text = person_info.lower().replace("ё", "е")
+        words = _TOKEN_RE.findall(text)
+        tokens = [stem(word) for word in words]
+
+        # Правила по ключевым основам
+        rule_scores: Dict[str, float] = {}
+        rule_weights: List[float] = []
+        interest_scores: Dict[str, float] = {}
+        for word, token in zip(words, tokens):
+            for recipient, weight in self._rule_words.get(word, ()):
+                rule_scores[recipient] = rule_scores.get(recipient, 0.0) + weight
+                rule_weights.append(weight)
+            for agent in self._match(self._interest_index, token):
+                interest_scores[agent] = interest_scores.get(agent, 0.0) + 1.0
+
+        # Явно указанный возраст
+        age_match = _AGE_RE.search(text)
+        if age_match:
+            age = int(age_match.group(1))
+            if age < 14:
+                rule_scores["ребенок"] = rule_scores.get("ребенок", 0.0) + 3.0
+                rule_weights.append(3.0)
+            elif age >= 65:
+                rule_scores["пожилой человек"] = rule_scores.get("пожилой человек", 0.0) + 3.0
+                rule_weights.append(3.0)
+
+        # Смешиваем правила и модель
+        probabilities = self.model.predict_proba(tokens)
+        rules_total = sum(rule_scores.values())
+        if rules_total > 0:
+            labels = set(probabilities) | set(rule_scores)
+            probabilities = {
+                label: self.rules_weight * rule_scores.get(label, 0.0) / rules_total
+                + (1 - self.rules_weight) * probabilities.get(label, 0.0)
+                for label in labels
+            }
+
+        if probabilities:
+            recipient_type, confidence = max(probabilities.items(), key=lambda item: item[1])
+        else:
+            recipient_type, confidence = "знакомый", 0.0
+        
+        # Одно слабое совпадение (например, "подруг") - недостаточное основание обойтись без LLM
+        if len(rule_weights) == 1 and rule_weights[0] < STRONG_RULE_WEIGHT:
+            confidence = min(confidence, WEAK_RULE_MAX_CONFIDENCE)
+
+        return RecipientPrediction(
+            recipient_type=recipient_type,
+            confidence=round(confidence, 3),
+            agents=self._rank_agents(recipient_type, interest_scores),
+            probabilities=probabilities
+        )
+
+    @staticmethod
+    def _rank_agents(recipient_type: str, interest_scores: Dict[str, float]) -> List[str]:
+        """Базовые агенты типа получателя + агенты по упомянутым интересам"""
+        scores: Dict[str, float] = {}
+        for position, agent in enumerate(RECIPIENT_AGENTS.get(recipient_type, DEFAULT_AGENTS)):
+            scores[agent] = 3.0 - 0.5 * position
+        for agent, hits in interest_scores.items():
+            scores[agent] = scores.get(agent, 0.0) + 1.5 * hits
+        for position, agent in enumerate(DEFAULT_AGENTS):
+            scores.setdefault(agent, 0.5 - 0.1 * position)
+        return sorted(scores, key=lambda agent: scores[agent], reverse=True)
+
+
+def load_classifier(model_path: Optional[str] = None) -> RecipientClassifier:
+    """Классификатор с моделью из файла (если задан и читается) или обученной на встроенном корпусе"""
+    if model_path:
+        try:
+            return RecipientClassifier(model=NaiveBayesModel.load(model_path))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Не удалось загрузить модель получателя {model_path}: {str(e)}")
+    return RecipientClassifier()
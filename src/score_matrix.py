@@ -0,0 +1,163 @@
+"""
+Матрица оценок агенты × подарки и стратегии агрегации
+Строка - агент, столбец - подарок, NaN - агент подарок не оценивал. В режиме выбора одного подарка
+в строке заполнена одна клетка (выбранный подарок), в режиме оценки всех подарков - вся строка.
+Все стратегии считаются векторно по всей матрице сразу, рейтинг дает любой top-K за один запуск,
+а сохраненная матрица позволяет показать следующие подарки без новых вызовов LLM
+"""
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class ScoreMatrix:
+    """Оценки агентов по подаркам (шкала 0..100) и выбор каждого агента"""
+
+    def __init__(self, agents: Sequence[str], gift_ids: Sequence[str], weights: Optional[Sequence[float]] = None):
+        self.agents = list(agents)
+        self.gift_ids = list(gift_ids)
+        self.scores = np.full((len(self.agents), len(self.gift_ids)), np.nan)
+        self.picks = np.full(len(self.agents), -1, dtype=int)    # Столбец выбранного подарка (-1 - нет голоса)
+        self.weights = np.ones(len(self.agents)) if weights is None else np.asarray(weights, dtype=float)
+        self._rows = {agent: i for i, agent in enumerate(self.agents)}
+        self._columns = {gift_key: i for i, gift_key in enumerate(self.gift_ids)}
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.scores.shape
+
+    def add_scores(self, agent: str, scores: Dict[str, float]):
+        """Оценки агентом всех (или части) подарков"""
+        row = self._rows[agent]
+        for gift_key, score in scores.items():
+            column = self._columns.get(gift_key)
+            if column is not None:
+                self.scores[row, column] = score
+
+    def add_vote(self, agent: str, gift_key: str, score: float):
+        """Голос агента за подарок; оценка пишется, только если агент не оценил подарок сам"""
+        row, column = self._rows[agent], self._columns[gift_key]
+        self.picks[row] = column
+        if np.isnan(self.scores[row, column]):
+            self.scores[row, column] = score
+
+    @property
+    def mask(self) -> np.ndarray:
+        """Заполненные клетки"""
+        return ~np.isnan(self.scores)
+
+    def votes(self) -> np.ndarray:
+        """Число голосов за каждый подарок"""
+        return np.bincount(self.picks[self.picks >= 0], minlength=len(self.gift_ids))
+
+    def means(self) -> np.ndarray:
+        """Средняя оценка подарка по оценившим его агентам (NaN - никто не оценил)"""
+        mask = self.mask
+        counts = mask.sum(axis=0)
+        sums = np.where(mask, self.scores, 0.0).sum(axis=0)
+        return np.divide(sums, counts, out=np.full(len(self.gift_ids), np.nan), where=counts > 0)
+
+    def evaluated(self) -> np.ndarray:
+        """Подарки, по которым есть голос или оценка"""
+        return (self.votes() > 0) | self.mask.any(axis=0)
+
+    def voters(self, gift_key: str) -> List[Tuple[str, float]]:
+        """Агенты, выбравшие подарок, и их оценки"""
+        column = self._columns[gift_key]
+        rows = np.flatnonzero(self.picks == column)
+        return [(self.agents[row], float(self.scores[row, column])) for row in rows]
+
+    def aggregate(self, method: str) -> np.ndarray:
+        """Итоговый балл каждого подарка по стратегии (больше - лучше, NaN - нет данных)"""
+        if method not in AGGREGATIONS:
+            raise ValueError(f"Неизвестная стратегия агрегации: {method} (доступны: {', '.join(AGGREGATIONS)})")
+        return AGGREGATIONS[method](self)
+
+    def ranking(self, method: str) -> List[str]:
+        """
+        Все подарки от лучшего к худшему
+
+        Порядок: подарки с голосами или оценками, затем остальные; внутри - балл стратегии,
+        число голосов, средняя оценка, порядок в исходном списке
+        """
+        primary = np.nan_to_num(self.aggregate(method), nan=-np.inf)
+        means = np.nan_to_num(self.means(), nan=-np.inf)
+        # lexsort сортирует по возрастанию, главный ключ - последний
+        order = np.lexsort((np.arange(len(self.gift_ids)), -means, -self.votes(), -primary, ~self.evaluated()))
+        return [self.gift_ids[column] for column in order]
+
+    def top_k(self, method: str, k: int, offset: int = 0) -> List[str]:
+        """Подарки с offset по offset + k места рейтинга"""
+        return self.ranking(method)[offset:offset + k]
+
+
+def _weighted_mean(values: np.ndarray, mask: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Взвешенное среднее по столбцам с учетом только заполненных клеток"""
+    column_weights = (weights[:, None] * mask).sum(axis=0)
+    sums = (weights[:, None] * np.where(mask, values, 0.0)).sum(axis=0)
+    return np.divide(sums, column_weights, out=np.full(values.shape[1], np.nan), where=column_weights > 0)
+
+
+def mean_score(matrix: ScoreMatrix) -> np.ndarray:
+    """Средняя оценка по оценившим подарок агентам (с весами агентов, если они заданы)"""
+    return _weighted_mean(matrix.scores, matrix.mask, matrix.weights)
+
+
+def votes_then_mean(matrix: ScoreMatrix) -> np.ndarray:
+    """Число голосов (при равенстве ranking учитывает среднюю оценку) - прежний способ выбора"""
+    return matrix.votes().astype(float)
+
+
+def zscore_mean(matrix: ScoreMatrix) -> np.ndarray:
+    """
+    Средний z-score: оценки каждого агента нормируются по его собственной шкале
+    (строгий и щедрый агент дают одинаковый вклад); агент с одной оценкой или без разброса дает 0
+    """
+    mask = matrix.mask
+    counts = np.maximum(mask.sum(axis=1, keepdims=True), 1)
+    values = np.where(mask, matrix.scores, 0.0)
+    row_means = values.sum(axis=1, keepdims=True) / counts
+    row_stds = np.sqrt((np.where(mask, matrix.scores - row_means, 0.0) ** 2).sum(axis=1, keepdims=True) / counts)
+    z = np.divide(matrix.scores - row_means, row_stds, out=np.zeros_like(matrix.scores), where=row_stds > 0)
+    return _weighted_mean(z, mask, matrix.weights)
+
+
+def _preferences(matrix: ScoreMatrix) -> np.ndarray:
+    """
+    prefer[a, g, h] - агент a ставит подарок g выше h
+    Неоцененные подарки считаются хуже любого оцененного и равными между собой
+    """
+    filled = np.where(matrix.mask, matrix.scores, -np.inf)
+    return filled[:, :, None] > filled[:, None, :]
+
+
+def borda(matrix: ScoreMatrix) -> np.ndarray:
+    """Счет Борда: сколько подарков агент поставил ниже данного (ничья - пол-очка), сумма по агентам"""
+    filled = np.where(matrix.mask, matrix.scores, -np.inf)
+    above = _preferences(matrix).sum(axis=2)
+    ties = (filled[:, :, None] == filled[:, None, :]).sum(axis=2) - 1
+    active = matrix.weights * matrix.mask.any(axis=1)
+    return active @ (above + 0.5 * ties)
+
+
+def condorcet(matrix: ScoreMatrix) -> np.ndarray:
+    """
+    Метод Копленда: число подарков, которые данный побеждает в попарных сравнениях (ничья - пол-очка)
+    Победитель по Кондорсе, если он есть, получает максимум - число подарков минус один
+    """
+    active = matrix.weights * matrix.mask.any(axis=1)
+    pairwise = np.einsum("a,agh->gh", active, _preferences(matrix).astype(float))
+    wins = (pairwise > pairwise.T).sum(axis=1)
+    ties = (pairwise == pairwise.T).sum(axis=1) - 1
+    return wins + 0.5 * ties
+
+
+# Стратегии агрегации по имени (Configuration.score_aggregation)
+AGGREGATIONS: Dict[str, Callable[[ScoreMatrix], np.ndarray]] = {
+    "votes": votes_then_mean,
+    "mean": mean_score,
+    "borda": borda,
+    "condorcet": condorcet,
+    "zscore": zscore_mean
+}
@@ -0,0 +1,74 @@
+"""
+Склейка одинаковых одновременных запросов (singleflight)
+Параллельные вызовы с одним ключом ждут один общий запрос и получают его результат
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight:
+    """Общий запрос и число ожидающих его вызовов"""
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Один запрос на ключ в каждый момент времени
+
+    Отмена считается по ссылкам: если ушел один из ожидающих, общий запрос продолжается,
+    он отменяется только когда не осталось ни одного ожидающего
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._stats = {
+            "запросов": 0,
+            "склеено": 0,
+            "отменено": 0
+        }
+        self.logger = logging.getLogger("SingleFlight")
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполнение factory() или присоединение к уже идущему вызову с тем же ключом
+
+        Args:
+            key: Отпечаток запроса
+            factory: Создает корутину запроса (вызывается только для первого вызова)
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self._stats["запросов"] += 1
+        else:
+            self._stats["склеено"] += 1
+            self.logger.info(f"🔗 Запрос {key[:12]} уже выполняется, ждем общий результат")
+
+        flight.waiters += 1
+        try:
+            # shield: отмена одного ожидающего не должна отменять общий запрос
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+                self._forget(key, flight)
+                self._stats["отменено"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["в_полете"] = len(self._flights)
+        return stats
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
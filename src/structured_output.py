@@ -0,0 +1,100 @@
+"""
+Структурированный вывод: response_format с JSON схемой (OpenAI-совместимый API)
+Схема этапа передается модели, ответ по схеме разбирается без эвристик.
+Статистика по моделям: сколько ответов не разобралось и сколько раз пришлось брать резервный результат
+"""
+
+import copy
+from typing import Any, Dict
+
+# Ключи схемы, которые строгий режим OpenAI не принимает (проверку по ним делает pydantic после ответа)
+_STRICT_UNSUPPORTED = ("default", "minLength", "maxLength", "title")
+
+# Ответ 400 относится к response_format, если упоминает его
+_FEATURE_MARKERS = ("response_format", "json_schema", "structured output")
+# ...и означает, что параметр не поддерживается вообще (а не что схема некорректна)
+_UNSUPPORTED_MARKERS = (
+    "not supported", "unsupported", "does not support", "doesn't support", "not available",
+    "unrecognized", "unknown parameter", "not permitted", "not allowed"
+)
+
+
+def _strict_schema(schema: Any) -> Any:
+    """Схема для strict режима: у объектов все поля обязательны и нет лишних полей"""
+    if isinstance(schema, list):
+        return [_strict_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    result = {}
+    for key, value in schema.items():
+        if key in ("properties", "$defs"):
+            # Имена полей и определений - не ключи схемы, фильтровать их нельзя
+            result[key] = {name: _strict_schema(item) for name, item in value.items()}
+        elif key not in _STRICT_UNSUPPORTED:
+            result[key] = _strict_schema(value)
+    if result.get("type") == "object" and "properties" in result:
+        result["required"] = list(result["properties"])
+        result["additionalProperties"] = False
+    return result
+
+
+def json_schema_format(name: str, schema: Dict[str, Any], strict: bool = False) -> Dict[str, Any]:
+    """
+    Значение response_format для схемы
+
+    Args:
+        name: Имя схемы (латиница, цифры, _ и -)
+        schema: JSON схема (например, model_json_schema() модели pydantic)
+        strict: Строгое соответствие схеме - только если все поля модели обязательны
+    """
+    schema = _strict_schema(schema) if strict else copy.deepcopy(schema)
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": strict, "schema": schema}}
+
+
+def _mentions_feature(status: int, body: str) -> bool:
+    return status == 400 and any(marker in body for marker in _FEATURE_MARKERS)
+
+
+def is_unsupported_error(status: int, body: str) -> bool:
+    """Ответ 400 означает, что модель у провайдера не поддерживает response_format"""
+    body = body.lower()
+    return _mentions_feature(status, body) and any(marker in body for marker in _UNSUPPORTED_MARKERS)
+
+
+def is_invalid_schema_error(status: int, body: str) -> bool:
+    """
+    Ответ 400 про response_format без признаков неподдерживаемого параметра - провайдер отклонил
+    саму схему (например, требования strict режима): функция работает, чинить нужно схему этапа
+    """
+    body = body.lower()
+    return _mentions_feature(status, body) and not any(marker in body for marker in _UNSUPPORTED_MARKERS)
+
+
+class ParseStats:
+    """Доля неразобранных ответов и резервных результатов по моделям"""
+
+    def __init__(self):
+        self._models: Dict[str, Dict[str, int]] = {}
+
+    def _counters(self, model: str) -> Dict[str, int]:
+        return self._models.setdefault(model, {"ответов": 0, "по_схеме": 0, "ошибок_разбора": 0, "резервных": 0})
+
+    def record_response(self, model: str, structured: bool, parsed: bool):
+        counters = self._counters(model)
+        counters["ответов"] += 1
+        counters["по_схеме"] += int(structured)
+        counters["ошибок_разбора"] += int(not parsed)
+
+    def record_fallback(self, model: str, count: int = 1):
+        self._counters(model)["резервных"] += count
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for model, counters in self._models.items():
+            responses = counters["ответов"]
+            result[model] = {
+                **counters,
+                "доля_ошибок_разбора": round(counters["ошибок_разбора"] / responses, 3) if responses else 0.0,
+                "доля_резервных": round(counters["резервных"] / responses, 3) if responses else 0.0
+            }
+        return result
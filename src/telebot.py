@@ -1,15 +1,19 @@
-from typing import TypedDict, Annotated, List, Dict, Any, Union
+from typing import TypedDict, Annotated, List, Dict, Any, Optional, Union
 from io import BytesIO
+import asyncio
+import html
 import logging
+import time
 from telegram import PhotoSize, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
 from telegram.constants import ParseMode
 import urllib.parse
 import traceback
 from agent_context import AgentContext
+from gift_queue import GiftJob, GiftJobQueue, QueueFullError
 
 # run agent
-from agent5 import run_neuro_gift
+from agent5 import run_neuro_gift_async, show_more_gifts, start_shared_api_client, close_shared_api_client
 import os
 
 from dotenv import load_dotenv
@@ -26,6 +30,23 @@ if None != TOKEN:
 else:
     print("Telegram Token missed")
 
+# Сколько апдейтов Telegram обрабатывается одновременно (запуски агента не блокируют друг друга)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 16))
+
+# Очередь подбора подарков: сколько запусков агента идет одновременно и сколько ждет
+GIFT_WORKERS = int(os.getenv("GIFT_WORKERS", 4))
+GIFT_QUEUE_MAX_SIZE = int(os.getenv("GIFT_QUEUE_MAX_SIZE", 50))
+
+gift_queue = GiftJobQueue(workers=GIFT_WORKERS, max_queue_size=GIFT_QUEUE_MAX_SIZE)
+
+# Минимальный интервал между редактированиями сообщений в одном чате (лимиты Telegram)
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", 1.5))
+
+# /more: сколько следующих подарков рейтинга показать; ключи chat_data с последним запуском в чате
+MORE_GIFTS_COUNT = int(os.getenv("MORE_GIFTS_COUNT", 2))
+LAST_RUN_KEY = "last_gift_run"
+SHOWN_GIFTS_KEY = "shown_gifts"
+
 
 # Настройка логгирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -38,6 +59,7 @@ async def start(update: Update, context):
 Помогу подобрать идеальный подарок — персонально, с заботой и на основе того, что действительно важно для получателя.
 
 Расскажи мне о человеке, которому хочешь сделать сюрприз, о его личности и увлечениях. С меня - все остальное.                                    
+Захочешь увидеть другие варианты из того же подбора - отправь /more.
 """)
 
     
@@ -71,6 +93,21 @@ def string_results(final_selection):
     
     return result
 
+def string_gifts_list(gifts_data):
+    """Сгенерированный список подарков, по убыванию релевантности"""
+    result = "📝 Варианты подарков:\n"
+    ranked = sorted(gifts_data, key=lambda gift: gift.get('релевантность', 0), reverse=True)
+    for i, gift in enumerate(ranked, 1):
+        result += f"{i}. {html.escape(str(gift['подарок']))} — ⭐ {gift.get('релевантность', '?')}/10\n"
+    return result
+
+def string_vote_tally(tally, completed, total):
+    """Текущий подсчет голосов агентов"""
+    result = f"🗳️ Голосование агентов: {completed}/{total}\n"
+    for gift_name, votes in sorted(tally.items(), key=lambda item: item[1], reverse=True):
+        result += f"   {html.escape(str(gift_name))}: {votes}\n"
+    return result
+
 def get_links(query):
     result = ""
     markets = [
@@ -158,11 +195,88 @@ def strOrEmpty(data : str) :
     
     return data
         
+class ProgressMessage:
+    """
+    Одно сообщение, которое редактируется по мере выполнения этапов агента
+
+    Промежуточные обновления склеиваются: в чат уходит не чаще одного
+    редактирования в PROGRESS_EDIT_INTERVAL секунд, всегда с последним текстом
+    """
+
+    # Время последнего редактирования по чатам - общий лимит для всех запросов чата;
+    # записи старше интервала лимит не задают и удаляются при завершении запросов
+    _last_edit_by_chat: Dict[int, float] = {}
+
+    def __init__(self, message, interval: float = PROGRESS_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._pending_text = None
+        self._last_text = None
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+        self.gifts_text = ""
+        self.tally = {}
+
+    async def update(self, text: str):
+        """Промежуточное обновление - отправится с учетом лимита"""
+        self._pending_text = text
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def finish(self, text: str):
+        """Финальный текст - отправляется всегда, с учетом лимита"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._pending_text = text
+        if not await self._flush():
+            # Отредактировать не удалось - итог не должен потеряться
+            await self.message.reply_html(text, disable_web_page_preview=True)
+        self._prune_edit_times()
+
+    async def on_progress(self, stage: str, payload: Dict[str, Any]):
+        """Колбэк для AgentContext.progress_callback"""
+        if stage == "gifts_generated":
+            self.gifts_text = string_gifts_list(payload["gifts_data"])
+            await self.update(self.gifts_text + "\n⏳ Агенты оценивают варианты...")
+        elif stage == "agent_vote":
+            gift_name = payload["response"].get("выбранный_подарок")
+            if gift_name:
+                self.tally[gift_name] = self.tally.get(gift_name, 0) + 1
+            await self.update(self.gifts_text + "\n" + string_vote_tally(self.tally, payload["completed"], payload["total"]))
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self._wait_time())
+        await self._flush()
+
+    def _prune_edit_times(self):
+        """Удаление времени редактирования чатов, где интервал уже прошел, - словарь не растет с числом чатов"""
+        expired = time.monotonic() - self.interval
+        for chat_id, last_edit in list(self._last_edit_by_chat.items()):
+            if last_edit <= expired:
+                del self._last_edit_by_chat[chat_id]
+
+    def _wait_time(self) -> float:
+        last_edit = self._last_edit_by_chat.get(self.message.chat_id, 0.0)
+        return max(0.0, last_edit + self.interval - time.monotonic())
+
+    async def _flush(self) -> bool:
+        async with self._lock:
+            await asyncio.sleep(self._wait_time())
+            text = self._pending_text
+            if text is None or text == self._last_text:
+                return True
+            self._last_edit_by_chat[self.message.chat_id] = time.monotonic()
+            try:
+                await self.message.edit_text(text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+                self._last_text = text
+                return True
+            except Exception:
+                print(traceback.format_exc())
+                print("Failed edit progress message")
+                return False
+
 # Обработчик текстовых сообщений (интеграция с вашим скриптом)
 async def handle_message(update: Update, context: CallbackContext):
-    # ответ пользователю
-    await update.message.reply_text(f"Вызов принят, скоро вернусь с ответом")
-
     try:
         user_input = strOrEmpty(update.message.text) + strOrEmpty(update.message.caption)
         
@@ -177,28 +291,105 @@ async def handle_message(update: Update, context: CallbackContext):
         agentContext = AgentContext()
         agentContext.person_info = user_input
         agentContext.photos = files
+        agentContext.user_id = str(update.effective_user.id) if update.effective_user else None
         
         print(f"== Telegram input: {agentContext.person_info} photos:{len(agentContext.photos)}")
         
-        await call_agent(agentContext, update)
+        await enqueue_agent(agentContext, update, context.chat_data)
         
     except Exception:
         print(traceback.format_exc())
         await update.message.reply_text(f"Что-то пошло не так... повторите запрос")
 
-async def call_agent(context: AgentContext, update: Update):
-    result = run_neuro_gift(context)
+# Обработчик команды /more - следующие подарки рейтинга последнего запроса, без вызовов LLM
+async def more(update: Update, context: CallbackContext):
+    last_run = context.chat_data.get(LAST_RUN_KEY)
+    if last_run is None:
+        await update.message.reply_text("Сначала расскажите о человеке, которому выбираем подарок")
+        return
+
+    shown = context.chat_data.get(SHOWN_GIFTS_KEY, 0)
+    gifts = show_more_gifts(last_run, shown, MORE_GIFTS_COUNT)
+    if not gifts:
+        await update.message.reply_text("Других вариантов нет - расскажите о человеке подробнее, и я подберу новые")
+        return
+
+    context.chat_data[SHOWN_GIFTS_KEY] = shown + len(gifts)
+    await update.message.reply_html(string_results(gifts), disable_web_page_preview=True)
+
+async def enqueue_agent(context: AgentContext, update: Update, chat_data: Optional[Dict[str, Any]] = None):
+    """Постановка запроса в очередь, хендлер не ждет завершения агента"""
+    status_message = await update.message.reply_text("Вызов принят, скоро вернусь с ответом")
+
+    progress = ProgressMessage(status_message)
+    context.progress_callback = progress.on_progress
+
+    async def on_position(position: int):
+        await progress.update(f"Вызов принят, вы {position}-й в очереди")
+
+    async def on_start():
+        await progress.update("Подбираю подарки, скоро вернусь с ответом")
+
+    async def run():
+        try:
+            await call_agent(context, progress, chat_data)
+        except Exception:
+            print(traceback.format_exc())
+            await progress.finish(f"Что-то пошло не так... повторите запрос")
+
+    job = GiftJob(run=run, on_position=on_position, on_start=on_start)
+    try:
+        position = await gift_queue.submit(job)
+    except QueueFullError:
+        await progress.finish("Сейчас очень много запросов 🎄 Попробуйте повторить через пару минут")
+        return
+
+    if position > 1 and not job.started:
+        await on_position(position)
+
+async def call_agent(context: AgentContext, progress: ProgressMessage, chat_data: Optional[Dict[str, Any]] = None):
+    # Нативный async вызов: пока агент ждет ответов LLM, event loop обслуживает других пользователей
+    result = await run_neuro_gift_async(context)
     str_results = string_results(result)
+
+    if chat_data is not None:
+        # Матрица оценок запуска остается в чате для /more; фото больше не нужны
+        context.photos = []
+        chat_data[LAST_RUN_KEY] = context
+        chat_data[SHOWN_GIFTS_KEY] = len(result)
     
     #str_results = "Test"
-    await update.message.reply_html(f"{str_results}")
+    # Итог заменяет промежуточный прогресс в том же сообщении
+    await progress.finish(f"{str_results}")
+
+async def on_startup(application: Application):
+    # Один API клиент на весь процесс: общий пул соединений и общий лимит запросов к LLM
+    try:
+        await start_shared_api_client()
+    except Exception:
+        print(traceback.format_exc())
+        print("Shared API client not started")
+    await gift_queue.start()
+
+async def on_shutdown(application: Application):
+    await gift_queue.stop()
+    await close_shared_api_client()
 
 # Основная функция
 def main():
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    print(f"Concurrent updates: {MAX_CONCURRENT_UPDATES}, gift workers: {GIFT_WORKERS}, queue: {GIFT_QUEUE_MAX_SIZE}")
 
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("more", more))
     application.add_handler(MessageHandler(filters.PHOTO | filters.TEXT & ~filters.COMMAND, handle_message))
 
     # Запускаем бота
@@ -0,0 +1,58 @@
+"""
+Проверки сопоставления ответа агента с подарком: id, номер, название и его перефразировки
+
+Запуск: python -m pytest -q test_gift_index.py
+"""
+
+import pytest
+
+from gift_index import GiftIndex, assign_gift_ids
+
+GIFTS = assign_gift_ids([
+    {"подарок": "Набор для рисования акварелью"},
+    {"подарок": "Умная колонка «Алиса»"},
+    {"подарок": "Книга"},
+])
+
+
+@pytest.fixture(scope="module")
+def index() -> GiftIndex:
+    return GiftIndex(GIFTS)
+
+
+@pytest.mark.parametrize("reference, gift_key", [
+    ("g2", "g2"),
+    ("G3", "g3"),
+    (" g1 ", "g1"),
+    ("2", "g2"),
+    (3, "g3"),
+])
+def test_resolve_id_and_number(index, reference, gift_key):
+    assert index.resolve(reference) == gift_key
+
+
+def test_unknown_id_is_not_guessed(index):
+    assert index.resolve("g7") is None
+    assert index.resolve("9") is None
+
+
+@pytest.mark.parametrize("reference, gift_key", [
+    ("умная колонка Алиса", "g2"),
+    ("Умная колонка", "g2"),
+    ("Набор для рисования акварелью премиум", "g1"),
+    ("Набор для рисования акварелю", "g1"),
+    ("Книги", "g3"),
+])
+def test_resolve_paraphrased_name(index, reference, gift_key):
+    assert index.resolve(reference) == gift_key
+
+
+@pytest.mark.parametrize("reference", ["a", "кол", "для", "", None, "Велосипед"])
+def test_fragments_do_not_match(index, reference):
+    assert index.resolve(reference) is None
+
+
+def test_gifts_without_ids_get_positional_ids():
+    index = GiftIndex([{"подарок": "Книга"}, {"подарок": "Плед"}])
+    assert index.resolve("Плед") == "g2"
+    assert index.get("g1")["подарок"] == "Книга"
@@ -0,0 +1,86 @@
+"""
+Проверки извлечения JSON из ответов LLM: починка испорченного JSON и инкрементальный разбор потока
+
+Запуск: python -m pytest -q test_json_extract.py
+"""
+
+import pytest
+
+from json_extract import JSONExtractError, JSONStreamExtractor, extract_json, repair_json
+
+
+def test_extract_json_from_markdown_and_prose():
+    value, repaired = extract_json('Вот ответ:\n```json\n{"подарок": "Книга", "оценка": 80}\n```')
+    assert value == {"подарок": "Книга", "оценка": 80}
+    assert not repaired
+
+
+@pytest.mark.parametrize("text, expected_value", [
+    ('{"a": 1, "b": [1, 2,],}', {"a": 1, "b": [1, 2]}),
+    ('[{"id": "g1"}, {"id": "g2"},\n]', [{"id": "g1"}, {"id": "g2"}]),
+])
+def test_trailing_commas_are_removed(text, expected_value):
+    value, repaired = extract_json(text)
+    assert value == expected_value
+    assert repaired
+
+
+@pytest.mark.parametrize("text, expected_value", [
+    ('{"выбранный_подарок": "g2", "обоснование": "Подходит для', {"выбранный_подарок": "g2", "обоснование": "Подходит для"}),
+    ('[{"подарок": "Книга"}, {"подарок": "Пле', [{"подарок": "Книга"}, {"подарок": "Пле"}]),
+    ('{"a": 1, "b": {"c": [1, 2', {"a": 1, "b": {"c": [1, 2]}}),
+])
+def test_truncated_response_is_closed(text, expected_value):
+    value, repaired = extract_json(text)
+    assert value == expected_value
+    assert repaired
+
+
+def test_truncated_response_keeps_outer_object():
+    # Обрезанный ответ агента не должен подменяться вложенным объектом
+    value, _ = extract_json('{"оценки": {"g1": 80}, "выбранный_подарок": "g1", "обоснование": "Т', dict)
+    assert value["выбранный_подарок"] == "g1"
+    assert value["оценки"] == {"g1": 80}
+
+
+def test_repair_drops_unfinished_key():
+    assert repair_json('{"a": 1, "b') == '{"a": 1}'
+
+
+def test_smart_quotes_are_repaired():
+    value, _ = extract_json("{“подарок”: “Книга”}")
+    assert value == {"подарок": "Книга"}
+
+
+def test_expected_type_is_enforced():
+    with pytest.raises(JSONExtractError):
+        extract_json('{"a": 1}', expected=list)
+
+
+def feed_all(extractor: JSONStreamExtractor, chunks) -> bool:
+    return any([extractor.feed(chunk) for chunk in chunks])
+
+
+@pytest.mark.parametrize("chunks", [
+    ['Ответ [1] ниже: {"a":1}'],
+    ["Ответ [1] ниже", ': {"a"', ":1}"],
+    ["См. [примечание] и [2]: ", '{"a": 1}'],
+])
+def test_stream_skips_prose_brackets_before_expected_object(chunks):
+    extractor = JSONStreamExtractor(expected=dict)
+    assert feed_all(extractor, chunks)
+    assert extractor.value == {"a": 1}
+
+
+def test_stream_without_expected_type_skips_text_in_brackets():
+    extractor = JSONStreamExtractor()
+    assert extractor.feed('Подарки [см. ниже]: [{"подарок": "Книга"}]')
+    assert extractor.value == [{"подарок": "Книга"}]
+
+
+def test_stream_waits_for_the_closing_bracket():
+    extractor = JSONStreamExtractor(expected=dict)
+    assert not extractor.feed('{"a": {"b": "}"')
+    assert extractor.partial() == {"a": {"b": "}"}}
+    assert extractor.feed("}} и текст после")
+    assert extractor.text == '{"a": {"b": "}"}}'
@@ -0,0 +1,74 @@
+"""
+Проверки локального классификатора получателя на формулировках, где основы правил
+совпадают с началом посторонних слов (мужчина/мужик/муж, женат/жена, детство/дети,
+математика/мать, тетрис/тетя, командировка/команда)
+
+Запуск: python -m pytest -q test_recipient_classifier.py
+"""
+
+import pytest
+
+from recipient_classifier import RecipientClassifier
+
+# Порог Configuration.classifier_min_confidence: ниже него решение принимает LLM селектор
+LLM_CUTOFF = 0.6
+# Без сработавшего правила вероятность типа дает только байесовская модель (правило дало бы от 0.7)
+MAX_UNRELATED_PROBABILITY = 0.2
+
+
+@pytest.fixture(scope="module")
+def classifier() -> RecipientClassifier:
+    return RecipientClassifier()
+
+
+@pytest.mark.parametrize("person_info", [
+    "Мужчина 35 лет, любит рыбалку",
+    "Женщина, 40 лет, работает врачом",
+    "Подруга детства",
+])
+def test_ambiguous_wording_falls_through_to_llm(classifier, person_info):
+    prediction = classifier.classify(person_info)
+    assert prediction.confidence < LLM_CUTOFF
+
+
+def test_childhood_is_not_a_child(classifier):
+    assert classifier.classify("Подруга детства").recipient_type != "ребенок"
+
+
+def test_mathematics_is_not_a_parent(classifier):
+    prediction = classifier.classify("Учитель математики в школе")
+    assert prediction.recipient_type == "учитель"
+    assert prediction.probabilities.get("родитель", 0.0) < 0.1
+
+
+@pytest.mark.parametrize("person_info, recipient_type", [
+    ("Муж 40 лет, инженер, любит футбол", "супруг/супруга"),
+    ("Жена, 35 лет, годовщина свадьбы", "супруг/супруга"),
+    ("Сыну 7 лет, любит конструкторы", "ребенок"),
+    ("Мама, 55 лет, любит сад", "родитель"),
+])
+def test_direct_mentions_stay_local(classifier, person_info, recipient_type):
+    prediction = classifier.classify(person_info)
+    assert prediction.recipient_type == recipient_type
+    assert prediction.confidence >= LLM_CUTOFF
+
+
+@pytest.mark.parametrize("person_info, unrelated_type", [
+    ("Подарок мужику на работе", "супруг/супруга"),
+    ("Жених, свадьба через месяц", "супруг/супруга"),
+    ("Женат, работает инженером", "супруг/супруга"),
+    ("Часто в командировках, любит тетрис", "родственник"),
+    ("Часто в командировках, любит тетрис", "коллега"),
+    ("Любит матовые кружки и папайю", "родитель"),
+])
+def test_rules_match_whole_words(classifier, person_info, unrelated_type):
+    prediction = classifier.classify(person_info)
+    assert prediction.probabilities.get(unrelated_type, 0.0) < MAX_UNRELATED_PROBABILITY
+
+
+@pytest.mark.parametrize("person_info, recipient_type", [
+    ("Подарок мужику на работе, коллега из отдела продаж", "коллега"),
+    ("Начальнику, любит матовые кружки и папайю", "начальник"),
+])
+def test_lookalike_words_do_not_outvote_recipient(classifier, person_info, recipient_type):
+    assert classifier.classify(person_info).recipient_type == recipient_type
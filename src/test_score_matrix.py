@@ -0,0 +1,72 @@
+"""
+Проверки стратегий агрегации матрицы оценок агенты × подарки
+
+Запуск: python -m pytest -q test_score_matrix.py
+"""
+
+import numpy as np
+import pytest
+
+from score_matrix import AGGREGATIONS, ScoreMatrix
+
+GIFT_IDS = ["g1", "g2", "g3"]
+
+
+def scored(rows):
+    """Матрица с полными оценками: агент -> оценки подарков по порядку GIFT_IDS"""
+    matrix = ScoreMatrix(list(rows), GIFT_IDS)
+    for agent, scores in rows.items():
+        matrix.add_scores(agent, dict(zip(GIFT_IDS, scores)))
+    return matrix
+
+
+def test_condorcet_winner_beats_every_other_gift():
+    # g1 выигрывает у g2 (a, c) и у g3 (a, b), хотя у b и c он не первый
+    matrix = scored({"a": [90, 80, 10], "b": [80, 90, 70], "c": [70, 60, 80]})
+    assert matrix.aggregate("condorcet").tolist() == [2.0, 1.0, 0.0]
+    assert matrix.ranking("condorcet")[0] == "g1"
+
+
+def test_borda_tie_is_broken_by_mean_then_list_order():
+    matrix = scored({"a": [90, 40, 10], "b": [40, 90, 10]})
+    borda = matrix.aggregate("borda")
+    assert borda[0] == borda[1] > borda[2]
+    assert matrix.ranking("borda") == ["g1", "g2", "g3"]
+
+
+def test_zscore_row_without_spread_contributes_zero():
+    matrix = scored({"flat": [50, 50, 50], "b": [90, 50, 10]})
+    z = matrix.aggregate("zscore")
+    assert np.isfinite(z).all()
+    assert z[0] == pytest.approx(-z[2])
+    assert z[1] == pytest.approx(0.0)
+    assert z[0] == pytest.approx(np.sqrt(1.5) / 2)
+
+
+def test_zscore_of_flat_matrix_is_zero():
+    assert scored({"a": [70, 70, 70]}).aggregate("zscore").tolist() == [0.0, 0.0, 0.0]
+
+
+def test_votes_and_mean_ignore_missing_cells():
+    matrix = ScoreMatrix(["a", "b", "c"], GIFT_IDS)
+    matrix.add_vote("a", "g2", 80)
+    matrix.add_vote("b", "g2", 60)
+    matrix.add_vote("c", "g1", 90)
+    assert matrix.votes().tolist() == [1, 2, 0]
+    mean = matrix.aggregate("mean")
+    assert mean[:2].tolist() == [90.0, 70.0]
+    assert np.isnan(mean[2])
+    assert matrix.ranking("votes") == ["g2", "g1", "g3"]
+    assert matrix.top_k("mean", 1, offset=1) == ["g2"]
+
+
+def test_unevaluated_gifts_rank_last_for_every_strategy():
+    matrix = ScoreMatrix(["a"], GIFT_IDS)
+    matrix.add_vote("a", "g3", 70)
+    for method in AGGREGATIONS:
+        assert matrix.ranking(method)[0] == "g3"
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        scored({"a": [1, 2, 3]}).aggregate("weighted_mean")